@@ -23,13 +23,14 @@ from __future__ import print_function
 
 __docformat__ = 'restructuredtext'
 
-import csv, getopt, getpass, os, re, shutil, sys, UserDict, operator
+import csv, getopt, getpass, os, re, shutil, sys, UserDict, operator, time
 
 from roundup import date, hyperdb, roundupdb, init, password, token
 from roundup import __version__ as roundup_version
 import roundup.instance
 from roundup.configuration import CoreConfig, NoConfigError, UserConfig
 from roundup.i18n import _
+from roundup.mailer import Mailer, get_mail_queue
 from roundup.exceptions import UsageError
 
 # Polyglot code
@@ -56,6 +57,145 @@ class CommandDict(UserDict.UserDict):
             raise KeyError(key)
         return l
 
+class colon_separated(csv.excel):
+    delimiter = ':'
+
+def export_class(db, classname, dir, export_files=True, batch_size=100,
+        verbose=False):
+    """Export the items and journals of a class to colon-separated-value
+    files in dir, fetching "batch_size" items at a time.
+
+    Return the number of items exported and the length of the longest
+    field written.
+    """
+    cl = db.getclass(classname)
+
+    if not export_files and hasattr(cl, 'export_files'):
+        sys.stdout.write('Exporting %s WITHOUT the files\r\n'%
+            classname)
+
+    f = open(os.path.join(dir, classname+'.csv'), 'wb')
+    writer = csv.writer(f, colon_separated)
+
+    propnames = cl.export_propnames()
+    fields = propnames[:]
+    fields.append('is retired')
+    writer.writerow(fields)
+
+    # all nodes for this class
+    max_len = 0
+    nodeids = cl.getnodeids()
+    for i in range(0, len(nodeids), batch_size):
+        batch = nodeids[i:i + batch_size]
+        cl.getnodes(batch)
+        for nodeid in batch:
+            if verbose:
+                sys.stdout.write('\rExporting %s - %s'%(classname, nodeid))
+                sys.stdout.flush()
+            exp = cl.export_list(propnames, nodeid)
+            max_len = max([max_len] + [len(x) for x in exp])
+            writer.writerow(exp)
+            if export_files and hasattr(cl, 'export_files'):
+                cl.export_files(dir, nodeid)
+
+    # close this file
+    f.close()
+
+    # export the journals
+    jf = open(os.path.join(dir, classname+'-journals.csv'), 'wb')
+    if verbose:
+        sys.stdout.write("\nExporting Journal for %s\n" % classname)
+        sys.stdout.flush()
+    journals = csv.writer(jf, colon_separated)
+    for row in cl.export_journals():
+        journals.writerow(row)
+    jf.close()
+    return len(nodeids), max_len
+
+def import_class(db, classname, dir, batch_size=100, verbose=False):
+    """Import the items and journals of a class from the files written
+    by export_class(), "batch_size" items at a time.
+
+    Return the number of items imported.
+    """
+    cl = db.getclass(classname)
+
+    # ensure that the properties and the CSV file headings match
+    f = open(os.path.join(dir, classname+'.csv'), 'r')
+    reader = csv.reader(f, colon_separated)
+    file_props = None
+    maxid = 1
+    count = 0
+    batch = []
+    db.begin_import(classname)
+    try:
+        # loop through the file and create a node for each entry
+        for n, r in enumerate(reader):
+            if file_props is None:
+                file_props = r
+                continue
+
+            if verbose:
+                sys.stdout.write('\rImporting %s - %s'%(classname, n))
+                sys.stdout.flush()
+
+            batch.append(r)
+            if len(batch) < batch_size:
+                continue
+            maxid = max([maxid] + import_batch(cl, dir, file_props, batch))
+            count += len(batch)
+            batch = []
+        if batch:
+            maxid = max([maxid] + import_batch(cl, dir, file_props, batch))
+            count += len(batch)
+    finally:
+        db.end_import(classname)
+
+    # (print to sys.stdout here to allow tests to squash it .. ugh)
+    print(file=sys.stdout)
+
+    f.close()
+
+    # import the journals
+    f = open(os.path.join(dir, classname + '-journals.csv'), 'r')
+    reader = csv.reader(f, colon_separated)
+    cl.import_journals(reader)
+    f.close()
+
+    # (print to sys.stdout here to allow tests to squash it .. ugh)
+    print('setting', classname, maxid+1, file=sys.stdout)
+
+    # set the id counter
+    db.setid(classname, str(maxid+1))
+    return count
+
+def import_batch(cl, dir, file_props, rows):
+    """Import the rows and their files, returning the ids as numbers.
+    """
+    nodeids = cl.import_lists(file_props, rows)
+    if hasattr(cl, 'import_files'):
+        for nodeid in nodeids:
+            cl.import_files(dir, nodeid)
+    return [int(nodeid) for nodeid in nodeids]
+
+def run_in_tracker(args):
+    """Call function(db, *args) with a new admin connection to the
+    tracker and commit. This is run by the worker processes of the
+    export and import commands.
+
+    Return the classname, the function's result and the time taken.
+    """
+    tracker_home, function, classname, args = args
+    db = roundup.instance.open(tracker_home).open('admin')
+    try:
+        db.tx_Source = 'cli'
+        start = time.time()
+        result = function(db, classname, *args)
+        db.commit()
+        return classname, result, time.time() - start
+    finally:
+        db.close()
+
 class AdminTool:
     """ A collection of methods used in maintaining Roundup trackers.
 
@@ -1161,7 +1301,7 @@ Erase it? Y/N: """))
         return 0
 
     def do_export(self, args, export_files=True):
-        ''"""Usage: export [[-]class[,class]] export_dir
+        ''"""Usage: export [batch=N] [processes=N] [[-]class[,class]] export_dir
         Export the database to colon-separated-value files.
         To exclude the files (e.g. for the msg or file class),
         use the exporttables command.
@@ -1172,7 +1312,15 @@ Erase it? Y/N: """))
         This action exports the current data from the database into
         colon-separated-value files that are placed in the nominated
         destination directory.
+
+        Items are fetched "batch" (default 100) at a time. If
+        "processes" is more than one, that many processes export
+        classes in parallel. This is only done for the postgresql and
+        mysql backends.
         """
+        options, args = self.int_options_from_args(args,
+            batch=100, processes=1)
+
         # grab the directory to export to
         if len(args) < 1:
             raise UsageError(_('Not enough arguments supplied'))
@@ -1188,9 +1336,8 @@ Erase it? Y/N: """))
                 classes = args[0].split(',')
         else:
             classes = self.db.classes
-
-        class colon_separated(csv.excel):
-            delimiter = ':'
+        for classname in classes:
+            self.get_class(classname)
 
         # make sure target dir exists
         if not os.path.exists(dir):
@@ -1200,60 +1347,17 @@ Erase it? Y/N: """))
         max_len = self.db.config.CSV_FIELD_SIZE
 
         # do all the classes specified
-        for classname in classes:
-            cl = self.get_class(classname)
-
-            if not export_files and hasattr(cl, 'export_files'):
-                sys.stdout.write('Exporting %s WITHOUT the files\r\n'%
-                    classname)
-
-            f = open(os.path.join(dir, classname+'.csv'), 'wb')
-            writer = csv.writer(f, colon_separated)
-
-            properties = cl.getprops()
-            propnames = cl.export_propnames()
-            fields = propnames[:]
-            fields.append('is retired')
-            writer.writerow(fields)
-
-            # all nodes for this class
-            for nodeid in cl.getnodeids():
-                if self.verbose:
-                    sys.stdout.write('\rExporting %s - %s'%(classname, nodeid))
-                    sys.stdout.flush()
-                node = cl.getnode(nodeid)
-                exp = cl.export_list(propnames, nodeid)
-                lensum = sum ([len (repr(node[p])) for p in propnames])
-                # for a safe upper bound of field length we add
-                # difference between CSV len and sum of all field lengths
-                d = sum ([len(x) for x in exp]) - lensum
-                assert (d > 0)
-                for p in propnames:
-                    ll = len(repr(node[p])) + d
-                    if ll > max_len:
-                        max_len = ll
-                writer.writerow(exp)
-                if export_files and hasattr(cl, 'export_files'):
-                    cl.export_files(dir, nodeid)
-
-            # close this file
-            f.close()
-
-            # export the journals
-            jf = open(os.path.join(dir, classname+'-journals.csv'), 'wb')
-            if self.verbose:
-                sys.stdout.write("\nExporting Journal for %s\n" % classname)
-                sys.stdout.flush()
-            journals = csv.writer(jf, colon_separated)
-            for row in cl.export_journals():
-                journals.writerow(row)
-            jf.close()
+        for classname, (count, length), seconds in self.run_classes(
+                export_class, classes, options,
+                (dir, export_files, options['batch'])):
+            max_len = max(max_len, length)
+            self.report_rate(_('Exported'), classname, count, seconds)
         if max_len > self.db.config.CSV_FIELD_SIZE:
             print("Warning: config csv_field_size should be at least %s"%max_len, file=sys.stderr)
         return 0
 
     def do_exporttables(self, args):
-        ''"""Usage: exporttables [[-]class[,class]] export_dir
+        ''"""Usage: exporttables [batch=N] [processes=N] [[-]class[,class]] export_dir
         Export the database to colon-separated-value files, excluding the
         files below $TRACKER_HOME/db/files/ (which can be archived separately).
         To include the files, use the export command.
@@ -1268,7 +1372,7 @@ Erase it? Y/N: """))
         return self.do_export(args, export_files=False)
 
     def do_import(self, args):
-        ''"""Usage: import import_dir
+        ''"""Usage: import [batch=N] [processes=N] import_dir
         Import a database from the directory containing CSV files,
         two per class to import.
 
@@ -1286,10 +1390,18 @@ Erase it? Y/N: """))
         The new nodes are added to the existing database - if you want to
         create a new database using the imported data, then create a new
         database (or, tediously, retire all the old data.)
+
+        Items are inserted "batch" (default 100) at a time, with bulk
+        inserts where the backend supports them. If "processes" is more
+        than one, that many processes import classes in parallel, each
+        committing its classes as it finishes them. This is only done
+        for the postgresql and mysql backends: anydbm and sqlite let
+        only one process write to the database at a time.
         """
+        options, args = self.int_options_from_args(args,
+            batch=100, processes=1)
         if len(args) < 1:
             raise UsageError(_('Not enough arguments supplied'))
-        from roundup import hyperdb
 
         if hasattr (csv, 'field_size_limit'):
             csv.field_size_limit(self.db.config.CSV_FIELD_SIZE)
@@ -1297,58 +1409,94 @@ Erase it? Y/N: """))
         # directory to import from
         dir = args[0]
 
-        class colon_separated(csv.excel):
-            delimiter = ':'
-
         # import all the files
+        classes = []
         for file in os.listdir(dir):
             classname, ext = os.path.splitext(file)
             # we only care about CSV files
             if ext != '.csv' or classname.endswith('-journals'):
                 continue
+            self.get_class(classname)
+            classes.append(classname)
 
-            cl = self.get_class(classname)
-
-            # ensure that the properties and the CSV file headings match
-            f = open(os.path.join(dir, file), 'r')
-            reader = csv.reader(f, colon_separated)
-            file_props = None
-            maxid = 1
-            # loop through the file and create a node for each entry
-            for n, r in enumerate(reader):
-                if file_props is None:
-                    file_props = r
-                    continue
-
-                if self.verbose:
-                    sys.stdout.write('\rImporting %s - %s'%(classname, n))
-                    sys.stdout.flush()
-
-                # do the import and figure the current highest nodeid
-                nodeid = cl.import_list(file_props, r)
-                if hasattr(cl, 'import_files'):
-                    cl.import_files(dir, nodeid)
-                maxid = max(maxid, int(nodeid))
-
-            # (print to sys.stdout here to allow tests to squash it .. ugh)
-            print(file=sys.stdout)
+        for classname, count, seconds in self.run_classes(import_class,
+                classes, options, (dir, options['batch'])):
+            self.report_rate(_('Imported'), classname, count, seconds)
 
-            f.close()
-
-            # import the journals
-            f = open(os.path.join(args[0], classname + '-journals.csv'), 'r')
-            reader = csv.reader(f, colon_separated)
-            cl.import_journals(reader)
-            f.close()
+        if options['processes'] <= 1:
+            self.db_uncommitted = True
+        return 0
 
-            # (print to sys.stdout here to allow tests to squash it .. ugh)
-            print('setting', classname, maxid+1, file=sys.stdout)
+    def int_options_from_args(self, args, **defaults):
+        """ Split the name=N options named in defaults from the args.
 
-            # set the id counter
-            self.db.setid(classname, str(maxid+1))
+            Return a dict of the options' values and the other args.
+        """
+        options = defaults.copy()
+        rest = []
+        for arg in args:
+            if '=' not in arg:
+                rest.append(arg)
+                continue
+            name, value = arg.split('=', 1)
+            if name not in defaults:
+                raise UsageError(_('unknown option "%(arg)s"')%locals())
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise UsageError(_('"%(arg)s" is not a number')%locals())
+        if 'batch' in options:
+            options['batch'] = max(options['batch'], 1)
+        return options, rest
+
+    def run_classes(self, function, classes, options, args):
+        """ Call function(db, classname, *args) for each of the classes,
+            yielding the classname, the function's result and the time
+            taken.
+
+            With more than one process in the options, the classes are
+            handed to a pool of processes that open the tracker
+            themselves; our own database is closed meanwhile. The
+            processes option is set to 1 for the backends locking the
+            whole database, where the processes would only wait for
+            each other.
+        """
+        if options['processes'] > 1 and self.db.dbtype in ('anydbm',
+                'sqlite'):
+            print(_('Ignoring processes=%(processes)d: the %(backend)s '
+                'backend lets only one process use the database at a time')%{
+                'processes': options['processes'],
+                'backend': self.db.dbtype}, file=sys.stderr)
+            options['processes'] = 1
+        if options['processes'] <= 1:
+            for classname in classes:
+                start = time.time()
+                result = function(self.db, classname, *args)
+                yield classname, result, time.time() - start
+            return
+
+        import multiprocessing
+        # the workers need the database to themselves, anydbm locks it
+        self.db.commit()
+        self.db.close()
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for result in pool.imap_unordered(run_in_tracker,
+                    [(self.tracker_home, function, classname, args)
+                    for classname in classes]):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+            self.db = roundup.instance.open(self.tracker_home).open('admin')
+            self.db.tx_Source = 'cli'
 
-        self.db_uncommitted = True
-        return 0
+    def report_rate(self, action, classname, count, seconds):
+        """ Report how many items of the class were handled how fast.
+        """
+        rate = count / max(seconds, 0.001)
+        print(_('%(action)s %(count)d %(classname)s items in %(seconds).1f '
+            'seconds (%(rate)d items/second)')%locals(), file=sys.stdout)
 
     def do_pack(self, args):
         ''"""Usage: pack period | date
@@ -1390,14 +1538,28 @@ Erase it? Y/N: """))
         return 0
 
     def do_reindex(self, args, desre=re.compile('([A-Za-z]+)([0-9]+)')):
-        ''"""Usage: reindex [classname|designator]*
+        ''"""Usage: reindex [batch=N] [processes=N] [classname|designator]*
         Re-generate a tracker's search indexes.
 
         This will re-generate the search indexes for a tracker.
         This will typically happen automatically.
+
+        Items are indexed "batch" (default 100) at a time and the
+        work is committed after each batch. If "processes" is more
+        than one, the texts are split into words in that many
+        processes. An interrupted reindex carries on where it
+        stopped when it is run again.
         """
-        if args:
-            for arg in args:
+        options, names = self.int_options_from_args(args,
+            batch=100, processes=1)
+        batch_size = options['batch']
+        processes = options['processes']
+        state_file = os.path.join(self.db.config.DATABASE, 'reindex-state')
+        classnames = [arg for arg in names if not desre.match(arg)]
+        if os.path.exists(state_file) and (classnames or not names):
+            sys.stdout.write(_('Resuming an interrupted reindex\n'))
+        if names:
+            for arg in names:
                 m = desre.match(arg)
                 if m:
                     cl = self.get_class(m.group(1))
@@ -1408,9 +1570,11 @@ Erase it? Y/N: """))
                             'designator': arg})
                 else:
                     cl = self.get_class(arg)
-                    self.db.reindex(arg)
+                    self.db.reindex(arg, batch_size=batch_size,
+                        processes=processes, state_file=state_file)
         else:
-            self.db.reindex(show_progress=True)
+            self.db.reindex(show_progress=True, batch_size=batch_size,
+                processes=processes, state_file=state_file)
         return 0
 
     def do_security(self, args):
@@ -1479,6 +1643,40 @@ Erase it? Y/N: """))
             print(_('No migration action required'))
         return 0
 
+    def do_deliver_mail(self, args):
+        ''"""Usage: deliver_mail [interval]
+        Send the messages waiting in the outgoing mail queue.
+
+        Nosy messages are put into the queue when the "queue" option in
+        the [mail] section of the tracker configuration is set. This
+        command sends the messages that are due over one SMTP connection.
+        Messages that can't be sent are retried on a later run.
+
+        With an interval (in seconds) the command keeps running and
+        delivers the queue every interval seconds.
+        """
+        if len(args) > 1:
+            raise UsageError(_('Too many arguments supplied'))
+        interval = None
+        if args:
+            try:
+                interval = float(args[0])
+            except ValueError:
+                raise UsageError(_('Invalid interval "%(interval)s"')%{
+                    'interval': args[0]})
+        config = self.db.config
+        queue = get_mail_queue(config)
+        mailer = Mailer(config)
+        while True:
+            sent, failed = mailer.deliver_queue(queue,
+                config.MAIL_QUEUE_MAX_ATTEMPTS)
+            if sent or failed:
+                print(_('%(sent)s messages sent, %(failed)s failed')%locals())
+            if interval is None:
+                break
+            time.sleep(interval)
+        return 0
+
     def run_command(self, args):
         """Run a single command
         """
@@ -27,7 +27,7 @@ import os, marshal, re, weakref, string, copy, time, shutil, logging
 from roundup.anypy.dbm_ import anydbm, whichdb
 
 from roundup import hyperdb, date, password, roundupdb, security, support
-from roundup.backends import locking
+from roundup.backends import locking, indexer_common, nodeindex_dbm
 from roundup.i18n import _
 
 from roundup.backends.blobfiles import FileStorage
@@ -177,6 +177,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.newnodes = {}      # keep track of the new nodes by class
         self.destroyednodes = {}# keep track of the destroyed nodes by class
         self.transactions = []
+        self.nodeindexes = {}   # secondary indexes opened for reading
         self.indexer = get_indexer(config, self)
         self.security = security.Security(self)
         os.umask(config.UMASK)
@@ -216,20 +217,18 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             self.Otk = OneTimeKeys(self)
         return self.Otk
 
-    def reindex(self, classname=None, show_progress=False):
+    def reindex(self, classname=None, show_progress=False, batch_size=100,
+            processes=None, state_file=None):
+        """ Re-generate the search indexes of one or all classes.
+
+        See indexer_common.reindex for the other arguments.
+        """
         if classname:
             classes = [self.getclass(classname)]
         else:
             classes = self.classes.values()
-        for klass in classes:
-            if show_progress:
-                for nodeid in support.Progress('Reindex %s'%klass.classname,
-                        klass.list()):
-                    klass.index(nodeid)
-            else:
-                for nodeid in klass.list():
-                    klass.index(nodeid)
-        self.indexer.save_index()
+        indexer_common.reindex(self, classes, show_progress, batch_size,
+            processes, state_file)
 
     def __repr__(self):
         return '<back_anydbm instance at %x>'%id(self)
@@ -282,6 +281,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """Delete all database contents
         """
         logging.getLogger('roundup.hyperdb.backend').info('clear')
+        self.closenodeindexes()
         for cn in self.classes:
             for dummy in 'nodes', 'journals':
                 path = os.path.join(self.dir, 'journals.%s'%cn)
@@ -289,6 +289,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                     os.remove(path)
                 elif os.path.exists(path+'.db'):    # dbm appends .db
                     os.remove(path+'.db')
+            self.removeindexdb(cn)
         # reset id sequences
         path = os.path.join(os.getcwd(), self.dir, '_ids')
         if os.path.exists(path):
@@ -302,6 +303,49 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """
         return self.opendb('nodes.%s'%classname, mode)
 
+    def getindexdb(self, classname, mode='r'):
+        """ grab a connection to the secondary indexes of a class
+        """
+        return self.opendb('indexes.%s'%classname, mode)
+
+    def removeindexdb(self, classname):
+        """ remove the secondary indexes of a class, whatever files the
+            dbm module made for them
+        """
+        path = os.path.join(os.getcwd(), self.dir, 'indexes.%s'%classname)
+        for ext in '', '.db', '.dir', '.dat', '.bak', '.pag':
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+
+    def getnodeindex(self, classname, cldb):
+        """ Return the secondary indexes of a class for searching, or
+            None if the database doesn't keep them.
+
+            Missing or out of date indexes are built from the class db
+            "cldb". The indexes only cover committed nodes.
+        """
+        if not self.config.RDBMS_ANYDBM_INDEXES:
+            return None
+        if classname in self.nodeindexes:
+            return self.nodeindexes[classname]
+        props = nodeindex_dbm.index_props(self.getclass(classname))
+        index = nodeindex_dbm.NodeIndex(self.getindexdb(classname, 'c'),
+            props)
+        if not index.valid():
+            index.db.close()
+            self.removeindexdb(classname)
+            index = nodeindex_dbm.NodeIndex(self.getindexdb(classname, 'c'),
+                props)
+            index.build(cldb)
+            index.flush()
+        self.nodeindexes[classname] = index
+        return index
+
+    def closenodeindexes(self):
+        for index in self.nodeindexes.itervalues():
+            index.db.close()
+        self.nodeindexes = {}
+
     def determine_db_type(self, path):
         """ determine which DB wrote the class file
         """
@@ -612,12 +656,18 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                         j[4][k] = password.JournalPassword(j[4][k])
         return journal
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, decode=True, daterange=None,
+            actions=None, limit=None, offset=None, direction='ascending'):
         """ get the journal for id
 
             Raise IndexError if the node doesn't exist (as per history()'s
             API)
+
+            The params are always decoded, "decode" is ignored. The whole
+            journal is read and the entries asked for are selected from it.
         """
+        select = dict(daterange=daterange, actions=actions, limit=limit,
+            offset=offset, direction=direction)
         # our journal result
         res = []
 
@@ -648,7 +698,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 raise
             if res:
                 # we have unsaved journal entries, return them
-                return self.fix_journal (classname, res)
+                return hyperdb.filter_journal(
+                    self.fix_journal(classname, res), **select)
             raise IndexError('no such %s %s'%(classname, nodeid))
         try:
             journal = marshal.loads(db[nodeid])
@@ -656,14 +707,16 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             db.close()
             if res:
                 # we have some unsaved journal entries, be happy!
-                return self.fix_journal (classname, res)
+                return hyperdb.filter_journal(
+                    self.fix_journal(classname, res), **select)
             raise IndexError('no such %s %s'%(classname, nodeid))
         db.close()
 
         # add all the saved journal entries for this node
         for nodeid, date_stamp, user, action, params in journal:
             res.append((nodeid, date.Date(date_stamp), user, action, params))
-        return self.fix_journal (classname, res)
+        return hyperdb.filter_journal(self.fix_journal(classname, res),
+            **select)
 
     def pack(self, pack_before):
         """ Delete all journal entries except "create" before 'pack_before'.
@@ -716,6 +769,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         # keep a handle to all the database files opened
         self.databases = {}
+        self.indexes = {}
+        self.closenodeindexes()
 
         try:
             # now, do all the transactions
@@ -723,7 +778,12 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             for method, args in self.transactions:
                 reindex[method(*args)] = 1
         finally:
-            # make sure we close all the database files
+            # make sure we close all the database files, writing the
+            # index changes for the nodes that were saved
+            for index in self.indexes.itervalues():
+                if index is not None:
+                    index.close()
+            del self.indexes
             for db in self.databases.itervalues():
                 db.close()
             del self.databases
@@ -761,11 +821,38 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             self.databases[db_name] = self.getclassdb(classname, 'c')
         return self.databases[db_name]
 
+    def getCachedNodeIndex(self, classname):
+        """ get the secondary indexes of a class for commit, None if they
+            aren't kept
+        """
+        if classname not in self.indexes:
+            index = None
+            if self.config.RDBMS_ANYDBM_INDEXES:
+                index = nodeindex_dbm.NodeIndex(self.getindexdb(classname,
+                    'c'), nodeindex_dbm.index_props(self.getclass(classname)))
+                if not index.valid():
+                    # the class db is open for writing, so the indexes
+                    # can't be built now; they will be on the next search
+                    index.db.close()
+                    index = None
+            if index is None:
+                # indexes not kept up to date must go
+                self.removeindexdb(classname)
+            self.indexes[classname] = index
+        return self.indexes[classname]
+
     def doSaveNode(self, classname, nodeid, node):
         db = self.getCachedClassDB(classname)
+        index = self.getCachedNodeIndex(classname)
+        old = None
+        if index is not None and nodeid in db:
+            old = marshal.loads(db[nodeid])
 
         # now save the marshalled data
-        db[nodeid] = marshal.dumps(self.serialise(classname, node))
+        node = self.serialise(classname, node)
+        db[nodeid] = marshal.dumps(node)
+        if index is not None:
+            index.update(nodeid, old, node)
 
         # return the classname, nodeid so we reindex this content
         return (classname, nodeid)
@@ -825,8 +912,12 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
     def doDestroyNode(self, classname, nodeid):
         # delete from the class database
         db = self.getCachedClassDB(classname)
+        index = self.getCachedNodeIndex(classname)
         if nodeid in db:
+            old = marshal.loads(db[nodeid])
             del db[nodeid]
+            if index is not None:
+                index.update(nodeid, old, None)
 
         # delete from the database
         db = self.getCachedJournalDB(classname)
@@ -850,8 +941,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.transactions = []
 
     def close(self):
-        """ Nothing to do
+        """ Release the lock and close the secondary indexes
         """
+        self.closenodeindexes()
         if self.lockfile is not None:
             locking.release_lock(self.lockfile)
             self.lockfile.close()
@@ -1508,7 +1600,6 @@ class Class(hyperdb.Class):
         """Return the name of the key property for this class or None."""
         return self.key
 
-    # TODO: set up a separate index db file for this? profile?
     def lookup(self, keyvalue):
         """Locate a particular node by its key property and return its id.
 
@@ -1522,7 +1613,12 @@ class Class(hyperdb.Class):
                 'class %s'%self.classname)
         cldb = self.db.getclassdb(self.classname)
         try:
-            for nodeid in self.getnodeids(cldb):
+            index = self.db.getnodeindex(self.classname, cldb)
+            if index is not None and isinstance(keyvalue, str):
+                nodeids = self.indexednodeids(index.keyed(keyvalue), cldb)
+            else:
+                nodeids = self.getnodeids(cldb)
+            for nodeid in nodeids:
                 node = self.db.getnode(self.classname, nodeid, cldb)
                 if self.db.RETIRED_FLAG in node:
                     continue
@@ -1562,7 +1658,17 @@ class Class(hyperdb.Class):
         cldb = self.db.getclassdb(self.classname)
         l = []
         try:
-            for id in self.getnodeids(db=cldb):
+            index = self.db.getnodeindex(self.classname, cldb)
+            if index is not None:
+                ids = set()
+                for propname, itemids in propspec.iteritems():
+                    if type(itemids) is not type({}):
+                        itemids = {itemids:1}
+                    ids.update(index.links(propname, itemids))
+                nodeids = self.indexednodeids(ids, cldb)
+            else:
+                nodeids = self.getnodeids(db=cldb)
+            for id in nodeids:
                 item = self.db.getnode(self.classname, id, db=cldb)
                 if self.db.RETIRED_FLAG in item:
                     continue
@@ -1683,6 +1789,34 @@ class Class(hyperdb.Class):
                 db.close()
         return res
 
+    def indexednodeids(self, ids, cldb, retired=None):
+        """ Return the ids of the nodes among "ids", found in the
+            secondary indexes, that still exist, plus the nodes created
+            or changed in this transaction which the indexes don't know
+            about yet.
+
+            "retired" selects retired or non-retired nodes like in
+            getnodeids().
+        """
+        cn = self.classname
+        newnodes = self.db.newnodes.get(cn, {})
+        destroyed = self.db.destroyednodes.get(cn, {})
+        ids = set(ids)
+        ids.update(newnodes)
+        ids.update(self.db.dirtynodes.get(cn, {}))
+        res = []
+        for nodeid in ids:
+            if nodeid in destroyed:
+                continue
+            if nodeid not in newnodes and nodeid not in cldb:
+                continue
+            if retired is False or retired is True:
+                node = self.db.getnode(cn, nodeid, cldb)
+                if retired != (self.db.RETIRED_FLAG in node):
+                    continue
+            res.append(nodeid)
+        return res
+
     def _filter(self, search_matches, filterspec, proptree,
             num_re = re.compile('^\d+$'), retired=False):
         """Return a list of the ids of the nodes in this class that
@@ -1804,8 +1938,48 @@ class Class(hyperdb.Class):
         cldb = self.db.getclassdb(cn)
         t = 0
         try:
-            # TODO: only full-scan once (use items())
-            for nodeid in self.getnodeids(cldb, retired=retired):
+            # narrow the nodes down with the secondary indexes, if kept
+            ids = None
+            index = self.db.getnodeindex(cn, cldb)
+            for t, k, v in filterspec:
+                if index is None:
+                    break
+                if k == 'id':
+                    s = set(v)
+                elif t == LINK:
+                    s = index.links(k, v)
+                elif t == MULTILINK:
+                    if not v:
+                        s = index.links(k, [None])
+                    else:
+                        try:
+                            opcodes = [int(x) for x in v]
+                        except ValueError:
+                            opcodes = []
+                        if opcodes and min(opcodes) < -1:
+                            # an expression, see Expression
+                            continue
+                        s = index.links(k, [x for x in v if x != '-1'])
+                elif t == DATE:
+                    # compare up to the minute, the filter below is exact
+                    low = high = None
+                    if v.from_value is not None:
+                        low = v.from_value.serialise()[:12]
+                    if v.to_value is not None:
+                        high = v.to_value.serialise()[:12] + '~'
+                    s = index.dates(k, low, high)
+                else:
+                    continue
+                if ids is None:
+                    ids = s
+                else:
+                    ids &= s
+            if ids is None:
+                nodeids = self.getnodeids(cldb, retired=retired)
+            else:
+                nodeids = self.indexednodeids(ids, cldb, retired)
+
+            for nodeid in nodeids:
                 node = self.db.getnode(cn, nodeid, cldb)
                 # apply filter
                 for t, k, v in filterspec:
@@ -2000,6 +2174,14 @@ class Class(hyperdb.Class):
 
     def index(self, nodeid):
         """ Add (or refresh) the node to search indexes """
+        for identifier, text, mime_type in self.index_entries(nodeid):
+            self.db.indexer.add_text(identifier, text, mime_type)
+
+    def index_entries(self, nodeid):
+        """ Return the (identifier, text, mime_type) entries to put in the
+            search indexes for the node
+        """
+        entries = []
         # find all the String properties that have indexme
         for prop, propclass in self.getprops().iteritems():
             if isinstance(propclass, hyperdb.String) and propclass.indexme:
@@ -2009,7 +2191,9 @@ class Class(hyperdb.Class):
                 except IndexError:
                     # node has been destroyed
                     continue
-                self.db.indexer.add_text((self.classname, nodeid, prop), value)
+                entries.append(((self.classname, nodeid, prop), value,
+                    'text/plain'))
+        return entries
 
     #
     # import / export support
@@ -2232,17 +2416,19 @@ class FileClass(hyperdb.FileClass, Class):
         self.fireReactors('set', itemid, oldvalues)
         return propvalues
 
-    def index(self, nodeid):
-        """ Add (or refresh) the node to search indexes.
+    def index_entries(self, nodeid):
+        """ Return the (identifier, text, mime_type) entries to put in the
+            search indexes for the node.
 
         Use the content-type property for the content property.
         """
+        entries = []
         # find all the String properties that have indexme
         for prop, propclass in self.getprops().iteritems():
             if prop == 'content' and propclass.indexme:
                 mime_type = self.get(nodeid, 'type', self.default_mime_type)
-                self.db.indexer.add_text((self.classname, nodeid, 'content'),
-                    str(self.get(nodeid, 'content')), mime_type)
+                entries.append(((self.classname, nodeid, 'content'),
+                    str(self.get(nodeid, 'content')), mime_type))
             elif isinstance(propclass, hyperdb.String) and propclass.indexme:
                 # index them under (classname, nodeid, property)
                 try:
@@ -2250,7 +2436,9 @@ class FileClass(hyperdb.FileClass, Class):
                 except IndexError:
                     # node has been destroyed
                     continue
-                self.db.indexer.add_text((self.classname, nodeid, prop), value)
+                entries.append(((self.classname, nodeid, prop), value,
+                    'text/plain'))
+        return entries
 
 # deviation from spec - was called ItemClass
 class IssueClass(Class, roundupdb.IssueClass):
@@ -58,6 +58,7 @@ def connection_dict(config, dbnamestr=None):
 
 def db_nuke(config):
     """Clear all database contents and drop database itself"""
+    rdbms_common.clear_connection_pools()
     if db_exists(config):
         kwargs = connection_dict(config)
         conn = MySQLdb.connect(**kwargs)
@@ -126,6 +127,12 @@ class Database(rdbms_common.Database):
     # used by some code to switch styles of query
     implements_intersect = 0
 
+    supports_connection_pool = True
+
+    # mysql needs a LIMIT with OFFSET, this is the documented way of
+    # saying "all rows"
+    sql_no_limit = '18446744073709551615'
+
     # Backend for MySQL to use.
     # InnoDB is faster, but if you're running <4.0.16 then you'll need to
     # use BDB to pass all unit tests.
@@ -172,10 +179,11 @@ class Database(rdbms_common.Database):
 
     def open_connection(self):
         # make sure the database actually exists
-        if not db_exists(self.config):
+        if not self.sql_have_pooled_connection() and \
+                not db_exists(self.config):
             db_create(self.config)
 
-        self.conn, self.cursor = self.sql_open_connection()
+        self.conn, self.cursor = self.sql_get_connection()
 
         try:
             self.load_dbschema()
@@ -192,6 +200,7 @@ class Database(rdbms_common.Database):
                 num INTEGER) ENGINE=%s'''%self.mysql_backend)
             self.sql('create index ids_name_idx on ids(name)')
             self.create_version_2_tables()
+            self.create_terms_table()
 
     def load_dbschema(self):
         ''' Load the schema definition that the database currently implements
@@ -237,6 +246,12 @@ class Database(rdbms_common.Database):
         sql = 'insert into ids (name, num) values (%s,%s)'%(self.arg, self.arg)
         self.sql(sql, ('__textids', 1))
 
+    def create_terms_table(self):
+        self.sql('''CREATE TABLE __terms (_word VARCHAR(30), _textid INT,
+            _freq INT, _positions TEXT) ENGINE=%s'''%self.mysql_backend)
+        self.sql('CREATE INDEX terms_word_idx ON __terms(_word, _textid)')
+        self.sql('CREATE INDEX terms_by_id ON __terms(_textid)')
+
     def add_new_columns_v2(self):
         '''While we're adding the actor column, we need to update the
         tables to have the correct datatypes.'''
@@ -601,6 +616,12 @@ class MysqlClass:
         s = ','.join([x[0] for x in self.db.sql_fetchall()])
         return '_%s.id not in (%s)'%(classname, s)
 
+    # No _sort_concat: group_concat truncates to group_concat_max_len
+    # and ORDER BY only compares the first max_sort_length bytes (both
+    # 1024 by default), which keeps only about 50 dates. Raising
+    # max_sort_length makes every sort key that long on MySQL 5, so
+    # sorting by a Multilink property is finished in Python.
+
     def create_inner(self, **propvalues):
         try:
             return rdbms_common.Class.create_inner(self, **propvalues)
@@ -23,6 +23,7 @@ from psycopg2.psycopg1 import ProgrammingError
 from psycopg2.extensions import TransactionRollbackError
 
 import logging
+from cStringIO import StringIO
 
 from roundup import hyperdb, date
 from roundup.backends import rdbms_common
@@ -54,6 +55,7 @@ def db_create(config):
 
 def db_nuke(config):
     """Clear all database contents and drop database itself"""
+    rdbms_common.clear_connection_pools()
     command = 'DROP DATABASE "%s"'% config.RDBMS_NAME
     logging.getLogger('roundup.hyperdb').info(command)
     db_command(config, command)
@@ -121,6 +123,16 @@ def db_exists(config):
     except:
         return 0
 
+def copy_escape(value):
+    """ Format value for the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
 class Sessions(sessions_rdbms.Sessions):
     def set(self, *args, **kwargs):
         try:
@@ -151,6 +163,21 @@ class Database(rdbms_common.Database):
     # used by some code to switch styles of query
     implements_intersect = 1
 
+    supports_connection_pool = True
+
+    def sql_bulk_insert(self, table, columns, rows):
+        """ Insert the rows into table using COPY.
+        """
+        if not rows:
+            return
+        self.log_debug('COPY %s %r (%d rows)'%(table, columns, len(rows)))
+        data = StringIO()
+        for values in rows:
+            data.write('\t'.join([copy_escape(v) for v in values]))
+            data.write('\n')
+        data.seek(0)
+        self.cursor.copy_from(data, table, columns=columns)
+
     def sql_open_connection(self):
         db = connection_dict(self.config, 'database')
         logging.getLogger('roundup.hyperdb').info(
@@ -168,10 +195,11 @@ class Database(rdbms_common.Database):
         return (conn, cursor)
 
     def open_connection(self):
-        if not db_exists(self.config):
+        if not self.sql_have_pooled_connection() and \
+                not db_exists(self.config):
             db_create(self.config)
 
-        self.conn, self.cursor = self.sql_open_connection()
+        self.conn, self.cursor = self.sql_get_connection()
 
         try:
             self.load_dbschema()
@@ -184,6 +212,7 @@ class Database(rdbms_common.Database):
             self.sql("CREATE TABLE dual (dummy integer)")
             self.sql("insert into dual values (1)")
             self.create_version_2_tables()
+            self.create_terms_table()
             # Need to commit here, otherwise otk/session will not find
             # the necessary tables (in a parallel connection!)
             self.commit()
@@ -290,6 +319,12 @@ class PostgresqlClass:
     order_by_null_values = '(%s is not NULL)'
     case_insensitive_like = 'ILIKE'
 
+    def _sort_concat(self, value, frum, where, desc):
+        # Locale collations ignore chr(1), compare bytes like Python
+        return '(select string_agg(%s, chr(1) order by %s collate "C"%s) '\
+            'from %s where %s) collate "C"'%(value, value,
+            ['', ' desc'][desc], frum, where)
+
 class Class(PostgresqlClass, rdbms_common.Class):
     pass
 class IssueClass(PostgresqlClass, rdbms_common.IssueClass):
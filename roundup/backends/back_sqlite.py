@@ -53,6 +53,9 @@ class Database(rdbms_common.Database):
 
     dbtype = "sqlite"
 
+    # sqlite needs a LIMIT with OFFSET
+    sql_no_limit = '-1'
+
     # used by some code to switch styles of query
     implements_intersect = 1
 
@@ -170,6 +173,7 @@ class Database(rdbms_common.Database):
             self.sql('create table ids (name varchar, num integer)')
             self.sql('create index ids_name_idx on ids(name)')
             self.create_version_2_tables()
+            self.create_terms_table()
 
     def create_version_2_tables(self):
         self.sql('create table otks (otk_key varchar, '
@@ -444,22 +448,29 @@ class Database(rdbms_common.Database):
         self.sql(sql, vals)
 
     if sqlite_version in (2,3):
-        def load_journal(self, classname, cols, nodeid):
+        def load_journal(self, classname, cols, nodeid, **kw):
             """We need to turn the sqlite3.Row into a tuple so it can be
             unpacked"""
             l = rdbms_common.Database.load_journal(self,
-                classname, cols, nodeid)
+                classname, cols, nodeid, **kw)
             cols = range(5)
             return [[row[col] for col in cols] for row in l]
 
 class sqliteClass:
     def filter(self, search_matches, filterspec, sort=(None,None),
-            group=(None,None), retired=False):
+            group=(None,None), retired=False, limit=None, offset=None):
         """ If there's NO matches to a fetch, sqlite returns NULL
             instead of nothing
         """
         return [f for f in rdbms_common.Class.filter(self, search_matches,
-            filterspec, sort=sort, group=group, retired=retired) if f]
+            filterspec, sort=sort, group=group, retired=retired, limit=limit,
+            offset=offset) if f]
+
+    def _sort_concat(self, value, frum, where, desc):
+        # group_concat only keeps the order of a sorted subselect
+        return '(select group_concat(_v, char(1)) from (select %s as _v '\
+            'from %s where %s order by _v%s))'%(value, frum, where,
+            ['', ' desc'][desc])
 
 class Class(sqliteClass, rdbms_common.Class):
     pass
@@ -1,6 +1,6 @@
-import re
+import os, re, json
 
-from roundup import hyperdb
+from roundup import hyperdb, support
 
 STOPWORDS = [
     "A", "AND", "ARE", "AS", "AT", "BE", "BUT", "BY",
@@ -27,9 +27,34 @@ class Indexer:
     def is_stopword(self, word):
         return word in self.stopwords
 
+    def add_texts(self, entries, pool=None):
+        """Index a batch of (identifier, text, mime_type) entries.
+
+        Indexers that can do better than adding the texts one at a time
+        override this; "pool" is a multiprocessing pool they may use.
+        """
+        for identifier, text, mime_type in entries:
+            self.add_text(identifier, text, mime_type)
+
     def getHits(self, search_terms, klass):
         return self.find(search_terms)
 
+    def query(self, text, klass, limit=None, ignore={}):
+        """Return [(itemid, score)] of the items of "klass" matching the
+        query text, best first, at most "limit" of them.
+
+        This default implementation looks for items with all the words
+        of the text and gives them all the same score; indexers that can
+        rank their results override it.
+        """
+        if not isinstance(text, unicode):
+            text = unicode(text, "utf-8", "replace")
+        words = [w.upper().encode("utf-8", "replace")
+            for w in re.findall(r'(?u)\b\w{%d,%d}\b'%(self.minlength,
+            self.maxlength), text)]
+        hits = self.search(words, klass, ignore)
+        return [(itemid, 0) for itemid in sorted(hits, key=int)[:limit]]
+
     def search(self, search_terms, klass, ignore={}):
         """Display search results looking for [search, terms] associated
         with the hyperdb Class "klass". Ignore hits on {class: property}.
@@ -107,6 +132,66 @@ class Indexer:
                             node_dict[linkprop].append(nodeid)
         return nodeids
 
+def reindex(db, classes, show_progress=False, batch_size=100,
+        processes=None, state_file=None):
+    """Re-generate the index entries of all items of the given classes.
+
+    The texts of "batch_size" items at a time are handed to the indexer's
+    add_texts(). If "processes" is more than one, a multiprocessing pool
+    of that size is used to split the texts into words.
+
+    If "state_file" is given, the database is committed after every batch
+    and the last item indexed is recorded in the file, so an interrupted
+    reindex carries on where it stopped when run again with the same
+    file. The file is removed once all classes are done.
+    """
+    state = {}
+    if state_file and os.path.exists(state_file):
+        state = json.load(open(state_file))
+    pool = None
+    if processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+    try:
+        for klass in classes:
+            cn = klass.classname
+            nodeids = sorted(klass.list(), key=int)
+            if cn in state:
+                nodeids = [nodeid for nodeid in nodeids
+                    if int(nodeid) > int(state[cn])]
+            if show_progress:
+                nodeids = support.Progress('Reindex %s'%cn, nodeids)
+            entries = []
+            for n, nodeid in enumerate(nodeids):
+                entries.extend(klass.index_entries(nodeid))
+                if (n + 1) % batch_size == 0:
+                    db.indexer.add_texts(entries, pool)
+                    entries = []
+                    if state_file:
+                        state[cn] = nodeid
+                        save_reindex_state(db, state_file, state)
+            db.indexer.add_texts(entries, pool)
+            if state_file and entries:
+                state[cn] = nodeid
+                save_reindex_state(db, state_file, state)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    db.indexer.save_index()
+    if state_file and os.path.exists(state_file):
+        os.remove(state_file)
+
+def save_reindex_state(db, state_file, state):
+    """Commit what has been indexed so far and record it in state_file.
+    """
+    db.commit()
+    tmp = state_file + '.tmp'
+    f = open(tmp, 'w')
+    json.dump(state, f)
+    f.close()
+    os.rename(tmp, state_file)
+
 def get_indexer(config, db):
     indexer_name = getattr(config, "INDEXER", "")
     if not indexer_name:
@@ -133,6 +218,11 @@ def get_indexer(config, db):
         from indexer_whoosh import Indexer
         return Indexer(db)
 
+    if indexer_name == "ranked":
+        if db.dbtype in ("sqlite", "postgres", "mysql"):
+            from roundup.backends.indexer_ranked import Indexer
+            return Indexer(db)
+
     if indexer_name == "native":
         # load proper native indexing based on database type
         if db.dbtype == "anydbm":
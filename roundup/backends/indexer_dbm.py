@@ -17,29 +17,55 @@
 '''This module provides an indexer class, RoundupIndexer, that stores text
 indices in a roundup instance.  This class makes searching the content of
 messages, string properties and text files possible.
+
+The index is kept in the "indexes" directory of the tracker database as a
+base generation and an append-only log of the changes made since::
+
+    current          number of the current generation
+    index-N.files    zlib compressed marshal of the files and fileids
+    index-N.words    zlib compressed marshal of {word: (offset, length)}
+    index-N.post     the posting lists, each a zlib compressed marshal of
+                     {fileid: count}, read through a memory map
+    index-N.log      records of the changes made since generation N was
+                     written, each a 4 byte length and a zlib compressed
+                     marshal of the change
+
+Saving the index appends a record to the log, so its cost is
+proportional to the text added. When the log grows large compared to the
+posting lists, they are merged into a new generation in a background
+thread.
 '''
 __docformat__ = 'restructuredtext'
 
-import os, shutil, re, mimetypes, marshal, zlib, errno
+import os, shutil, re, mimetypes, marshal, zlib, errno, mmap, struct
+import threading
 from roundup.hyperdb import Link, Multilink
+from roundup.backends import locking
 from roundup.backends.indexer_common import Indexer as IndexerBase
 
 class Indexer(IndexerBase):
     '''Indexes information from roundup's hyperdb to allow efficient
     searching.
 
-    Three structures are created by the indexer::
+    Three structures are kept by the indexer::
 
           files   {identifier: (fileid, wordcount)}
           words   {word: {fileid: count}}
           fileids {fileid: identifier}
 
-    where identifier is (classname, nodeid, propertyname)
+    where identifier is (classname, nodeid, propertyname). The words
+    only hold the postings changed since the base generation was
+    written; the base postings are read from disk when needed. A posting
+    for a fileid that is no longer in fileids is stale and ignored.
     '''
+    # merge the log into a new generation once it is this large, and
+    # larger than merge_ratio times the posting lists
+    merge_size = 1 << 20
+    merge_ratio = 0.25
+
     def __init__(self, db):
         IndexerBase.__init__(self, db)
         self.indexdb_path = os.path.join(db.config.DATABASE, 'indexes')
-        self.indexdb = os.path.join(self.indexdb_path, 'index.db')
         self.reindex = 0
         self.quiet = 9
         self.changed = 0
@@ -53,7 +79,7 @@ class Indexer(IndexerBase):
         elif os.path.exists(version):
             version = open(version).read()
             # check the value and reindex if it's not the latest
-            if version.strip() != '1':
+            if version.strip() != '2':
                 self.force_reindex()
 
     def force_reindex(self):
@@ -63,7 +89,7 @@ class Indexer(IndexerBase):
             shutil.rmtree(self.indexdb_path)
         os.makedirs(self.indexdb_path)
         os.chmod(self.indexdb_path, 0775)
-        open(os.path.join(self.indexdb_path, 'version'), 'w').write('1\n')
+        open(os.path.join(self.indexdb_path, 'version'), 'w').write('2\n')
         self.reindex = 1
         self.changed = 1
 
@@ -92,6 +118,8 @@ class Indexer(IndexerBase):
         file_index = abs(self.files['_TOP'][0])
         self.files[identifier] = (file_index, len(words))
         self.fileids[file_index] = identifier
+        self.pending_files['_TOP'] = self.files['_TOP']
+        self.pending_files[identifier] = self.files[identifier]
 
         # find the unique words
         filedict = {}
@@ -106,15 +134,9 @@ class Indexer(IndexerBase):
         # now add to the totals
         for word in filedict:
             # each word has a dict of {identifier: count}
-            if word in self.words:
-                entry = self.words[word]
-            else:
-                # new word
-                entry = {}
-                self.words[word] = entry
-
-            # make a reference to the file for this word
-            entry[file_index] = filedict[word]
+            self.words.setdefault(word, {})[file_index] = filedict[word]
+            self.pending_words.setdefault(word, {})[file_index] = \
+                filedict[word]
 
         # save needed
         self.changed = 1
@@ -138,15 +160,27 @@ class Indexer(IndexerBase):
         return re.findall(r'\b\w{%d,%d}\b' % (self.minlength, self.maxlength),
                           text)
 
+    def get_postings(self, word):
+        '''Return {fileid: count} for the word.
+        '''
+        entry = {}
+        if word in self.offsets:
+            offset, length = self.offsets[word]
+            entry = marshal.loads(zlib.decompress(
+                self.postings[offset:offset+length]))
+        if word in self.words:
+            entry.update(self.words[word])
+        for fileid in list(entry):
+            if fileid not in self.fileids:
+                del entry[fileid]
+        return entry
+
     # we override this to ignore too short and too long words
     # and also to fix a bug - the (fail) case.
     def find(self, wordlist):
         '''Locate files that match ALL the words in wordlist
         '''
-        if not hasattr(self, 'words'):
-            self.load_index()
-        self.load_index(wordlist=wordlist)
-        entries = {}
+        self.load_index()
         hits = None
         for word in wordlist:
             if not self.minlength <= len(word) <= self.maxlength:
@@ -155,15 +189,12 @@ class Indexer(IndexerBase):
             word = word.upper()
             if self.is_stopword(word):
                 continue
-            entry = self.words.get(word)    # For each word, get index
-            entries[word] = entry           #   of matching files
+            entry = self.get_postings(word) # For each word, get index
             if not entry:                   # Nothing for this one word (fail)
                 return {}
             if hits is None:
                 hits = {}
                 for k in entry:
-                    if k not in self.fileids:
-                        raise ValueError('Index is corrupted: re-generate it')
                     hits[k] = self.fileids[k]
             else:
                 # Eliminate hits for every non-match
@@ -174,48 +205,26 @@ class Indexer(IndexerBase):
             return {}
         return list(hits.values())
 
-    segments = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ#_-!"
+    def path(self, generation, kind):
+        return os.path.join(self.indexdb_path, 'index-%d.%s'%(generation,
+            kind))
+
     def load_index(self, reload=0, wordlist=None):
         # Unless reload is indicated, do not load twice
         if self.index_loaded() and not reload:
             return 0
 
-        # Ok, now let's actually load it
-        db = {'WORDS': {}, 'FILES': {'_TOP':(0,None)}, 'FILEIDS': {}}
-
-        # Identify the relevant word-dictionary segments
-        if not wordlist:
-            segments = self.segments
-        else:
-            segments = ['-','#']
-            for word in wordlist:
-                segments.append(word[0].upper())
-
-        # Load the segments
-        for segment in segments:
-            try:
-                f = open(self.indexdb + segment, 'rb')
-            except IOError as error:
-                # probably just nonexistent segment index file
-                if error.errno != errno.ENOENT: raise
-            else:
-                pickle_str = zlib.decompress(f.read())
-                f.close()
-                dbslice = marshal.loads(pickle_str)
-                if dbslice.get('WORDS'):
-                    # if it has some words, add them
-                    for word, entry in dbslice['WORDS'].iteritems():
-                        db['WORDS'][word] = entry
-                if dbslice.get('FILES'):
-                    # if it has some files, add them
-                    db['FILES'] = dbslice['FILES']
-                if dbslice.get('FILEIDS'):
-                    # if it has fileids, add them
-                    db['FILEIDS'] = dbslice['FILEIDS']
-
-        self.words = db['WORDS']
-        self.files = db['FILES']
-        self.fileids = db['FILEIDS']
+        state = load_generation(self.indexdb_path)
+        self.generation = state['generation']
+        self.files = state['files']
+        self.fileids = state['fileids']
+        self.offsets = state['offsets']
+        self.postings = state['postings']
+        self.words = state['words']
+        self.log_size = state['log_size']
+        self.post_size = state['post_size']
+        self.pending_files = {}
+        self.pending_words = {}
         self.changed = 0
 
     def save_index(self):
@@ -223,39 +232,43 @@ class Indexer(IndexerBase):
         if not self.index_loaded() or not self.changed:
             return
 
-        # brutal space saver... delete all the small segments
-        for segment in self.segments:
-            try:
-                os.remove(self.indexdb + segment)
-            except OSError as error:
-                # probably just nonexistent segment index file
-                if error.errno != errno.ENOENT: raise
-
-        # First write the much simpler filename/fileid dictionaries
-        dbfil = {'WORDS':None, 'FILES':self.files, 'FILEIDS':self.fileids}
-        open(self.indexdb+'-','wb').write(zlib.compress(marshal.dumps(dbfil)))
-
-        # The hard part is splitting the word dictionary up, of course
-        letters = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ#_"
-        segdicts = {}                           # Need batch of empty dicts
-        for segment in letters:
-            segdicts[segment] = {}
-        for word, entry in self.words.iteritems():  # Split into segment dicts
-            initchar = word[0].upper()
-            segdicts[initchar][word] = entry
-
-        # save
-        for initchar in letters:
-            db = {'WORDS':segdicts[initchar], 'FILES':None, 'FILEIDS':None}
-            pickle_str = marshal.dumps(db)
-            filename = self.indexdb + initchar
-            pickle_fh = open(filename, 'wb')
-            pickle_fh.write(zlib.compress(pickle_str))
-            os.chmod(filename, 0664)
+        record = zlib.compress(marshal.dumps({'FILES': self.pending_files,
+            'WORDS': self.pending_words}))
+        lock = locking.acquire_lock(os.path.join(self.indexdb_path, 'lock'))
+        try:
+            # append to the log of the generation that is current now; a
+            # merge may have started a new one since the index was loaded
+            generation = current_generation(self.indexdb_path)
+            log = open(self.path(generation, 'log'), 'ab')
+            log.write(struct.pack('>I', len(record)) + record)
+            log.close()
+            self.log_size = os.path.getsize(self.path(generation, 'log'))
+            if generation != self.generation:
+                self.post_size = os.path.getsize(self.path(generation,
+                    'post'))
+        finally:
+            locking.release_lock(lock)
+            lock.close()
+
+        self.pending_files = {}
+        self.pending_words = {}
 
         # save done
         self.changed = 0
 
+        if (self.log_size > self.merge_size and
+                self.log_size > self.post_size * self.merge_ratio):
+            t = threading.Thread(target=merge_generation,
+                args=(self.indexdb_path,))
+            t.start()
+
+    def merge_index(self):
+        '''Merge the log into a new generation of the index now.
+        '''
+        self.save_index()
+        merge_generation(self.indexdb_path)
+        self.load_index(reload=1)
+
     def purge_entry(self, identifier):
         '''Remove a file from file index and word index
         '''
@@ -267,11 +280,10 @@ class Indexer(IndexerBase):
         file_index = self.files[identifier][0]
         del self.files[identifier]
         del self.fileids[file_index]
+        self.pending_files[identifier] = None
 
-        # The much harder part, cleanup the word index
-        for key, occurs in self.words.iteritems():
-            if file_index in occurs:
-                del occurs[file_index]
+        # the postings of the file are now stale, and are dropped by the
+        # next merge
 
         # save needed
         self.changed = 1
@@ -287,5 +299,173 @@ class Indexer(IndexerBase):
     def close(self):
         pass
 
+def current_generation(dirname):
+    '''Return the number of the current generation of the index.
+    '''
+    try:
+        return int(open(os.path.join(dirname, 'current')).read())
+    except IOError as error:
+        if error.errno != errno.ENOENT: raise
+        return 0
+
+def read_file(filename, default):
+    '''Return the unmarshalled contents of a compressed index file.
+    '''
+    try:
+        f = open(filename, 'rb')
+    except IOError as error:
+        if error.errno != errno.ENOENT: raise
+        return default
+    try:
+        return marshal.loads(zlib.decompress(f.read()))
+    finally:
+        f.close()
+
+def replay_log(filename, files, fileids, words, size=None):
+    '''Apply the records in the log to files, fileids and words, reading
+    at most size bytes of it. Return the size of the complete records.
+    '''
+    try:
+        f = open(filename, 'rb')
+    except IOError as error:
+        if error.errno != errno.ENOENT: raise
+        return 0
+    done = 0
+    try:
+        data = f.read(size) if size is not None else f.read()
+    finally:
+        f.close()
+    while done + 4 <= len(data):
+        length = struct.unpack('>I', data[done:done+4])[0]
+        if done + 4 + length > len(data):
+            # incomplete record of an interrupted write
+            break
+        record = marshal.loads(zlib.decompress(data[done+4:done+4+length]))
+        done += 4 + length
+        for identifier, entry in record['FILES'].iteritems():
+            if identifier != '_TOP' and identifier in files:
+                del fileids[files[identifier][0]]
+                del files[identifier]
+            if entry is not None:
+                files[identifier] = entry
+                if identifier != '_TOP':
+                    fileids[entry[0]] = identifier
+        for word, entry in record['WORDS'].iteritems():
+            words.setdefault(word, {}).update(entry)
+    return done
+
+def load_generation(dirname, log_size=None):
+    '''Load the current generation of the index and replay its log.
+    '''
+    generation = current_generation(dirname)
+    path = lambda kind: os.path.join(dirname, 'index-%d.%s'%(generation,
+        kind))
+    files = read_file(path('files'), {'FILES': {'_TOP': (0, None)},
+        'FILEIDS': {}})
+    offsets = read_file(path('words'), {})
+    postings = ''
+    post_size = 0
+    if os.path.exists(path('post')):
+        post_size = os.path.getsize(path('post'))
+    if post_size:
+        f = open(path('post'), 'rb')
+        try:
+            postings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+    state = {'generation': generation, 'files': files['FILES'],
+        'fileids': files['FILEIDS'], 'offsets': offsets,
+        'postings': postings, 'words': {}, 'post_size': post_size}
+    state['log_size'] = replay_log(path('log'), state['files'],
+        state['fileids'], state['words'], log_size)
+    return state
+
+merge_lock = threading.Lock()
+
+def merge_generation(dirname):
+    '''Write a new generation of the index with the postings of the
+    current one and the changes in its log.
+    '''
+    # one merge at a time in this process
+    if not merge_lock.acquire(False):
+        return
+    try:
+        lockname = os.path.join(dirname, 'lock')
+        lock = locking.acquire_lock(lockname)
+        try:
+            generation = current_generation(dirname)
+            log = os.path.join(dirname, 'index-%d.log'%generation)
+            log_size = 0
+            if os.path.exists(log):
+                log_size = os.path.getsize(log)
+        finally:
+            locking.release_lock(lock)
+            lock.close()
+
+        # the log may grow while we work; we merge what it held when we
+        # started and carry over the rest below
+        state = load_generation(dirname, log_size)
+        new = generation + 1
+        path = lambda kind: os.path.join(dirname, 'index-%d.%s'%(new, kind))
+        fileids = state['fileids']
+        offsets = {}
+        post = open(path('post'), 'wb')
+        position = 0
+        words = set(state['offsets']) | set(state['words'])
+        for word in sorted(words):
+            entry = {}
+            if word in state['offsets']:
+                offset, length = state['offsets'][word]
+                entry = marshal.loads(zlib.decompress(
+                    state['postings'][offset:offset+length]))
+            entry.update(state['words'].get(word, {}))
+            for fileid in list(entry):
+                if fileid not in fileids:
+                    del entry[fileid]
+            if not entry:
+                continue
+            data = zlib.compress(marshal.dumps(entry))
+            post.write(data)
+            offsets[word] = (position, len(data))
+            position += len(data)
+        post.close()
+        if state['postings']:
+            state['postings'].close()
+        open(path('words'), 'wb').write(zlib.compress(marshal.dumps(offsets)))
+        open(path('files'), 'wb').write(zlib.compress(marshal.dumps({
+            'FILES': state['files'], 'FILEIDS': fileids})))
+
+        lock = locking.acquire_lock(lockname)
+        try:
+            # carry over what was logged while we were merging
+            tail = ''
+            if os.path.exists(log):
+                f = open(log, 'rb')
+                f.seek(state['log_size'])
+                tail = f.read()
+                f.close()
+            open(path('log'), 'wb').write(tail)
+            for kind in 'files', 'words', 'post', 'log':
+                os.chmod(path(kind), 0664)
+
+            current = os.path.join(dirname, 'current')
+            open(current + '.tmp', 'w').write('%d\n'%new)
+            if os.name == 'nt' and os.path.exists(current):
+                os.remove(current)
+            os.rename(current + '.tmp', current)
+        finally:
+            locking.release_lock(lock)
+            lock.close()
+
+        # keep the previous generation for readers that still use it
+        for name in os.listdir(dirname):
+            m = re.match(r'index-(\d+)\.', name)
+            if m and int(m.group(1)) < generation:
+                try:
+                    os.remove(os.path.join(dirname, name))
+                except OSError:
+                    pass
+    finally:
+        merge_lock.release()
 
 # vim: set filetype=python ts=4 sw=4 et si
@@ -0,0 +1,258 @@
+""" This implements a ranked full-text indexer over RDBMS tables.
+
+For every word of a text the __terms table holds one posting: the word,
+the text's id in __textids, the number of times the word occurs and the
+word's positions in the text. A query fetches the postings of all its
+words in one statement and works out matches, phrases and scores from
+them, so it supports::
+
+    bug fix             texts with both words
+    bug OR crash        texts with either word
+    "memory leak"       texts with the words next to each other
+
+A text's score is the sum, over the query words, of the word's inverse
+document frequency weighted by how often the word occurs in the text.
+Results are mapped to the items of the searched class with one query per
+Link or Multilink property, and query() can return only the best
+matches.
+"""
+import re, math
+
+from roundup import hyperdb
+from roundup.backends import indexer_rdbms
+
+def text_terms(args):
+    """ Return {word: [position, ...]} for (text, minlength, maxlength,
+        stopwords).
+
+        Positions count all words of the text, so that the words of a
+        phrase query are found next to each other even if stopwords or
+        very short words are left out of the index.
+    """
+    text, minlength, maxlength, stopwords = args
+    if not isinstance(text, unicode):
+        text = unicode(text, "utf-8", "replace")
+    terms = {}
+    for position, w in enumerate(re.findall(r'(?u)\w+', text.upper())):
+        if not minlength <= len(w) <= maxlength:
+            continue
+        word = w.encode("utf-8")
+        if word not in stopwords:
+            terms.setdefault(word, []).append(position)
+    return terms
+
+def encode_positions(positions):
+    """ Encode ascending positions as comma separated differences. """
+    last = 0
+    l = []
+    for position in positions:
+        l.append(str(position - last))
+        last = position
+    return ','.join(l)
+
+def decode_positions(data):
+    """ Decode the positions written by encode_positions(). """
+    positions = []
+    last = 0
+    for delta in data.split(','):
+        last += int(delta)
+        positions.append(last)
+    return positions
+
+class Indexer(indexer_rdbms.Indexer):
+    # how fast a word's weight saturates with its number of occurrences
+    k1 = 1.2
+
+    def add_text(self, identifier, text, mime_type='text/plain'):
+        """ "identifier" is  (classname, itemid, property) """
+        self.add_texts([(identifier, text, mime_type)])
+
+    def add_texts(self, entries, pool=None):
+        """ Index a batch of (identifier, text, mime_type) entries.
+        """
+        entries = [(tuple(map(str, identifier)), text)
+            for identifier, text, mime_type in entries
+            if mime_type == 'text/plain']
+        if not entries:
+            return
+        args = [(text, self.minlength, self.maxlength, self.stopwords)
+            for identifier, text in entries]
+        if pool is None:
+            termsets = map(text_terms, args)
+        else:
+            termsets = pool.map(text_terms, args)
+
+        textids = self.get_textids([identifier
+            for identifier, text in entries], '__terms')
+        rows = []
+        for (identifier, text), terms in zip(entries, termsets):
+            id = textids[identifier]
+            for word, positions in terms.iteritems():
+                rows.append((word, id, len(positions),
+                    encode_positions(positions)))
+        self.db.sql_bulk_insert('__terms', ('_word', '_textid', '_freq',
+            '_positions'), rows)
+
+    def parse_query(self, text):
+        """ Split the query text into a list of alternatives, each a list
+        of phrases that must all match, each phrase a list of
+        (word, offset) pairs.
+        """
+        if not isinstance(text, unicode):
+            text = unicode(text, "utf-8", "replace")
+        alternatives = [[]]
+        for phrase, word in re.findall(r'(?u)"([^"]*)"|(\S+)', text):
+            if word == 'OR':
+                alternatives.append([])
+                continue
+            terms = text_terms((phrase or word, self.minlength,
+                self.maxlength, self.stopwords))
+            if not terms:
+                continue
+            offset = min([positions[0] for positions in terms.values()])
+            alternatives[-1].append([(w, positions[0] - offset)
+                for w, positions in terms.items()])
+        return [phrases for phrases in alternatives if phrases]
+
+    def match(self, text):
+        """ Return {(classname, itemid, property): score} for the texts
+        matching the query text.
+        """
+        alternatives = self.parse_query(text)
+        words = set()
+        for phrases in alternatives:
+            for phrase in phrases:
+                words.update([word for word, offset in phrase])
+        if not words:
+            return {}
+
+        # fetch the postings of all the words
+        a = self.db.arg
+        words = list(words)
+        sql = 'select w._word, w._freq, w._positions, t._class, t._itemid, '\
+            't._prop from __terms w, __textids t where '\
+            'w._textid=t._textid and w._word in (%s)'%','.join([a]*len(words))
+        self.db.cursor.execute(sql, words)
+        postings = {}
+        for row in self.db.cursor.fetchall():
+            identifier = (str(row[3]), str(row[4]), str(row[5]))
+            postings.setdefault(identifier, {})[str(row[0])] = (int(row[1]),
+                row[2])
+
+        # inverse document frequencies
+        self.db.cursor.execute('select count(*) from __textids')
+        total = int(self.db.cursor.fetchone()[0]) or 1
+        counts = {}
+        for terms in postings.itervalues():
+            for word in terms:
+                counts[word] = counts.get(word, 0) + 1
+        idf = {}
+        for word, count in counts.iteritems():
+            idf[word] = math.log(1 + float(total) / count)
+
+        hits = {}
+        for identifier, terms in postings.iteritems():
+            for phrases in alternatives:
+                if self.matches(phrases, terms):
+                    break
+            else:
+                continue
+            score = 0
+            for word, (freq, positions) in terms.iteritems():
+                score += idf[word] * freq * (self.k1 + 1) / (freq + self.k1)
+            hits[identifier] = score
+        return hits
+
+    def matches(self, phrases, terms):
+        """ Do all phrases occur in the text with the given terms,
+        {word: (freq, encoded positions)}?
+        """
+        for phrase in phrases:
+            if len(phrase) == 1:
+                if phrase[0][0] not in terms:
+                    return False
+                continue
+            starts = None
+            for word, offset in phrase:
+                if word not in terms:
+                    return False
+                s = set([p - offset
+                    for p in decode_positions(terms[word][1])])
+                if starts is None:
+                    starts = s
+                else:
+                    starts &= s
+                if not starts:
+                    return False
+        return True
+
+    def find(self, wordlist):
+        """look up all the words in the wordlist.
+        If none are found return an empty list
+        """
+        return list(self.match(' '.join(wordlist)))
+
+    def search(self, search_terms, klass, ignore={}):
+        """Display search results looking for [search, terms] associated
+        with the hyperdb Class "klass". Ignore hits on {class: property}.
+        """
+        hits = self.match(' '.join(search_terms))
+        return dict([(itemid, linked) for itemid, (score, linked)
+            in self.map_hits(hits, klass, ignore).iteritems()])
+
+    def query(self, text, klass, limit=None, ignore={}):
+        """Return [(itemid, score)] of the items of "klass" matching the
+        query text, best first, at most "limit" of them.
+        """
+        hits = self.match(text)
+        result = [(score, itemid) for itemid, (score, linked)
+            in self.map_hits(hits, klass, ignore).iteritems()]
+        result.sort(key=lambda x: (-x[0], int(x[1])))
+        return [(itemid, score) for score, itemid in result[:limit]]
+
+    def map_hits(self, hits, klass, ignore={}):
+        """ Map the text hits {identifier: score} to the items of klass,
+        returning {itemid: (score, {linkprop: [nodeid, ...]})}.
+        """
+        result = {}
+        linked = {}
+        for (classname, nodeid, prop), score in hits.iteritems():
+            if (classname, prop) in ignore:
+                continue
+            if classname == klass.classname:
+                entry = result.setdefault(nodeid, [0, {}])
+                entry[0] += score
+            else:
+                scores = linked.setdefault(classname, {})
+                scores[nodeid] = scores.get(nodeid, 0) + score
+
+        a = self.db.arg
+        for linkprop, propclass in klass.getprops().iteritems():
+            if not isinstance(propclass, (hyperdb.Link, hyperdb.Multilink)):
+                continue
+            scores = linked.get(propclass.classname)
+            if not scores:
+                continue
+            nodeids = scores.keys()
+            n = self.db.sql_max_params
+            for i in range(0, len(nodeids), n):
+                chunk = nodeids[i:i + n]
+                if isinstance(propclass, hyperdb.Multilink):
+                    sql = 'select m.nodeid, m.linkid from %s_%s m, _%s c '\
+                        'where m.nodeid=c.id and c.__retired__=0 and '\
+                        'm.linkid in (%s)'%(klass.classname, linkprop,
+                        klass.classname, ','.join([a]*len(chunk)))
+                else:
+                    sql = 'select id, _%s from _%s where __retired__=0 '\
+                        'and _%s in (%s)'%(linkprop, klass.classname,
+                        linkprop, ','.join([a]*len(chunk)))
+                self.db.cursor.execute(sql, [int(x) for x in chunk])
+                for itemid, nodeid in self.db.cursor.fetchall():
+                    itemid, nodeid = str(itemid), str(nodeid)
+                    entry = result.setdefault(itemid, [0, {}])
+                    entry[0] += scores[nodeid]
+                    entry[1].setdefault(linkprop, []).append(nodeid)
+        return dict([(itemid, tuple(entry))
+            for itemid, entry in result.iteritems()])
+
+# vim: set filetype=python ts=4 sw=4 et si
@@ -6,6 +6,24 @@ import re
 
 from roundup.backends.indexer_common import Indexer as IndexerBase
 
+def text_words(args):
+    """ Return the set of words of (text, minlength, maxlength, stopwords)
+        to put in the index.
+
+        This is a plain function taking a single tuple so that it may be
+        run in a multiprocessing pool.
+    """
+    text, minlength, maxlength, stopwords = args
+    if not isinstance(text, unicode):
+        text = unicode(text, "utf-8", "replace")
+    text = text.upper()
+    words = set()
+    for w in re.findall(r'(?u)\b\w{%d,%d}\b' % (minlength, maxlength), text):
+        word = w.encode("utf-8")
+        if word not in stopwords:
+            words.add(word)
+    return words
+
 class Indexer(IndexerBase):
     def __init__(self, db):
         IndexerBase.__init__(self, db)
@@ -61,22 +79,86 @@ class Indexer(IndexerBase):
             self.db.cursor.execute(sql, (id, ))
 
         # ok, find all the unique words in the text
-        if not isinstance(text, unicode):
-            text = unicode(text, "utf-8", "replace")
-        text = text.upper()
-        wordlist = [w.encode("utf-8")
-                    for w in re.findall(r'(?u)\b\w{%d,%d}\b'
-                                        % (self.minlength, self.maxlength), text)]
-        words = set()
-        for word in wordlist:
-            if self.is_stopword(word): continue
-            words.add(word)
+        words = text_words((text, self.minlength, self.maxlength,
+            self.stopwords))
 
         # for each word, add an entry in the db
         sql = 'insert into __words (_word, _textid) values (%s, %s)'%(a, a)
         words = [(word, id) for word in words]
         self.db.cursor.executemany(sql, words)
 
+    def add_texts(self, entries, pool=None):
+        """ Index a batch of (identifier, text, mime_type) entries.
+
+        The words of all texts are found first (in "pool" if one is
+        given), then the old words of the batch are removed and the new
+        ones written with a few bulk statements.
+        """
+        entries = [(tuple(map(str, identifier)), text)
+            for identifier, text, mime_type in entries
+            if mime_type == 'text/plain']
+        if not entries:
+            return
+        args = [(text, self.minlength, self.maxlength, self.stopwords)
+            for identifier, text in entries]
+        if pool is None:
+            wordsets = map(text_words, args)
+        else:
+            wordsets = pool.map(text_words, args)
+
+        textids = self.get_textids([identifier
+            for identifier, text in entries])
+        rows = []
+        for (identifier, text), words in zip(entries, wordsets):
+            id = textids[identifier]
+            rows.extend([(word, id) for word in words])
+        self.db.sql_bulk_insert('__words', ('_word', '_textid'), rows)
+
+    def get_textids(self, identifiers, table='__words'):
+        """ Return {identifier: textid} for the (classname, itemid,
+        property) identifiers.
+
+        Identifiers not indexed before are given a new id; the entries
+        of the others are removed from "table".
+        """
+        # find the ids of the identifiers already indexed, by class
+        a = self.db.arg
+        textids = {}
+        byclass = {}
+        for identifier in identifiers:
+            byclass.setdefault(identifier[0], set()).add(identifier[1])
+        n = self.db.sql_max_params - 1
+        for classname, itemids in byclass.iteritems():
+            itemids = list(itemids)
+            for i in range(0, len(itemids), n):
+                chunk = itemids[i:i + n]
+                sql = 'select _textid, _class, _itemid, _prop from __textids'\
+                    ' where _class=%s and _itemid in (%s)'%(a,
+                    ','.join([a] * len(chunk)))
+                self.db.cursor.execute(sql, [classname] + chunk)
+                for row in self.db.cursor.fetchall():
+                    textids[(str(row[1]), str(row[2]), str(row[3]))] = \
+                        int(row[0])
+
+        # clear out the existing indexed values
+        old = [textids[identifier] for identifier in identifiers
+            if identifier in textids]
+        for i in range(0, len(old), self.db.sql_max_params):
+            chunk = old[i:i + self.db.sql_max_params]
+            sql = 'delete from %s where _textid in (%s)'%(table,
+                ','.join([a] * len(chunk)))
+            self.db.cursor.execute(sql, chunk)
+
+        # new identifiers get a new id
+        new = []
+        for identifier in identifiers:
+            if identifier not in textids:
+                textids[identifier] = int(self.db.newid('__textids'))
+                new.append((textids[identifier], ) + identifier)
+        self.db.sql_bulk_insert('__textids', ('_textid', '_class', '_itemid',
+            '_prop'), new)
+        return textids
+
     def find(self, wordlist):
         """look up all the words in the wordlist.
         If none are found return an empty dictionary
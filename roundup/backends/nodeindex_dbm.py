@@ -0,0 +1,176 @@
+"""This module defines the secondary indexes the anydbm backend may keep
+next to the nodes of a class, so that searches only need to decode the
+nodes that can match.
+
+The indexes of a class are stored in their own dbm file. Keys are:
+
+    __props__           the indexed properties, to notice schema changes
+    L<prop>:<nodeid>    ids of the nodes linking to <nodeid> through the
+                        Link or Multilink <prop>; an empty <nodeid> for
+                        the nodes where <prop> isn't set
+    K:<value>           ids of the nodes whose key property is <value>
+    D<prop>             [(serialised date, nodeid), ...] of the Date
+                        <prop>, sorted
+
+Values are marshalled. The indexes hold all committed nodes, retired ones
+included, and may name more nodes than match: callers check the nodes
+they are given.
+"""
+__docformat__ = 'restructuredtext'
+
+import marshal, bisect
+
+from roundup import hyperdb
+
+# bump this when the layout of the indexes changes
+VERSION = 1
+
+def index_props(klass):
+    """ Return the sorted [(propname, kind)] of the properties of "klass"
+        that are indexed. Kind is 'L' for Link, 'M' for Multilink, 'D' for
+        Date and 'K' for the key property.
+    """
+    l = []
+    for propname, prop in klass.getprops().iteritems():
+        if isinstance(prop, hyperdb.Link):
+            l.append((propname, 'L'))
+        elif isinstance(prop, hyperdb.Multilink):
+            l.append((propname, 'M'))
+        elif isinstance(prop, hyperdb.Date):
+            l.append((propname, 'D'))
+    if klass.getkey():
+        l.append((klass.getkey(), 'K'))
+    l.sort()
+    return l
+
+class NodeIndex:
+    """ The secondary indexes of one class, stored in the dbm "db".
+
+        Entries read are cached and changes are kept in memory until
+        flush().
+    """
+    def __init__(self, db, props):
+        self.db = db
+        self.props = props
+        self.entries = {}
+        self.changed = {}
+
+    def valid(self):
+        """ Are the indexes complete and made for the current schema? """
+        if '__props__' not in self.db:
+            return False
+        return marshal.loads(self.db['__props__']) == [VERSION, self.props]
+
+    def get(self, key):
+        if key not in self.entries:
+            if key in self.db:
+                value = marshal.loads(self.db[key])
+            else:
+                value = []
+            if not key.startswith('D'):
+                value = set(value)
+            self.entries[key] = value
+        return self.entries[key]
+
+    def keys(self, node):
+        """ Return the set and date index keys for the serialised node as
+            ([set key, ...], {date key: date}).
+        """
+        sets = []
+        dates = {}
+        for propname, kind in self.props:
+            value = node.get(propname)
+            if kind == 'L':
+                sets.append('L%s:%s'%(propname, value or ''))
+            elif kind == 'M':
+                for v in value or ['']:
+                    sets.append('L%s:%s'%(propname, v))
+            elif kind == 'K':
+                if isinstance(value, str):
+                    sets.append('K:' + value)
+            elif value is not None:
+                dates['D' + propname] = value
+        return sets, dates
+
+    def update(self, nodeid, old, new):
+        """ Move the node "nodeid" from its "old" to its "new" serialised
+            values. Either may be None for a created or destroyed node.
+        """
+        oldsets, olddates = self.keys(old or {})
+        newsets, newdates = self.keys(new or {})
+        for key in set(oldsets) - set(newsets):
+            self.get(key).discard(nodeid)
+            self.changed[key] = 1
+        for key in set(newsets) - set(oldsets):
+            self.get(key).add(nodeid)
+            self.changed[key] = 1
+        for key in set(olddates) | set(newdates):
+            value = olddates.get(key)
+            if value == newdates.get(key):
+                continue
+            l = self.get(key)
+            if value is not None:
+                i = bisect.bisect_left(l, (value, nodeid))
+                if i < len(l) and l[i] == (value, nodeid):
+                    del l[i]
+            if key in newdates:
+                bisect.insort(l, (newdates[key], nodeid))
+            self.changed[key] = 1
+
+    def build(self, cldb):
+        """ Index all nodes of the class db "cldb". """
+        dates = {}
+        for nodeid in cldb.keys():
+            sets, d = self.keys(marshal.loads(cldb[nodeid]))
+            for key in sets:
+                self.get(key).add(nodeid)
+                self.changed[key] = 1
+            for key, value in d.iteritems():
+                dates.setdefault(key, []).append((value, nodeid))
+        for key, l in dates.iteritems():
+            l.sort()
+            self.entries[key] = l
+            self.changed[key] = 1
+
+    def flush(self):
+        """ Write the changed entries and mark the indexes complete. """
+        for key in self.changed:
+            value = self.entries[key]
+            if not value:
+                if key in self.db:
+                    del self.db[key]
+            else:
+                self.db[key] = marshal.dumps(list(value))
+        self.changed = {}
+        self.db['__props__'] = marshal.dumps([VERSION, self.props])
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def links(self, propname, nodeids):
+        """ Return the ids of the nodes linking to any of "nodeids" through
+            "propname"; None in "nodeids" stands for "not set".
+        """
+        s = set()
+        for nodeid in nodeids:
+            s.update(self.get('L%s:%s'%(propname, nodeid or '')))
+        return s
+
+    def keyed(self, value):
+        """ Return the ids of the nodes with the key property "value". """
+        return set(self.get('K:' + value))
+
+    def dates(self, propname, low=None, high=None):
+        """ Return the ids of the nodes whose serialised "propname" sorts
+            between "low" and "high"; None leaves that end open.
+        """
+        l = self.get('D' + propname)
+        start, end = 0, len(l)
+        if low is not None:
+            start = bisect.bisect_left(l, (low,))
+        if high is not None:
+            end = bisect.bisect_right(l, (high,))
+        return set([nodeid for value, nodeid in l[start:end]])
+
+# vim: set filetype=python ts=4 sw=4 et si
@@ -52,13 +52,15 @@ the same name.
 __docformat__ = 'restructuredtext'
 
 # standard python modules
-import sys, os, time, re, errno, weakref, copy, logging, datetime
+import sys, os, time, re, errno, weakref, copy, logging, datetime, threading
+import marshal, binascii, ast
+from collections import OrderedDict
 
 # roundup modules
 from roundup import hyperdb, date, password, roundupdb, security, support
 from roundup.hyperdb import String, Password, Date, Interval, Link, \
     Multilink, DatabaseError, Boolean, Number, Integer, Node
-from roundup.backends import locking
+from roundup.backends import locking, indexer_common
 from roundup.i18n import _
 
 
@@ -93,6 +95,24 @@ def date_to_hyperdb_value(d):
         return date.Date(d)
     return date.Date (str(d).replace(' ', '.'))
 
+def journal_dumps(params):
+    """ Encode the params of a journal entry for the params column.
+
+        The params are marshalled and base64 encoded behind a version
+        marker, so they can be read back without evaluating any code.
+    """
+    return 'm2:' + binascii.b2a_base64(marshal.dumps(params, 2)).strip()
+
+def journal_loads(data):
+    """ Decode a params column written by journal_dumps().
+
+        Entries written by older versions of Roundup hold the repr() of
+        the params, which is decoded with ast.literal_eval.
+    """
+    if data.startswith('m2:'):
+        return marshal.loads(binascii.a2b_base64(data[3:]))
+    return ast.literal_eval(data)
+
 
 def connection_dict(config, dbnamestr=None):
     """ Used by Postgresql and MySQL to detemine the keyword args for
@@ -155,12 +175,135 @@ class IdListOptimizer:
         return "ranges: %r / singles: %r" % (self.ranges, self.singles)
 
 
+class ConnectionPool:
+    """ Idle database connections kept open for reuse by later Database
+        instances of the same process.
+
+        At most max_size idle connections are kept. Connections that
+        have been idle for longer than idle_timeout seconds are closed,
+        except for the min_size most recently used ones. Connections
+        are checked with a trivial query before they are handed out.
+    """
+
+    def __init__(self, min_size, max_size, idle_timeout):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # (conn, time released) pairs, most recently released last
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self, db):
+        """ Return a (conn, cursor) pair, opening a new connection via
+            db.sql_open_connection() if there's no usable idle one.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                self.expire()
+                if not self.idle:
+                    break
+                conn = self.idle.pop()[0]
+            finally:
+                self.lock.release()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('select 1')
+                cursor.fetchone()
+                conn.rollback()
+            except Exception:
+                logging.getLogger('roundup.hyperdb.backend').info(
+                    'discarding broken pooled connection')
+                self.discard(conn)
+                continue
+            return conn, conn.cursor()
+        return db.sql_open_connection()
+
+    def put(self, conn):
+        """ Return conn to the pool, closing it if the pool is full.
+        """
+        try:
+            conn.rollback()
+        except Exception:
+            self.discard(conn)
+            return
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+        finally:
+            self.lock.release()
+        self.discard(conn)
+
+    def expire(self):
+        """ Close connections idle for too long. Call with the lock held.
+        """
+        limit = time.time() - self.idle_timeout
+        while len(self.idle) > self.min_size and self.idle[0][1] < limit:
+            self.discard(self.idle.pop(0)[0])
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def clear(self):
+        """ Close all idle connections.
+        """
+        self.lock.acquire()
+        try:
+            while self.idle:
+                self.discard(self.idle.pop()[0])
+        finally:
+            self.lock.release()
+
+# connection pools by backend, connection parameters and process id
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db):
+    """ Return the ConnectionPool to use for db or None if db doesn't
+        pool connections.
+    """
+    config = db.config
+    if not db.supports_connection_pool or config.RDBMS_CONNECTION_POOL_SIZE < 1:
+        return None
+    key = (db.__class__.__module__, config.RDBMS_NAME,
+        config.RDBMS_ISOLATION_LEVEL,
+        tuple(sorted(connection_dict(config).items())), os.getpid())
+    pool = _connection_pools.get(key)
+    if pool is None:
+        _connection_pools_lock.acquire()
+        try:
+            pool = _connection_pools.get(key)
+            if pool is None:
+                pool = _connection_pools[key] = ConnectionPool(
+                    config.RDBMS_CONNECTION_POOL_MIN,
+                    config.RDBMS_CONNECTION_POOL_SIZE,
+                    config.RDBMS_CONNECTION_POOL_TIMEOUT)
+        finally:
+            _connection_pools_lock.release()
+    return pool
+
+def clear_connection_pools():
+    """ Close all pooled connections of this process, e.g. before the
+        database is dropped.
+    """
+    pid = os.getpid()
+    for key, pool in list(_connection_pools.items()):
+        if key[-1] == pid:
+            pool.clear()
+
+
 class Database(FileStorage, hyperdb.Database, roundupdb.Database):
     """ Wrapper around an SQL database that presents a hyperdb interface.
 
         - some functionality is specific to the actual SQL database, hence
           the sql_* methods that are NotImplemented
-        - we keep a cache of the latest N row fetches (where N is configurable).
+        - we keep a cache of the latest N row fetches (where N is configurable,
+          optionally per class).
     """
     def __init__(self, config, journaltag=None):
         """ Open the database and load the schema from it.
@@ -177,9 +320,13 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         # keep a cache of the N most recently retrieved rows of any kind
         # (classname, nodeid) = row
+        # classes listed in cache_size_per_class get a cache of their own
         self.cache_size = config.RDBMS_CACHE_SIZE
+        self.cache_class_size = config.RDBMS_CACHE_SIZE_PER_CLASS
         self.clearCache()
-        self.stats = {'cache_hits': 0, 'cache_misses': 0, 'get_items': 0,
+        # cache_classes maps classname -> {'hits', 'misses', 'evictions'}
+        self.stats = {'cache_hits': 0, 'cache_misses': 0,
+            'cache_evictions': 0, 'cache_classes': {}, 'get_items': 0,
             'filtering': 0}
 
         # make sure the database directory exists
@@ -198,7 +345,10 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     def clearCache(self):
         self.cache = {}
-        self.cache_lru = []
+        # LRU order of the cache keys, least recently used first. The
+        # shared cache is stored under None, classes with their own
+        # cache size under their classname.
+        self.cache_lru = {}
         # upcall is necessary!
         roundupdb.Database.clearCache(self)
 
@@ -219,6 +369,34 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """
         raise NotImplementedError
 
+    # set by backends that can share connections through a ConnectionPool
+    supports_connection_pool = False
+
+    def sql_get_connection(self):
+        """ Return a (conn, cursor) pair, taken from the connection pool
+            if there is one.
+        """
+        pool = get_connection_pool(self)
+        if pool is None:
+            return self.sql_open_connection()
+        return pool.get(self)
+
+    def sql_release_connection(self, conn):
+        """ Give back a connection obtained from sql_get_connection().
+        """
+        pool = get_connection_pool(self)
+        if pool is None:
+            conn.close()
+        else:
+            pool.put(conn)
+
+    def sql_have_pooled_connection(self):
+        """ Is there an idle connection in the pool? If so, the database
+            is known to exist.
+        """
+        pool = get_connection_pool(self)
+        return pool is not None and bool(pool.idle)
+
     def sql(self, sql, args=None, cursor=None):
         """ Execute the sql with the optional args.
         """
@@ -230,6 +408,46 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         else:
             cursor.execute(sql)
 
+    # what a LIMIT clause needs to say for "no limit", for databases that
+    # don't accept an OFFSET without a LIMIT
+    sql_no_limit = None
+
+    def sql_limit(self, limit=None, offset=None):
+        """ Return the LIMIT/OFFSET clause selecting at most limit rows
+            after skipping offset rows.
+        """
+        sql = []
+        if limit is not None:
+            sql.append('limit %d'%limit)
+        elif offset and self.sql_no_limit:
+            sql.append('limit %s'%self.sql_no_limit)
+        if offset:
+            sql.append('offset %d'%offset)
+        return ' '.join(sql)
+
+    # the most parameters we pass in a single statement (SQLite's default
+    # limit is 999)
+    sql_max_params = 999
+
+    def sql_bulk_insert(self, table, columns, rows):
+        """ Insert the rows (tuples of values for columns) into table.
+
+            This uses multi-row INSERT statements with as many rows each as
+            sql_max_params allows.
+        """
+        if not rows:
+            return
+        row = '(%s)'%','.join([self.arg] * len(columns))
+        n = self.sql_max_params // len(columns)
+        for i in range(0, len(rows), n):
+            chunk = rows[i:i + n]
+            sql = 'insert into %s (%s) values %s'%(table, ','.join(columns),
+                ','.join([row] * len(chunk)))
+            args = []
+            for values in chunk:
+                args.extend(values)
+            self.sql(sql, args)
+
     def sql_fetchone(self):
         """ Fetch a single row. If there's nothing to fetch, return None.
         """
@@ -325,7 +543,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     # update this number when we need to make changes to the SQL structure
     # of the backen database
-    current_db_version = 5
+    current_db_version = 7
     db_version_updated = False
     def upgrade_db(self):
         """ Update the SQL database to reflect changes in the backend code.
@@ -365,6 +583,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             self.log_info('upgrade to version 5')
             self.fix_version_4_tables()
 
+        if version < 6:
+            self.log_info('upgrade to version 6')
+            self.fix_version_5_tables()
+
+        if version < 7:
+            self.log_info('upgrade to version 7')
+            self.fix_version_6_tables()
+
         self.database_schema['version'] = self.current_db_version
         self.db_version_updated = True
         return 1
@@ -446,20 +672,18 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.post_init()
 
 
-    def reindex(self, classname=None, show_progress=False):
+    def reindex(self, classname=None, show_progress=False, batch_size=100,
+            processes=None, state_file=None):
+        """ Re-generate the search indexes of one or all classes.
+
+        See indexer_common.reindex for the other arguments.
+        """
         if classname:
             classes = [self.getclass(classname)]
         else:
             classes = list(self.classes.itervalues())
-        for klass in classes:
-            if show_progress:
-                for nodeid in support.Progress('Reindex %s'%klass.classname,
-                        klass.list()):
-                    klass.index(nodeid)
-            else:
-                for nodeid in klass.list():
-                    klass.index(nodeid)
-        self.indexer.save_index()
+        indexer_common.reindex(self, classes, show_progress, batch_size,
+            processes, state_file)
 
     # Used here in the generic backend to determine if the database
     # supports 'DOUBLE PRECISION' for floating point numbers.
@@ -900,20 +1124,62 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         raise ValueError('%r is not a hyperdb property class' % propklass)
 
+    def _cache_lru(self, classname):
+        """ Return the LRU and its size limit responsible for classname.
+        """
+        if classname in self.cache_class_size:
+            pool, size = classname, self.cache_class_size[classname]
+        else:
+            pool, size = None, self.cache_size
+        lru = self.cache_lru.get(pool)
+        if lru is None:
+            lru = self.cache_lru[pool] = OrderedDict()
+        return lru, size
+
+    def _cache_stats(self, classname, counter):
+        """ Count a cache hit, miss or eviction for classname.
+        """
+        self.stats['cache_' + counter] += 1
+        classes = self.stats['cache_classes']
+        if classname not in classes:
+            classes[classname] = {'hits': 0, 'misses': 0, 'evictions': 0}
+        classes[classname][counter] += 1
+
     def _cache_del(self, key):
         del self.cache[key]
-        self.cache_lru.remove(key)
+        del self._cache_lru(key[0])[0][key]
 
     def _cache_refresh(self, key):
-        self.cache_lru.remove(key)
-        self.cache_lru.insert(0, key)
+        lru = self._cache_lru(key[0])[0]
+        del lru[key]
+        lru[key] = None
 
     def _cache_save(self, key, node):
         self.cache[key] = node
         # update the LRU
-        self.cache_lru.insert(0, key)
-        if len(self.cache_lru) > self.cache_size:
-            del self.cache[self.cache_lru.pop()]
+        lru, size = self._cache_lru(key[0])
+        lru.pop(key, None)
+        lru[key] = None
+        while len(lru) > size:
+            old = lru.popitem(last=False)[0]
+            del self.cache[old]
+            if __debug__:
+                self._cache_stats(old[0], 'evictions')
+
+    def cache_hit_rate(self, classname=None):
+        """ Return the fraction of node cache lookups that were hits,
+            either overall or for the given classname. Returns None if
+            there were no lookups yet.
+        """
+        if classname is None:
+            stats = {'hits': self.stats['cache_hits'],
+                'misses': self.stats['cache_misses']}
+        else:
+            stats = self.stats['cache_classes'].get(classname, {})
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        if not lookups:
+            return None
+        return float(stats['hits']) / lookups
 
     def addnode(self, classname, nodeid, node):
         """ Add the specified node to its class's db.
@@ -921,7 +1187,74 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.log_debug('addnode %s%s %r'%(classname,
             nodeid, node))
 
-        # determine the column definitions and multilink tables
+        cols, vals, values = self._node_row(classname, nodeid, node)
+
+        # make sure the ordering is correct for column name -> column value
+        s = ','.join([self.arg for x in cols])
+
+        # perform the inserts
+        sql = 'insert into _%s (%s) values (%s)'%(classname, ','.join(cols),
+            s)
+        self.sql(sql, vals)
+
+        # insert the multilink rows
+        cl = self.classes[classname]
+        x, mls = self.determine_columns(list(cl.properties.iteritems()))
+        for col in mls:
+            t = '%s_%s'%(classname, col)
+            for entry in node[col]:
+                sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
+                    self.arg, self.arg)
+                self.sql(sql, (entry, nodeid))
+
+    def addnodes(self, classname, nodes):
+        """ Add the new nodes, a list of (nodeid, node), to the class's db
+            with bulk inserts.
+        """
+        cl = self.classes[classname]
+        x, mls = self.determine_columns(list(cl.properties.iteritems()))
+        rows = []
+        links = dict([(col, []) for col in mls])
+        for nodeid, node in nodes:
+            cols, vals, values = self._node_row(classname, nodeid, node)
+            rows.append(vals)
+            for col in mls:
+                for entry in values[col]:
+                    links[col].append((entry, nodeid))
+        if not rows:
+            return
+        self.sql_bulk_insert('_%s'%classname, cols, rows)
+        for col in mls:
+            self.sql_bulk_insert('%s_%s'%(classname, col),
+                ('linkid', 'nodeid'), links[col])
+
+    def begin_import(self, classname):
+        """ Drop the indexes of the class's tables while its rows are
+            loaded; end_import() rebuilds them.
+        """
+        cl = self.classes[classname]
+        x, mls = self.determine_columns(list(cl.properties.iteritems()))
+        self.drop_class_table_indexes(classname, cl.key)
+        if cl.key:
+            # end_import() rebuilds the key/retired unique index too
+            self.drop_class_table_key_index(classname, cl.key)
+        for ml in mls:
+            self.drop_multilink_table_indexes(classname, ml)
+
+    def end_import(self, classname):
+        """ Rebuild the indexes dropped by begin_import().
+        """
+        cl = self.classes[classname]
+        x, mls = self.determine_columns(list(cl.properties.iteritems()))
+        self.create_class_table_indexes(cl)
+        for ml in mls:
+            self.create_multilink_table_indexes(cl, ml)
+
+    def _node_row(self, classname, nodeid, node):
+        """ Return the columns and values of the class table row for a
+            new node, and the node's values with the defaults filled in.
+        """
+        # determine the column definitions
         cl = self.classes[classname]
         cols, mls = self.determine_columns(list(cl.properties.iteritems()))
 
@@ -933,7 +1266,6 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             values['creation'] = values['activity'] = date.Date()
             values['actor'] = values['creator'] = self.getuid()
 
-        cl = self.classes[classname]
         props = cl.getprops(protected=1)
         del props['id']
 
@@ -970,23 +1302,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 value = self.to_sql_value(prop.__class__)(value)
             vals.append(value)
         vals.append(nodeid)
-        vals = tuple(vals)
-
-        # make sure the ordering is correct for column name -> column value
-        s = ','.join([self.arg for x in cols]) + ',%s'%self.arg
-        cols = ','.join([col for col,dt in cols]) + ',id'
-
-        # perform the inserts
-        sql = 'insert into _%s (%s) values (%s)'%(classname, cols, s)
-        self.sql(sql, vals)
-
-        # insert the multilink rows
-        for col in mls:
-            t = '%s_%s'%(classname, col)
-            for entry in node[col]:
-                sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
-                    self.arg, self.arg)
-                self.sql(sql, (entry, nodeid))
+        return [col for col,dt in cols] + ['id'], tuple(vals), values
 
     def setnode(self, classname, nodeid, values, multilink_changes={}):
         """ Change the specified node.
@@ -1149,14 +1465,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             # push us back to the top of the LRU
             self._cache_refresh(key)
             if __debug__:
-                self.stats['cache_hits'] += 1
+                self._cache_stats(classname, 'hits')
             # return the cached information
             if fetch_multilinks:
                 self._materialize_multilinks(classname, nodeid, self.cache[key])
             return self.cache[key]
 
         if __debug__:
-            self.stats['cache_misses'] += 1
+            self._cache_stats(classname, 'misses')
             start_t = time.time()
 
         # figure the columns we're fetching
@@ -1173,8 +1489,24 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             raise IndexError('no such %s node %s'%(classname, nodeid))
 
         # make up the node
+        node = self._make_node(cl.getprops(protected=1), cols, values)
+
+        if fetch_multilinks and mls:
+            self._materialize_multilinks(classname, nodeid, node, mls)
+
+        # save off in the cache
+        key = (classname, nodeid)
+        self._cache_save(key, node)
+
+        if __debug__:
+            self.stats['get_items'] += (time.time() - start_t)
+
+        return node
+
+    def _make_node(self, props, cols, values):
+        """ Make up a node from the values of the columns cols.
+        """
         node = {}
-        props = cl.getprops(protected=1)
         for col in range(len(cols)):
             name = cols[col][0][1:]
             if name.endswith('_int__'):
@@ -1185,18 +1517,88 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             if value is not None:
                 value = self.to_hyperdb_value(props[name].__class__)(value)
             node[name] = value
+        return node
 
-        if fetch_multilinks and mls:
-            self._materialize_multilinks(classname, nodeid, node, mls)
+    def getnodes(self, classname, nodeids, props=None):
+        """ Get many nodes from the database, returning {nodeid: node}.
+
+            The nodes not in the cache are fetched with one query per
+            sql_max_params ids. The Multilinks in props (all of them if
+            props is None) are fetched for all the nodes with one query
+            per property. The nodes are saved in the cache.
+        """
+        cl = self.classes[classname]
+        cols, mls = self.determine_columns(list(cl.properties.iteritems()))
+        if props is not None:
+            mls = [name for name in mls if name in props]
+
+        nodes = {}
+        missing = []
+        for nodeid in set(nodeids):
+            key = (classname, nodeid)
+            if key in self.cache:
+                self._cache_refresh(key)
+                if __debug__:
+                    self._cache_stats(classname, 'hits')
+                nodes[nodeid] = self.cache[key]
+            else:
+                if __debug__:
+                    self._cache_stats(classname, 'misses')
+                missing.append(int(nodeid))
+        missing.sort()
+
+        if __debug__:
+            start_t = time.time()
+
+        # perform the basic property fetch
+        scols = ','.join(['id'] + [col for col,dt in cols])
+        hprops = cl.getprops(protected=1)
+        n = self.sql_max_params
+        for i in range(0, len(missing), n):
+            ids = IdListOptimizer()
+            for nodeid in missing[i:i + n]:
+                ids.append(nodeid)
+            where, args = ids.where('id', self.arg)
+            sql = 'select %s from _%s where %s'%(scols, classname, where)
+            self.sql(sql, args)
+            for values in self.cursor.fetchall():
+                values = tuple(values)
+                nodes[str(values[0])] = self._make_node(hprops, cols,
+                    values[1:])
+        if len(nodes) < len(set(nodeids)):
+            for nodeid in nodeids:
+                if nodeid not in nodes:
+                    raise IndexError('no such %s node %s'%(classname, nodeid))
+
+        # fetch the multilinks of all the nodes in one go per property
+        for propname in mls:
+            need = sorted([int(nodeid) for nodeid, node in nodes.iteritems()
+                if propname not in node])
+            for i in range(0, len(need), n):
+                ids = IdListOptimizer()
+                for nodeid in need[i:i + n]:
+                    ids.append(nodeid)
+                    nodes[str(nodeid)][propname] = []
+                where, args = ids.where('nodeid', self.arg)
+                sql = 'select nodeid, linkid from %s_%s where %s'%(
+                    classname, propname, where)
+                self.sql(sql, args)
+                for nodeid, linkid in self.cursor.fetchall():
+                    nodes[str(nodeid)][propname].append(int(linkid))
+            # XXX numeric ids
+            for nodeid in need:
+                items = nodes[str(nodeid)][propname]
+                items.sort()
+                nodes[str(nodeid)][propname] = [str(x) for x in items]
 
         # save off in the cache
-        key = (classname, nodeid)
-        self._cache_save(key, node)
+        for nodeid, node in nodes.iteritems():
+            self._cache_save((classname, nodeid), node)
 
         if __debug__:
             self.stats['get_items'] += (time.time() - start_t)
 
-        return node
+        return nodes
 
     def destroynode(self, classname, nodeid):
         """Remove a node from the database. Called exclusively by the
@@ -1211,7 +1613,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         # see if we have this node cached
         if (classname, nodeid) in self.cache:
-            del self.cache[(classname, nodeid)]
+            self._cache_del((classname, nodeid))
 
         # see if there's any obvious commit actions that we should get rid of
         for entry in self.transactions[:]:
@@ -1301,7 +1703,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         if isinstance(params, type({})):
             self._journal_marshal(params, classname)
 
-        params = repr(params)
+        params = journal_dumps(params)
 
         dc = self.to_sql_value(hyperdb.Date)
         journaldate = dc(journaldate)
@@ -1327,17 +1729,16 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             # make the journalled data marshallable
             if isinstance(params, type({})):
                 self._journal_marshal(params, classname)
-            params = repr(params)
+            params = journal_dumps(params)
 
             self.save_journal(classname, cols, nodeid, dc(journaldate),
                 journaltag, action, params)
 
     def _journal_marshal(self, params, classname):
-        """Convert the journal params values into safely repr'able and
-        eval'able values."""
+        """Convert the journal params values into marshallable values."""
         properties = self.getclass(classname).getprops()
         for param, value in params.iteritems():
-            if not value:
+            if value is None:
                 continue
             property = properties[param]
             cvt = self.to_sql_value(property.__class__)
@@ -1350,43 +1751,57 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             elif isinstance(property, Boolean):
                 params[param] = cvt(value)
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, decode=True, daterange=None,
+            actions=None, limit=None, offset=None, direction='ascending'):
         """ get the journal for id
+
+            If decode is false the params of "set" entries are left as
+            stored, for decode_journal_params() to convert later. The
+            other arguments are passed to load_journal().
         """
         # make sure the node exists
         if not self.hasnode(classname, nodeid):
             raise IndexError('%s has no node %s'%(classname, nodeid))
 
         cols = ','.join('nodeid date tag action params'.split())
-        journal = self.load_journal(classname, cols, nodeid)
+        journal = self.load_journal(classname, cols, nodeid,
+            daterange=daterange, actions=actions, limit=limit,
+            offset=offset, direction=direction)
 
         # now unmarshal the data
         dc = self.to_hyperdb_value(hyperdb.Date)
         res = []
-        properties = self.getclass(classname).getprops()
         for nodeid, date_stamp, user, action, params in journal:
-            params = eval(params)
-            if isinstance(params, type({})):
-                for param, value in params.iteritems():
-                    if not value:
-                        continue
-                    property = properties.get(param, None)
-                    if property is None:
-                        # deleted property
-                        continue
-                    cvt = self.to_hyperdb_value(property.__class__)
-                    if isinstance(property, Password):
-                        params[param] = password.JournalPassword(value)
-                    elif isinstance(property, Date):
-                        params[param] = cvt(value)
-                    elif isinstance(property, Interval):
-                        params[param] = cvt(value)
-                    elif isinstance(property, Boolean):
-                        params[param] = cvt(value)
+            params = journal_loads(params)
+            if decode and isinstance(params, type({})):
+                self.decode_journal_params(classname, params)
             # XXX numeric ids
             res.append((str(nodeid), dc(date_stamp), user, action, params))
         return res
 
+    def decode_journal_params(self, classname, params):
+        """ Convert the stored values of the params of a "set" journal
+            entry to hyperdb values, in place.
+        """
+        properties = self.getclass(classname).getprops()
+        for param, value in params.iteritems():
+            if not value:
+                continue
+            property = properties.get(param, None)
+            if property is None:
+                # deleted property
+                continue
+            cvt = self.to_hyperdb_value(property.__class__)
+            if isinstance(property, Password):
+                params[param] = password.JournalPassword(value)
+            elif isinstance(property, Date):
+                params[param] = cvt(value)
+            elif isinstance(property, Interval):
+                params[param] = cvt(value)
+            elif isinstance(property, Boolean):
+                params[param] = cvt(value)
+        return params
+
     def save_journal(self, classname, cols, nodeid, journaldate,
             journaltag, action, params):
         """ Save the journal entry to the database
@@ -1399,13 +1814,38 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             classname, cols, a, a, a, a, a)
         self.sql(sql, entry)
 
-    def load_journal(self, classname, cols, nodeid):
+    def load_journal(self, classname, cols, nodeid, daterange=None,
+            actions=None, limit=None, offset=None, direction='ascending'):
         """ Load the journal from the database
-        """
+
+            The entries are selected and ordered by the query, see
+            hyperdb.Database.getjournal() for the arguments.
+        """
+        where = ['nodeid=%s'%self.arg]
+        args = [nodeid]
+        if daterange:
+            dc = self.to_sql_value(Date)
+            r = hyperdb.journal_range(daterange)
+            if r.from_value:
+                where.append('date>=%s'%self.arg)
+                args.append(dc(r.from_value))
+            if r.to_value:
+                where.append('date<=%s'%self.arg)
+                args.append(dc(r.to_value))
+        if actions is not None:
+            if not actions:
+                return []
+            where.append('action in (%s)'%','.join([self.arg]*len(actions)))
+            args.extend(actions)
+        order = 'date'
+        if direction == 'descending':
+            order = 'date desc'
+
         # now get the journal entries
-        sql = 'select %s from %s__journal where nodeid=%s order by date'%(
-            cols, classname, self.arg)
-        self.sql(sql, (nodeid,))
+        sql = 'select %s from %s__journal where %s order by %s %s'%(cols,
+            classname, ' and '.join(where), order,
+            self.sql_limit(limit, offset))
+        self.sql(sql, args)
         return self.cursor.fetchall()
 
     def pack(self, pack_before):
@@ -1429,6 +1869,49 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # open a new cursor for subsequent work
         self.cursor = self.conn.cursor()
 
+    def fix_version_5_tables(self):
+        # add the postings of the "ranked" full-text indexer
+        self.create_terms_table()
+
+    def fix_version_6_tables(self):
+        # store the journal params with journal_dumps()
+        for cn in self.classes:
+            self.convert_journal(cn)
+
+    def convert_journal(self, classname, chunk=500):
+        """ Rewrite the journal entries of the class that hold the repr()
+            of their params with journal_dumps(), "chunk" nodes at a time.
+        """
+        self.sql('select distinct nodeid from %s__journal where '
+            'params not like %s'%(classname, self.arg), ('m2:%',))
+        nodeids = sorted([int(row[0]) for row in self.cursor.fetchall()])
+        cols = ('nodeid', 'date', 'tag', 'action', 'params')
+        for i in range(0, len(nodeids), chunk):
+            ids = IdListOptimizer()
+            for nodeid in nodeids[i:i + chunk]:
+                ids.append(nodeid)
+            where, args = ids.where('nodeid', self.arg)
+            self.sql('select %s from %s__journal where %s'%(','.join(cols),
+                classname, where), args)
+            rows = []
+            for row in self.cursor.fetchall():
+                row = list(row)
+                if not row[4].startswith('m2:'):
+                    row[4] = journal_dumps(journal_loads(row[4]))
+                rows.append(tuple(row))
+            self.sql('delete from %s__journal where %s'%(classname, where),
+                args)
+            self.sql_bulk_insert('%s__journal'%classname, cols, rows)
+
+    def create_terms_table(self):
+        """ Create the table of word postings used by the "ranked" indexer:
+            the frequency and positions of each word in each text.
+        """
+        self.sql('CREATE TABLE __terms (_word VARCHAR(30), _textid INTEGER, '
+            '_freq INTEGER, _positions TEXT)')
+        self.sql('CREATE INDEX terms_word_idx ON __terms(_word, _textid)')
+        self.sql('CREATE INDEX terms_by_id ON __terms(_textid)')
+
     def commit(self):
         """ Commit the current transactions.
 
@@ -1491,7 +1974,13 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """ Close off the connection.
         """
         self.indexer.close()
-        self.sql_close()
+        if get_connection_pool(self) is None:
+            self.sql_close()
+        elif self.conn is not None:
+            logging.getLogger('roundup.hyperdb.backend').info('close')
+            # a second close() mustn't put the connection back again
+            conn, self.conn = self.conn, None
+            self.sql_release_connection(conn)
         if self.Session:
             self.Session.close()
             self.Session = None
@@ -2312,6 +2801,66 @@ class Class(hyperdb.Class):
 	'''
         return True
 
+    # the type Date values are cast to for _sort_concat
+    sql_text_type = 'text'
+
+    def _sort_concat(self, value, frum, where, desc):
+        """ Return an SQL expression joining the "value"s of the rows of
+            "frum" matching "where", sorted (descending if "desc"), with
+            a separator that sorts before any other character. Compared
+            byte by byte, whatever the database's collation, these
+            strings compare like the sorted lists of values do in
+            Python. Return None if the database can't do this.
+        """
+        return None
+
+    def _multilink_sort(self, proptree):
+        """ Return {sort attribute: SQL expression} for the sort
+            attributes of proptree that cross a Multilink, if the database
+            can sort by all of them. Otherwise return {} and sorting by
+            them is finished in Python.
+
+            The database can sort by a Multilink property of this class,
+            followed by any number of Links, ending in a String (other
+            than id) or Date property, if no other sort attribute crosses
+            the same Multilink.
+        """
+        exprs = {}
+        for pt in proptree.sortattr:
+            path = list(pt.ancestors())
+            path.reverse()
+            mls = [p for p in path if isinstance(p.propclass, Multilink)]
+            if not mls:
+                continue
+            ml = path[0]
+            if (mls != [ml] or len(ml.sortattr) != 1 or pt.name == 'id'
+                    or not isinstance(pt.propclass, (String, Date))):
+                return {}
+
+            # join the Multilink table and the classes on the path
+            mt = '_%s_ml'%ml.uniqname
+            frum = ['%s_%s as %s'%(self.classname, ml.name, mt)]
+            col = '%s.linkid'%mt
+            for i, p in enumerate(path[:-1]):
+                alias = '_%s_s'%p.uniqname
+                frum.append('left outer join _%s as %s on %s=%s.id'%(
+                    p.classname, alias, col, alias))
+                col = '%s._%s'%(alias, path[i + 1].name)
+            if isinstance(pt.propclass, String):
+                value = 'lower(%s)'%col
+            else:
+                value = 'cast(%s as %s)'%(col, self.sql_text_type)
+            # unset values sort first, like None
+            value = "coalesce(%s,'')"%value
+            expr = self._sort_concat(value, ' '.join(frum),
+                '%s.nodeid=_%s.id'%(mt, self.classname),
+                pt.sort_direction == '-')
+            if expr is None:
+                return {}
+            # an empty Multilink sorts first, like an empty list
+            exprs[pt] = "coalesce(%s,'')"%expr
+        return exprs
+
     def _filter_multilink_expression_fallback(
         self, classname, multilink_table, expr):
         '''This is a fallback for database that do not support
@@ -2397,13 +2946,15 @@ class Class(hyperdb.Class):
             return where, v, True # True to indicate original
 
     def _filter_sql (self, search_matches, filterspec, srt=[], grp=[], retr=0,
-                     retired=False):
+                     retired=False, limit=None, offset=None):
         """ Compute the proptree and the SQL/ARGS for a filter.
         For argument description see filter below.
         We return a 3-tuple, the proptree, the sql and the sql-args
         or None if no SQL is necessary.
         The flag retr serves to retrieve *all* non-Multilink properties
         (for filling the cache during a filter_iter)
+        The limit and offset are only put into the SQL if the database
+        can do all of the sorting, proptree.limit_done tells if it did.
         """
         # we can't match anything if search_matches is empty
         if not search_matches and search_matches is not None:
@@ -2422,8 +2973,13 @@ class Class(hyperdb.Class):
         mlfilt = 0      # are we joining with Multilink tables?
         sortattr = self._sortattr (group = grp, sort = srt)
         proptree = self._proptree(filterspec, sortattr, retr)
+        mlsort = self._multilink_sort(proptree)
         mlseen = 0
         for pt in reversed(proptree.sortattr):
+            if pt in mlsort:
+                # sorted by the database, see _multilink_sort
+                pt.attr_sort_done = pt.tree_sort_done = True
+                continue
             p = pt
             while p.parent:
                 if isinstance (p.propclass, Multilink):
@@ -2437,7 +2993,6 @@ class Class(hyperdb.Class):
         proptree.compute_sort_done()
 
         cols = ['_%s.id'%icn]
-        mlsort = []
         rhsnum = 0
         for p in proptree:
             rc = ac = oc = None
@@ -2663,6 +3218,10 @@ class Class(hyperdb.Class):
                 p.sql_idx = len(cols)
                 cols.append (rc)
 
+        for pt, expr in mlsort.iteritems():
+            cols.append(expr)
+            pt.orderby.append(expr + ['', ' desc'][pt.sort_direction == '-'])
+
         props = self.getprops()
 
         # don't match retired nodes
@@ -2701,6 +3260,12 @@ class Class(hyperdb.Class):
         else:
             order = ''
 
+        # with all sorting done by the database, let it page, too
+        if (limit is not None or offset) and not [sa for sa in
+                proptree.sortattr if not sa.attr_sort_done]:
+            order = order + ' ' + self.db.sql_limit(limit, offset)
+            proptree.limit_done = True
+
         cols = ','.join(cols)
         loj = ' '.join(loj)
         sql = 'select %s from %s %s %s%s'%(cols, frum, loj, where, order)
@@ -2709,7 +3274,7 @@ class Class(hyperdb.Class):
         return proptree, sql, args
 
     def filter(self, search_matches, filterspec, sort=[], group=[],
-               retired=False):
+               retired=False, limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec
@@ -2723,6 +3288,11 @@ class Class(hyperdb.Class):
 
         "search_matches" is a container type or None
 
+        "limit" and "offset" select a page of at most limit ids, after
+        skipping offset ids of the sorted result. Unless sorting needs
+        to be finished in Python (e.g. sorting by several properties of
+        the same Multilink) they are applied by the database.
+
         The filter must match all properties specificed. If the property
         value to match is a list:
 
@@ -2733,7 +3303,7 @@ class Class(hyperdb.Class):
             start_t = time.time()
 
         sq = self._filter_sql (search_matches, filterspec, sort, group,
-                               retired=retired)
+                               retired=retired, limit=limit, offset=offset)
         # nothing to match?
         if sq is None:
             return []
@@ -2751,15 +3321,35 @@ class Class(hyperdb.Class):
         # XXX numeric ids
         l = [str(row[0]) for row in l]
         l = proptree.sort (l)
+        if not proptree.limit_done and (limit is not None or offset):
+            offset = offset or 0
+            if limit is None:
+                l = l[offset:]
+            else:
+                l = l[offset:offset + limit]
 
         if __debug__:
             self.db.stats['filtering'] += (time.time() - start_t)
         return l
 
+    def filter_count(self, search_matches, filterspec, retired=False):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec, see filter for the arguments.
+        """
+        sq = self._filter_sql(search_matches, filterspec, retired=retired)
+        # nothing to match?
+        if sq is None:
+            return 0
+        proptree, sql, args = sq
+        self.db.sql('select count(*) from (%s) as _count'%sql, args)
+        return self.db.sql_fetchone()[0]
+
     def filter_iter(self, search_matches, filterspec, sort=[], group=[],
-                    retired=False):
+                    retired=False, limit=None, offset=None):
         """Iterator similar to filter above with same args.
-        Limitation: We don't sort on multilinks.
+        Limitation: We don't finish sorting in Python (see
+        _multilink_sort), so limit and offset are always applied by the
+        database.
         This uses an optimisation: We put all nodes that are in the
         current row into the node cache. Then we return the node id.
         That way a fetch of a node won't create another sql-fetch (with
@@ -2767,11 +3357,13 @@ class Class(hyperdb.Class):
         cache. We're using our own temporary cursor.
         """
         sq = self._filter_sql(search_matches, filterspec, sort, group, retr=1,
-                              retired=retired)
+                              retired=retired, limit=limit, offset=offset)
         # nothing to match?
         if sq is None:
             return
         proptree, sql, args = sq
+        if not proptree.limit_done and (limit is not None or offset):
+            sql = sql + ' ' + self.db.sql_limit(limit, offset)
         cursor = self.db.conn.cursor()
         self.db.sql(sql, args, cursor)
         classes = {}
@@ -2864,11 +3456,20 @@ class Class(hyperdb.Class):
     def index(self, nodeid):
         """Add (or refresh) the node to search indexes
         """
+        for identifier, text, mime_type in self.index_entries(nodeid):
+            self.db.indexer.add_text(identifier, text, mime_type)
+
+    def index_entries(self, nodeid):
+        """Return the (identifier, text, mime_type) entries to put in the
+        search indexes for the node
+        """
+        entries = []
         # find all the String properties that have indexme
         for prop, propclass in self.getprops().iteritems():
             if isinstance(propclass, String) and propclass.indexme:
-                self.db.indexer.add_text((self.classname, nodeid, prop),
-                    str(self.get(nodeid, prop)))
+                entries.append(((self.classname, nodeid, prop),
+                    str(self.get(nodeid, prop)), 'text/plain'))
+        return entries
 
     #
     # import / export support
@@ -2905,11 +3506,89 @@ class Class(hyperdb.Class):
         """
         if self.db.journaltag is None:
             raise DatabaseError(_('Database open read-only'))
+        newid, d, retire, texts = self.import_values(propnames, proplist)
+        for entry in texts:
+            self.db.indexer.add_text(*entry)
+
+        # insert new node or update existing?
+        if not self.hasnode(newid):
+            self.db.addnode(self.classname, newid, d) # insert
+        else:
+            self.db.setnode(self.classname, newid, d) # update
+
+        # retire?
+        if retire:
+            # use the arg for __retired__ to cope with any odd database type
+            # conversion (hello, sqlite)
+            sql = 'update _%s set __retired__=%s where id=%s'%(self.classname,
+                self.db.arg, self.db.arg)
+            self.db.sql(sql, (newid, newid))
+        return newid
+
+    def import_lists(self, propnames, proplists):
+        """ Import many nodes, see import_list, returning their nodeids.
+
+            The nodes that don't exist yet are inserted with bulk inserts
+            and their texts are indexed in one go.
+        """
+        if self.db.journaltag is None:
+            raise DatabaseError(_('Database open read-only'))
+        nodes = []
+        texts = []
+        retired = []
+        for proplist in proplists:
+            newid, d, retire, entries = self.import_values(propnames,
+                proplist)
+            nodes.append((newid, d))
+            texts.extend(entries)
+            if retire:
+                retired.append(int(newid))
+        self.db.indexer.add_texts(texts)
+
+        # find the nodes that exist already
+        ids = sorted([int(newid) for newid, d in nodes])
+        existing = {}
+        n = self.db.sql_max_params
+        for i in range(0, len(ids), n):
+            idlist = IdListOptimizer()
+            for id in ids[i:i + n]:
+                idlist.append(id)
+            where, args = idlist.where('id', self.db.arg)
+            self.db.sql('select id from _%s where %s'%(self.classname,
+                where), args)
+            for row in self.db.cursor.fetchall():
+                existing[str(row[0])] = 1
+
+        self.db.addnodes(self.classname, [(newid, d) for newid, d in nodes
+            if newid not in existing])
+        for newid, d in nodes:
+            if newid in existing:
+                self.db.setnode(self.classname, newid, d) # update
+
+        # retire, setting __retired__ to the id as import_list does
+        retired.sort()
+        for i in range(0, len(retired), n):
+            idlist = IdListOptimizer()
+            for id in retired[i:i + n]:
+                idlist.append(id)
+            where, args = idlist.where('id', self.db.arg)
+            self.db.sql('update _%s set __retired__=id where %s'%(
+                self.classname, where), args)
+        return [newid for newid, d in nodes]
+
+    def import_values(self, propnames, proplist):
+        """ Convert the exported values of a node for import_list.
+
+            Return the nodeid, the node's property map, whether the node
+            is retired and the (identifier, text, mime type) entries to
+            index.
+        """
         properties = self.getprops()
 
         # make the new node's property map
         d = {}
         retire = 0
+        texts = []
         if not "id" in propnames:
             newid = self.db.newid(self.classname)
         else:
@@ -2950,28 +3629,14 @@ class Class(hyperdb.Class):
                     raise TypeError('new property "%(propname)s" not a '
                         'string: %(value)r'%locals())
                 if prop.indexme:
-                    self.db.indexer.add_text((self.classname, newid, propname),
-                        value)
+                    texts.append(((self.classname, newid, propname), value,
+                        'text/plain'))
             d[propname] = value
 
         # get a new id if necessary
         if newid is None:
             newid = self.db.newid(self.classname)
-
-        # insert new node or update existing?
-        if not self.hasnode(newid):
-            self.db.addnode(self.classname, newid, d) # insert
-        else:
-            self.db.setnode(self.classname, newid, d) # update
-
-        # retire?
-        if retire:
-            # use the arg for __retired__ to cope with any odd database type
-            # conversion (hello, sqlite)
-            sql = 'update _%s set __retired__=%s where id=%s'%(self.classname,
-                self.db.arg, self.db.arg)
-            self.db.sql(sql, (newid, newid))
-        return newid
+        return newid, d, retire, texts
 
     def export_journals(self):
         """Export a class's journal - generate a list of lists of
@@ -3109,17 +3774,19 @@ class FileClass(hyperdb.FileClass, Class):
         self.fireReactors('set', itemid, oldvalues)
         return propvalues
 
-    def index(self, nodeid):
-        """ Add (or refresh) the node to search indexes.
+    def index_entries(self, nodeid):
+        """ Return the (identifier, text, mime_type) entries to put in the
+            search indexes for the node.
 
         Use the content-type property for the content property.
         """
+        entries = []
         # find all the String properties that have indexme
         for prop, propclass in self.getprops().iteritems():
             if prop == 'content' and propclass.indexme:
                 mime_type = self.get(nodeid, 'type', self.default_mime_type)
-                self.db.indexer.add_text((self.classname, nodeid, 'content'),
-                    str(self.get(nodeid, 'content')), mime_type)
+                entries.append(((self.classname, nodeid, 'content'),
+                    str(self.get(nodeid, 'content')), mime_type))
             elif isinstance(propclass, hyperdb.String) and propclass.indexme:
                 # index them under (classname, nodeid, property)
                 try:
@@ -3127,7 +3794,9 @@ class FileClass(hyperdb.FileClass, Class):
                 except IndexError:
                     # node has been destroyed
                     continue
-                self.db.indexer.add_text((self.classname, nodeid, prop), value)
+                entries.append(((self.classname, nodeid, prop), value,
+                    'text/plain'))
+        return entries
 
 # XXX deviation from spec - was called ItemClass
 class IssueClass(Class, roundupdb.IssueClass):
@@ -18,6 +18,10 @@ class BasicDatabase:
     ''' Provide a nice encapsulation of an anydbm store.
 
         Keys are id strings, values are automatically marshalled data.
+
+        Values read or written are cached until the next commit, so that
+        a request looking at the same session or key several times only
+        opens the store once.
     '''
     _db_type = None
     name = None
@@ -25,14 +29,28 @@ class BasicDatabase:
     def __init__(self, db):
         self.config = db.config
         self.dir = db.config.DATABASE
+        self.cache = {}
         os.umask(db.config.UMASK)
 
-    def exists(self, infoid):
+    def load(self, infoid):
+        """ Return the values stored under infoid, or None if there are
+            none.
+        """
+        if infoid in self.cache:
+            return self.cache[infoid]
         db = self.opendb('c')
         try:
-            return infoid in db
+            if infoid in db:
+                values = marshal.loads(db[infoid])
+            else:
+                values = None
         finally:
             db.close()
+        self.cache[infoid] = values
+        return values
+
+    def exists(self, infoid):
+        return self.load(infoid) is not None
 
     def clear(self):
         path = os.path.join(self.dir, self.name)
@@ -40,6 +58,7 @@ class BasicDatabase:
             os.remove(path)
         elif os.path.exists(path+'.db'):    # dbm appends .db
             os.remove(path+'.db')
+        self.cache = {}
 
     def cache_db_type(self, path):
         ''' determine which DB wrote the class file, and cache it as an
@@ -61,41 +80,40 @@ class BasicDatabase:
     _marker = []
 
     def get(self, infoid, value, default=_marker):
-        db = self.opendb('c')
-        try:
-            if infoid in db:
-                values = marshal.loads(db[infoid])
-            else:
-                if default != self._marker:
-                    return default
-                raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
-            return values.get(value, None)
-        finally:
-            db.close()
+        values = self.load(infoid)
+        if values is None:
+            if default != self._marker:
+                return default
+            raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
+        return values.get(value, None)
 
     def getall(self, infoid):
-        db = self.opendb('c')
-        try:
-            try:
-                d = marshal.loads(db[infoid])
-                del d['__timestamp']
-                return d
-            except KeyError:
-                raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
-        finally:
-            db.close()
+        values = self.load(infoid)
+        if values is None or '__timestamp' not in values:
+            raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
+        d = values.copy()
+        del d['__timestamp']
+        return d
 
     def set(self, infoid, **newvalues):
+        """ Store all newvalues under key infoid.
+
+            Nothing is written if the stored values already match.
+        """
+        old = self.load(infoid)
+        if old is not None:
+            values = old.copy()
+        else:
+            values = {'__timestamp': time.time()}
+        values.update(newvalues)
+        if values == old:
+            return
         db = self.opendb('c')
         try:
-            if infoid in db:
-                values = marshal.loads(db[infoid])
-            else:
-                values = {'__timestamp': time.time()}
-            values.update(newvalues)
             db[infoid] = marshal.dumps(values)
         finally:
             db.close()
+        self.cache[infoid] = values
 
     def list(self):
         db = self.opendb('r')
@@ -111,6 +129,7 @@ class BasicDatabase:
                 del db[infoid]
         finally:
             db.close()
+        self.cache[infoid] = None
 
     def opendb(self, mode):
         '''Low-level database opener that gets around anydbm/dbm
@@ -132,7 +151,7 @@ class BasicDatabase:
         return dbm.open(path, mode)
 
     def commit(self):
-        pass
+        self.cache = {}
 
     def close(self):
         pass
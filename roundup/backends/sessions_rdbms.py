@@ -5,49 +5,80 @@ Yes, it's called "sessions" - because originally it only defined a session
 class. It's now also used for One Time Key handling too.
 """
 __docformat__ = 'restructuredtext'
-import os, time, logging
+import os, time, logging, marshal, binascii, ast
 from cgi import escape
 
+def dumps(values):
+    """ Encode a dict of session values for the TEXT value column.
+
+        Values are marshalled and base64 encoded, so they can be read back
+        without evaluating any code.
+    """
+    return binascii.b2a_base64(marshal.dumps(values, 2)).strip()
+
+def loads(data):
+    """ Decode a value column written by dumps().
+
+        Rows written by older versions of Roundup hold the repr() of the
+        values dict, which is decoded with ast.literal_eval.
+    """
+    if data.startswith('{'):
+        return ast.literal_eval(data)
+    return marshal.loads(binascii.a2b_base64(data))
+
 class BasicDatabase:
     ''' Provide a nice encapsulation of an RDBMS table.
 
         Keys are id strings, values are automatically marshalled data.
+
+        Values read or written are cached until the next commit, so that
+        a request looking at the same session or key several times only
+        reads it from the database once.
     '''
     name = None
     def __init__(self, db):
         self.db = db
-        self.conn, self.cursor = self.db.sql_open_connection()
+        self.conn, self.cursor = self.db.sql_get_connection()
+        self.cache = {}
 
     def clear(self):
         self.cursor.execute('delete from %ss'%self.name)
+        self.cache = {}
 
-    def exists(self, infoid):
-        n = self.name
-        self.cursor.execute('select count(*) from %ss where %s_key=%s'%(n,
-            n, self.db.arg), (infoid,))
-        return int(self.cursor.fetchone()[0])
-
-    _marker = []
-    def get(self, infoid, value, default=_marker):
+    def load(self, infoid):
+        """ Return the values stored under infoid, or None if there are
+            none.
+        """
+        if infoid in self.cache:
+            return self.cache[infoid]
         n = self.name
         self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
             n, n, self.db.arg), (infoid,))
         res = self.cursor.fetchone()
-        if not res:
+        if res:
+            values = loads(res[0])
+        else:
+            values = None
+        self.cache[infoid] = values
+        return values
+
+    def exists(self, infoid):
+        return self.load(infoid) is not None
+
+    _marker = []
+    def get(self, infoid, value, default=_marker):
+        values = self.load(infoid)
+        if values is None:
             if default != self._marker:
                 return default
             raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
-        values = eval(res[0])
         return values.get(value, None)
 
     def getall(self, infoid):
-        n = self.name
-        self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
-            n, n, self.db.arg), (infoid,))
-        res = self.cursor.fetchone()
-        if not res:
+        values = self.load(infoid)
+        if values is None:
             raise KeyError('No such %s "%s"'%(self.name, escape (infoid)))
-        return eval(res[0])
+        return values.copy()
 
     def set(self, infoid, **newvalues):
         """ Store all newvalues under key infoid with a timestamp in database.
@@ -55,24 +86,22 @@ class BasicDatabase:
             If newvalues['__timestamp'] exists and is representable as a floating point number
             (i.e. could be generated by time.time()), that value is used for the <name>_time
             column in the database.
+
+            Nothing is written if the stored values already match.
         """
-        c = self.cursor
         n = self.name
         a = self.db.arg
-        c.execute('select %s_value from %ss where %s_key=%s'%(n, n, n, a),
-            (infoid,))
-        res = c.fetchone()
-        if res:
-            values = eval(res[0])
-        else:
-            values = {}
-        values.update(newvalues)
-
-        if res:
+        old = self.load(infoid)
+        if old is not None:
+            values = old.copy()
+            values.update(newvalues)
+            if values == old:
+                return
             sql = 'update %ss set %s_value=%s where %s_key=%s'%(n, n,
                 a, n, a)
-            args = (repr(values), infoid)
+            args = (dumps(values), infoid)
         else:
+            values = newvalues
             if '__timestamp' in newvalues:
                 try:
                     # __timestamp must be represntable as a float. Check it.
@@ -84,8 +113,9 @@ class BasicDatabase:
 
             sql = 'insert into %ss (%s_key, %s_time, %s_value) '\
                 'values (%s, %s, %s)'%(n, n, n, n, a, a, a)
-            args = (infoid, timestamp, repr(values))
-        c.execute(sql, args)
+            args = (infoid, timestamp, dumps(values))
+        self.cursor.execute(sql, args)
+        self.cache[infoid] = values
 
     def list(self):
         c = self.cursor
@@ -96,6 +126,7 @@ class BasicDatabase:
     def destroy(self, infoid):
         self.cursor.execute('delete from %ss where %s_key=%s'%(self.name,
             self.name, self.db.arg), (infoid,))
+        self.cache[infoid] = None
 
     def updateTimestamp(self, infoid):
         """ don't update every hit - once a minute should be OK """
@@ -112,15 +143,19 @@ class BasicDatabase:
         old = now - week
         self.cursor.execute('delete from %ss where %s_time < %s'%(self.name,
             self.name, self.db.arg), (old, ))
+        self.cache = {}
 
     def commit(self):
         logger = logging.getLogger('roundup.hyperdb.backend')
         logger.info('commit %s' % self.name)
         self.conn.commit()
         self.cursor = self.conn.cursor()
+        self.cache = {}
 
     def close(self):
-        self.conn.close()
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.db.sql_release_connection(conn)
 
 class Sessions(BasicDatabase):
     name = 'session'
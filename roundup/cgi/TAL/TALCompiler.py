@@ -0,0 +1,376 @@
+"""
+Compile a TAL program into Python code.
+
+The TALInterpreter walks the opcode program produced by the TALGenerator
+for every render. CompiledInterpreter instead turns each program into a
+Python function once, so that rendering runs straight-line code: text is
+written, conditions and loops are evaluated and nested blocks are run
+inline, without dispatching on every opcode.
+
+The generated code runs against the interpreter and calls its handler
+methods for the rarer opcodes (macros, slots, i18n, on-error and tags
+with dynamic attributes), so the semantics are those of TALInterpreter.
+Only programs interpreted with tal=1 are compiled.
+
+The compiled code objects of a template can be cached in a file; the
+cache is keyed by a hash of the generated source, so it never goes
+stale.
+"""
+
+import imp, marshal, os
+from cgi import escape
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from TALInterpreter import TALInterpreter, ustr
+
+# the most nested loops and indentation levels put into one function;
+# deeper blocks are compiled into functions of their own
+MAX_LOOPS = 10
+MAX_INDENT = 40
+
+# header of the code cache files
+CACHE_MAGIC = imp.get_magic() + 'TALC1\n'
+
+# the attribute actions that output nothing when tal=1
+SILENT_ACTIONS = ('metal', 'tal', 'xmlns', 'i18n')
+
+class ProgramCompiler:
+    """ Generate the Python source of a module with one function per
+        program, "p0" for the program compiled and "p1"... for the
+        programs that are run through the interpreter's handlers.
+    """
+    def __init__(self, program):
+        # the arguments the generated code refers to as A[n]
+        self.args = []
+        # the programs compiled into functions, in order
+        self.programs = []
+        self.program_ids = {}
+        self.counter = 0
+        self.lines = []
+        self.queue(program)
+        i = 0
+        while i < len(self.programs):
+            self.function(i)
+            i += 1
+
+    def source(self):
+        return '\n'.join(self.lines) + '\n'
+
+    def queue(self, program):
+        """ Return the name of the function compiled for program. """
+        i = self.program_ids.get(id(program))
+        if i is None:
+            i = self.program_ids[id(program)] = len(self.programs)
+            self.programs.append(program)
+        return 'p%d'%i
+
+    def const(self, value):
+        self.args.append(value)
+        return 'A[%d]'%(len(self.args) - 1)
+
+    def name(self, prefix):
+        self.counter += 1
+        return '%s%d'%(prefix, self.counter)
+
+    def emit(self, indent, line):
+        self.lines.append('    '*indent + line)
+
+    def function(self, i):
+        self.emit(0, 'def p%d(self, A=A, H=H, escape=escape, ustr=ustr):'%i)
+        self.emit(1, 'engine = self.engine')
+        self.emit(1, 'write = self._stream_write')
+        self.emit(1, 'Default = self.Default')
+        self.block(self.programs[i], 1, 0)
+        self.emit(0, '')
+
+    def block(self, program, indent, loops):
+        """ Generate the code running program at the indent level. """
+        if indent > MAX_INDENT or loops > MAX_LOOPS:
+            self.queue(program)
+            self.emit(indent, 'self.interpret(%s)'%self.const(program))
+            return
+        start = len(self.lines)
+        for opcode, args in program:
+            method = getattr(self, 'op_' + opcode, None)
+            if method is None:
+                self.handler(opcode, args, indent)
+            else:
+                method(args, indent, loops)
+        if len(self.lines) == start:
+            self.emit(indent, 'pass')
+
+    def handler(self, opcode, args, indent):
+        """ Run the opcode through the interpreter's handler. """
+        for program in subprograms(opcode, args):
+            self.queue(program)
+        self.emit(indent, 'H[%r](self, %s)'%(opcode, self.const(args)))
+
+    def write(self, s, indent):
+        """ Write the constant text s, keeping the column up to date. """
+        self.emit(indent, 'write(%r)'%s)
+        i = s.rfind('\n')
+        if i < 0:
+            self.emit(indent, 'self.col = self.col + %d'%len(s))
+        else:
+            self.emit(indent, 'self.col = %d'%(len(s) - (i + 1)))
+
+    def op_rawtextColumn(self, (s, col), indent, loops):
+        self.emit(indent, 'write(%r)'%s)
+        self.emit(indent, 'self.col = %d'%col)
+
+    def op_rawtextOffset(self, (s, offset), indent, loops):
+        self.emit(indent, 'write(%r)'%s)
+        self.emit(indent, 'self.col = self.col + %d'%offset)
+
+    def op_setPosition(self, position, indent, loops):
+        self.emit(indent, 'self.position = %r'%(position,))
+        self.emit(indent, 'engine.setPosition(self.position)')
+
+    def op_rawtextBeginScope(self, (s, col, position, closeprev, dict),
+            indent, loops):
+        self.op_rawtextColumn((s, col), indent, loops)
+        self.op_setPosition(position, indent, loops)
+        if closeprev:
+            self.emit(indent, 'engine.endScope()')
+            self.emit(indent, 'engine.beginScope()')
+        else:
+            self.emit(indent, 'engine.beginScope()')
+            self.emit(indent, 'self.scopeLevel = self.scopeLevel + 1')
+        self.emit(indent, 'engine.setLocal("attrs", %s)'%self.const(dict))
+
+    def op_beginScope(self, dict, indent, loops):
+        self.emit(indent, 'engine.beginScope()')
+        self.emit(indent, 'engine.setLocal("attrs", %s)'%self.const(dict))
+        self.emit(indent, 'self.scopeLevel = self.scopeLevel + 1')
+
+    def op_endScope(self, args, indent, loops):
+        self.emit(indent, 'engine.endScope()')
+        self.emit(indent, 'self.scopeLevel = self.scopeLevel - 1')
+
+    def op_setLocal(self, (name, expr), indent, loops):
+        self.emit(indent, 'engine.setLocal(%r, engine.evaluateValue(%s))'%(
+            name, self.const(expr)))
+
+    def op_setGlobal(self, (name, expr), indent, loops):
+        self.emit(indent, 'engine.setGlobal(%r, engine.evaluateValue(%s))'%(
+            name, self.const(expr)))
+
+    def op_insertText(self, (expr, block), indent, loops):
+        v = self.name('v')
+        self.emit(indent, '%s = engine.evaluateText(%s)'%(v, self.const(expr)))
+        self.emit(indent, 'if %s is Default:'%v)
+        self.block(block, indent + 1, loops)
+        self.emit(indent, 'elif %s is not None:'%v)
+        self.emit(indent + 1, 's = escape(%s)'%v)
+        self.emit(indent + 1, 'write(s)')
+        self.emit(indent + 1, 'i = s.rfind("\\n")')
+        self.emit(indent + 1, 'if i < 0:')
+        self.emit(indent + 2, 'self.col = self.col + len(s)')
+        self.emit(indent + 1, 'else:')
+        self.emit(indent + 2, 'self.col = len(s) - (i + 1)')
+
+    def op_insertStructure(self, (expr, repldict, block), indent, loops):
+        v = self.name('v')
+        self.emit(indent, '%s = engine.evaluateStructure(%s)'%(v,
+            self.const(expr)))
+        self.emit(indent, 'if %s is Default:'%v)
+        self.block(block, indent + 1, loops)
+        self.emit(indent, 'elif %s is not None:'%v)
+        if repldict:
+            self.emit(indent + 1, 'self.insertStructureText(%s, %s)'%(v,
+                self.const(repldict)))
+        else:
+            self.emit(indent + 1, 'self.insertStructureText(%s, {})'%v)
+
+    def op_condition(self, (condition, block), indent, loops):
+        self.emit(indent, 'if engine.evaluateBoolean(%s):'%
+            self.const(condition))
+        self.block(block, indent + 1, loops)
+
+    def op_loop(self, (name, expr, block), indent, loops):
+        it = self.name('it')
+        self.emit(indent, '%s = engine.setRepeat(%r, %s)'%(it, name,
+            self.const(expr)))
+        self.emit(indent, 'while %s.next():'%it)
+        self.block(block, indent + 1, loops + 1)
+
+    def op_startTag(self, args, indent, loops):
+        self.emit(indent, 'self.do_startTag(%s)'%self.const(args))
+
+    def op_startEndTag(self, args, indent, loops):
+        self.emit(indent, 'self.do_startEndTag(%s)'%self.const(args))
+
+    def op_optTag(self, args, indent, loops):
+        name, cexpr, tag_ns, isend, start, program = args
+        if tag_ns or cexpr == '':
+            # the tag is always omitted
+            if cexpr:
+                self.emit(indent, 'engine.evaluateBoolean(%s)'%
+                    self.const(cexpr))
+            self.no_tag(start, indent, loops)
+            self.block(program, indent, loops)
+            return
+        if cexpr is None:
+            self.block(start, indent, loops)
+            if not isend:
+                self.block(program, indent, loops)
+                self.write('</%s>'%name, indent)
+            return
+        omit = self.name('omit')
+        self.emit(indent, '%s = engine.evaluateBoolean(%s)'%(omit,
+            self.const(cexpr)))
+        self.emit(indent, 'if %s:'%omit)
+        self.no_tag(start, indent + 1, loops)
+        if isend:
+            self.block(program, indent + 1, loops)
+        self.emit(indent, 'else:')
+        self.block(start, indent + 1, loops)
+        if not isend:
+            self.block(program, indent, loops)
+            self.emit(indent, 'if not %s:'%omit)
+            self.write('</%s>'%name, indent + 1)
+
+    def no_tag(self, start, indent, loops):
+        """ Run the start of an omitted tag for its side effects only. """
+        for opcode, args in start:
+            if opcode in ('rawtextColumn', 'rawtextOffset'):
+                continue
+            if opcode in ('startTag', 'startEndTag'):
+                for item in args[1]:
+                    if len(item) > 2 and item[2] not in SILENT_ACTIONS:
+                        break
+                else:
+                    continue
+            # the start tag evaluates expressions, run it with its
+            # output thrown away
+            self.queue(start)
+            self.emit(indent, 'self.discard(%s)'%self.const(start))
+            return
+        self.emit(indent, 'pass')
+
+def subprograms(opcode, args):
+    """ Return the programs the handler of the opcode may interpret. """
+    if opcode == 'optTag':
+        return [args[4], args[5]]
+    if opcode in ('defineMacro', 'fillSlot', 'defineSlot'):
+        return [args[1]]
+    if opcode == 'useMacro':
+        return [args[3]] + args[2].values()
+    if opcode == 'onError':
+        return [args[0], args[1]]
+    if opcode in ('insertText', 'loop', 'condition', 'insertStructure'):
+        return [args[-1]]
+    if opcode in ('i18nVariable', 'insertTranslation'):
+        return [args[1]]
+    return []
+
+def compile_program(program, functions, filename='<template>',
+        cache_file=None):
+    """ Compile the program and the programs run by it, adding
+        {id(program): (program, function)} to functions.
+
+        If cache_file is given, the compiled code is read from it if it
+        was generated from the same source, or written to it.
+    """
+    compiler = ProgramCompiler(program)
+    source = compiler.source()
+    key = sha1(source).hexdigest() + '\n'
+    code = None
+    if cache_file:
+        code = read_cache(cache_file, key)
+    if code is None:
+        code = compile(source, filename, 'exec')
+        if cache_file:
+            write_cache(cache_file, key, code)
+    namespace = {'A': compiler.args, 'H': TALInterpreter.bytecode_handlers_tal,
+        'escape': escape, 'ustr': ustr}
+    exec code in namespace
+    for i, program in enumerate(compiler.programs):
+        functions[id(program)] = (program, namespace['p%d'%i])
+
+def read_cache(cache_file, key):
+    """ Return the code object in the cache file if it has the key. """
+    try:
+        f = open(cache_file, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        if f.read(len(key)) != key:
+            return None
+        try:
+            return marshal.loads(f.read())
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        f.close()
+
+def write_cache(cache_file, key, code):
+    """ Write the code object to the cache file, if possible. """
+    tmp = '%s.%d'%(cache_file, os.getpid())
+    try:
+        f = open(tmp, 'wb')
+        try:
+            f.write(CACHE_MAGIC + key + marshal.dumps(code))
+        finally:
+            f.close()
+        os.rename(tmp, cache_file)
+    except (IOError, OSError):
+        # the cache is optional, e.g. the template directory may be
+        # read-only
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+class CompiledInterpreter(TALInterpreter):
+    """ A TALInterpreter running programs compiled into Python functions.
+
+        "functions" maps id(program) to (program, function) as filled in
+        by compile_program(). Programs not found in it, like those made
+        for inserted structures or macros of templates that weren't
+        compiled, are interpreted.
+    """
+    def __init__(self, program, macros, engine, stream=None, functions=None,
+            **kw):
+        TALInterpreter.__init__(self, program, macros, engine, stream, **kw)
+        if functions is None:
+            functions = {}
+        self.functions = functions
+
+    def interpret(self, program):
+        if self.debug or not self.tal:
+            return TALInterpreter.interpret(self, program)
+        entry = self.functions.get(id(program))
+        if entry is None or entry[0] is not program:
+            return TALInterpreter.interpret(self, program)
+        oldlevel = self.level
+        self.level = oldlevel + 1
+        try:
+            entry[1](self)
+        finally:
+            self.level = oldlevel
+
+    def discard(self, program):
+        """ Run the program, throwing its output away. """
+        state = self.saveState()
+        self.stream = stream = self.StringIO()
+        self._stream_write = stream.write
+        self.interpret(program)
+        self.restoreOutputState(state)
+
+    def insertStructureText(self, structure, repldict):
+        """ Insert a structure the way do_insertStructure_tal does. """
+        text = ustr(structure)
+        if not (repldict or self.strictinsert):
+            # Take a shortcut, no error checking
+            self.stream_write(text)
+        elif self.html:
+            self.insertHTMLStructure(text, repldict)
+        else:
+            self.insertXMLStructure(text, repldict)
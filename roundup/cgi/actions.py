@@ -1280,7 +1280,13 @@ class LoginAction(Action):
         '''
         db = self.db
         stored = db.user.get(userid, 'password')
-        if givenpw == stored:
+        threads = db.config.WEB_PASSWORD_VERIFY_THREADS
+        cache_time = db.config.WEB_PASSWORD_CACHE_TIME
+        if threads or cache_time:
+            verify = password.get_verifier(threads, cache_time).verify
+        else:
+            verify = lambda stored, givenpw: stored == givenpw
+        if stored is not None and verify(stored, givenpw):
             if db.config.WEB_MIGRATE_PASSWORDS and stored.needs_migration():
                 newpw = password.Password(givenpw, config=db.config)
                 db.user.set(userid, password=newpw)
@@ -1294,6 +1300,10 @@ class ExportCSVAction(Action):
     name = 'export'
     permissionType = 'View'
 
+    # number of items fetched and written at a time, small enough for
+    # the items to stay in the node cache until their row is written
+    batch_size = 50
+
     def handle(self):
         ''' Export the specified search query as CSV. '''
         # figure the request
@@ -1316,10 +1326,26 @@ class ExportCSVAction(Action):
                     self._('Column "%(column)s" not found in %(class)s')
                     % {'column': cgi.escape(cname), 'class': request.classname})
 
-        # full-text search
+        # find the columns the user may view on every item, and those
+        # that are subject to a check function for each item
+        security = self.db.security
+        roles = security.get_user_roles(self.client.userid)
+        checked = []
+        for name in columns:
+            granted, checks = security.compile(roles, 'View',
+                request.classname, name)
+            if granted:
+                continue
+            if not checks:
+                raise exceptions.Unauthorised(self._(
+                    'You do not have permission to view %(class)s'
+                ) % {'class': request.classname})
+            checked.append(name)
+
+        # full-text search, all of the matches are exported
         if request.search_text:
-            matches = self.db.indexer.search(
-                re.findall(r'\b\w{2,25}\b', request.search_text), klass)
+            matches = dict(self.db.indexer.query(request.search_text,
+                klass))
         else:
             matches = None
 
@@ -1342,20 +1368,89 @@ class ExportCSVAction(Action):
         writer = csv.writer(wfile)
         self.client._socket_op(writer.writerow, columns)
 
-        # and search
-        for itemid in klass.filter(matches, filterspec, sort, group):
-            row = []
-            for name in columns:
-                # check permission to view this property on this item
+        # and search, writing the rows a batch at a time, the best
+        # full-text matches first unless sorted otherwise
+        if matches is not None and not sort and not group:
+            itemids = klass.filter(matches, filterspec)
+            itemids.sort(key=lambda id: (-matches[id], int(id)))
+        else:
+            itemids = klass.filter_iter(matches, filterspec, sort, group)
+        batch = []
+        for itemid in itemids:
+            batch.append(itemid)
+            if len(batch) == self.batch_size:
+                self.write_rows(writer, wfile, klass, columns, checked, batch)
+                batch = []
+        if batch:
+            self.write_rows(writer, wfile, klass, columns, checked, batch)
+
+        return '\n'
+
+    def write_rows(self, writer, wfile, klass, columns, checked, itemids):
+        ''' Write the rows for the items, rendering Link and Multilink
+            values as the labels of the linked items.
+        '''
+        props = klass.getprops()
+        klass.getnodes(itemids, columns)
+
+        for itemid in itemids:
+            # check permission to view these properties on this item
+            for name in checked:
                 if not self.hasPermission('View', itemid=itemid,
-                        classname=request.classname, property=name):
+                        classname=klass.classname, property=name):
                     raise exceptions.Unauthorised(self._(
                         'You do not have permission to view %(class)s'
-                    ) % {'class': request.classname})
-                row.append(str(klass.get(itemid, name)))
-            self.client._socket_op(writer.writerow, row)
-
-        return '\n'
+                    ) % {'class': klass.classname})
+        values = [[klass.get(itemid, name) for name in columns]
+            for itemid in itemids]
+
+        # look up the labels of the linked items, a class at a time
+        labels = {}
+        for i, name in enumerate(columns):
+            prop = props[name]
+            if not isinstance(prop, (hyperdb.Link, hyperdb.Multilink)):
+                continue
+            linkids = labels.setdefault(prop.classname, {})
+            for row in values:
+                if isinstance(prop, hyperdb.Link):
+                    if row[i] is not None:
+                        linkids[row[i]] = None
+                else:
+                    for linkid in row[i]:
+                        linkids[linkid] = None
+        for classname, linkids in labels.iteritems():
+            linkcl = self.db.getclass(classname)
+            labelprop = linkcl.labelprop(default_to_id=1)
+            try:
+                linkcl.getnodes(list(linkids), [])
+            except IndexError:
+                # some of the items no longer exist, they are looked up
+                # one at a time
+                pass
+            for linkid in linkids:
+                try:
+                    linkids[linkid] = str(linkcl.get(linkid, labelprop))
+                except IndexError:
+                    linkids[linkid] = linkid
+
+        rows = []
+        for row in values:
+            for i, name in enumerate(columns):
+                prop = props[name]
+                if isinstance(prop, hyperdb.Link):
+                    if row[i] is None:
+                        row[i] = ''
+                    else:
+                        row[i] = labels[prop.classname][row[i]]
+                elif isinstance(prop, hyperdb.Multilink):
+                    row[i] = ';'.join([labels[prop.classname][linkid]
+                        for linkid in row[i]])
+                else:
+                    row[i] = str(row[i])
+            rows.append(row)
+        self.client._socket_op(writer.writerows, rows)
+        if hasattr(wfile, 'flush'):
+            self.client._socket_op(wfile.flush)
 
 
 class Bridge(BaseAction):
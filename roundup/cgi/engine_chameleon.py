@@ -8,12 +8,12 @@ import chameleon
 from roundup.cgi.templating import StringIO, context, TALLoaderBase
 
 class Loader(TALLoaderBase):
-    def __init__(self, dir):
-        self.dir = dir
-        self.loader = chameleon.PageTemplateLoader(dir)
+    def __init__(self, dir, **kw):
+        self.loader = chameleon.PageTemplateLoader(dir,
+            auto_reload=kw.get('cache') != 'frozen')
+        TALLoaderBase.__init__(self, dir, **kw)
 
-    def load(self, tplname):
-        src, filename = self._find(tplname)
+    def compile(self, src, filename):
         return RoundupPageTemplate(self.loader.load(src))
 
 class RoundupPageTemplate(object):
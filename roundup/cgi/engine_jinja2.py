@@ -41,7 +41,7 @@ from types import MethodType
 from roundup.cgi.templating import context, LoaderBase, TemplateBase
 
 class Jinja2Loader(LoaderBase):
-    def __init__(self, dir):
+    def __init__(self, dir, cache='check', poll_interval=10):
         extensions = [
             'jinja2.ext.autoescape',
         ]
@@ -49,7 +49,8 @@ class Jinja2Loader(LoaderBase):
         print "Extensions: ", extensions
         self._env = jinja2.Environment(
                         loader=jinja2.FileSystemLoader(dir),
-                        extensions=extensions
+                        extensions=extensions,
+                        auto_reload=(cache != 'frozen')
                     )
 
         # Adding a custom filter that can transform roundup's vars to unicode
@@ -3,65 +3,68 @@ Zope.
 """
 __docformat__ = 'restructuredtext'
 
-import errno
 import mimetypes
-import os
-import os.path
 
 from roundup.cgi.templating import StringIO, context, translationService, TALLoaderBase
 from roundup.cgi.PageTemplates import PageTemplate, GlobalTranslationService
 from roundup.cgi.PageTemplates.Expressions import getEngine
-from roundup.cgi.TAL import TALInterpreter
+from roundup.cgi.TAL import TALInterpreter, TALCompiler
 
 GlobalTranslationService.setGlobalTranslationService(translationService)
 
 class Loader(TALLoaderBase):
-    templates = {}
-
-    def __init__(self, dir):
-        self.dir = dir
-
-    def load(self, tplname):
-        # find the source
-        src, filename = self._find(tplname)
-
-        # has it changed?
-        try:
-            stime = os.stat(src)[os.path.stat.ST_MTIME]
-        except os.error as error:
-            if error.errno != errno.ENOENT:
-                raise
-
-        if self.templates.has_key(src) and \
-                stime <= self.templates[src].mtime:
-            # compiled template is up to date
-            return self.templates[src]
-
-        # compile the template
+    # the functions compiled for the templates of all compiling loaders,
+    # see below
+    functions_compiled = {}
+    # {src: ids of the programs of the template in functions_compiled},
+    # so that they are replaced when the template is compiled again
+    programs_compiled = {}
+
+    def __init__(self, dir, compiled=False, **kw):
+        # with "compiled" set the templates are turned into Python code,
+        # see TAL.TALCompiler; this maps id(program) to the functions
+        # compiled for the templates. It's shared by the loaders, which
+        # share their compiled templates, so that macros used from
+        # templates compiled by another loader are found.
+        self.functions = None
+        if compiled:
+            self.functions = self.functions_compiled
+        TALLoaderBase.__init__(self, dir, **kw)
+
+    def cache_key(self, src):
+        return (self.__class__, self.functions is not None, src)
+
+    def compile(self, src, filename):
         pt = RoundupPageTemplate()
         # use pt_edit so we can pass the content_type guess too
         content_type = mimetypes.guess_type(filename)[0] or 'text/html'
         pt.pt_edit(open(src).read(), content_type)
         pt.id = filename
-        pt.mtime = stime
-        # Add it to the cache.  We cannot do this until the template
-        # is fully initialized, as we could otherwise have a race
-        # condition when running with multiple threads:
-        #
-        # 1. Thread A notices the template is not in the cache,
-        #    adds it, but has not yet set "mtime".
-        #
-        # 2. Thread B notices the template is in the cache, checks
-        #    "mtime" (above) and crashes.
-        #
-        # Since Python dictionary access is atomic, as long as we
-        # insert "pt" only after it is fully initialized, we avoid
-        # this race condition.  It's possible that two separate
-        # threads will both do the work of initializing the template,
-        # but the risk of wasted work is offset by avoiding a lock.
-        self.templates[src] = pt
+        if self.functions is not None:
+            pt._cook()
+            if not pt._v_errors:
+                # the code is cached next to the template
+                functions = {}
+                TALCompiler.compile_program(pt._v_program, functions,
+                    src, src + '.talc')
+                self.add_functions(src, functions)
+                pt.functions = self.functions
         return pt
 
+    def add_functions(self, src, functions):
+        """ Add the functions compiled for the template "src" and drop
+            those compiled for it before, which an edited template would
+            otherwise keep alive with their programs.
+
+            Templates still using the old programs interpret them.
+        """
+        old = self.programs_compiled.get(src, ())
+        self.functions.update(functions)
+        self.programs_compiled[src] = functions.keys()
+        for key in old:
+            if key not in functions:
+                self.functions.pop(key, None)
+
 class RoundupPageTemplate(PageTemplate.PageTemplate):
     """A Roundup-specific PageTemplate.
 
@@ -70,6 +73,10 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
 
     """
 
+    # the compiled functions of the templates, None if the template is
+    # interpreted
+    functions = None
+
     def render(self, client, classname, request, **options):
         """Render this Page Template"""
 
@@ -88,7 +95,12 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
 
         # and go
         output = StringIO.StringIO()
-        TALInterpreter.TALInterpreter(self._v_program, self.macros,
-            getEngine().getContext(c), output, tal=1, strictinsert=0)()
+        if self.functions is None:
+            TALInterpreter.TALInterpreter(self._v_program, self.macros,
+                getEngine().getContext(c), output, tal=1, strictinsert=0)()
+        else:
+            TALCompiler.CompiledInterpreter(self._v_program, self.macros,
+                getEngine().getContext(c), output, functions=self.functions,
+                tal=1, strictinsert=0)()
         return output.getvalue()
 
@@ -20,7 +20,7 @@ todo = """
 __docformat__ = 'restructuredtext'
 
 
-import cgi, urllib, re, os.path, mimetypes, csv, string
+import cgi, urllib, re, os.path, mimetypes, csv, string, errno
 import calendar
 import textwrap
 import time, hashlib
@@ -156,44 +156,167 @@ class LoaderBase:
         raise NotImplementedError
 
 class TALLoaderBase(LoaderBase):
-    """ Common methods for the legacy TAL loaders."""
+    """ Common methods for the legacy TAL loaders.
+
+        The template directory is scanned once into a registry mapping
+        template names to files, and compiled templates are kept until
+        their file changes. How changes are noticed depends on "cache":
+
+        check
+            the directories are checked for added or removed templates
+            on every lookup, and a template's file is checked every time
+            it is loaded
+        poll
+            the same checks are made at most every "poll_interval"
+            seconds
+        frozen
+            all templates are compiled when the loader is created and the
+            filesystem is never looked at again
+
+        The registries and compiled templates are also kept for the
+        whole process, so that a loader created when a tracker is opened
+        again reuses those of the files that didn't change.
+    """
+    # file extensions tried for a template name, in order of preference
+    extensions = ('', '.html', '.xml')
 
-    def __init__(self, dir):
+    # {realpath of dir: (dirs, names)}
+    registries = {}
+    # {cache_key(src): (mtime, template)}
+    templates = {}
+
+    def __init__(self, dir, cache='check', poll_interval=10):
         self.dir = dir
+        self.cache = cache
+        self.poll_interval = poll_interval
+        # {src: (mtime, template)}
+        self.compiled = {}
+        self.scan(reuse=True)
+        if cache == 'frozen':
+            self.precompile()
+
+    def cache_key(self, src):
+        """ Return the key of the template compiled from the file "src"
+            in the process-wide cache.
+        """
+        return (self.__class__, src)
+
+    def compile(self, src, filename):
+        """ Compile the template in the file "src", returning a template
+            object with a render() method.
+        """
+        raise NotImplementedError
+
+    def scan(self, reuse=False):
+        """ Build the registry of the templates in the load directory.
+
+            With "reuse" set, the registry built by another loader of
+            the directory is used if none of its directories changed.
+        """
+        realsrc = os.path.realpath(self.dir)
+        if reuse and realsrc in self.registries:
+            dirs, names = self.registries[realsrc]
+            for dirpath, mtime in dirs.iteritems():
+                if self.mtime(dirpath) != mtime:
+                    break
+            else:
+                self.dirs, self.names = dirs, names
+                self.checked = time.time()
+                return
+        names = {}
+        dirs = {}
+        for dirpath, dirnames, filenames in os.walk(realsrc):
+            dirs[dirpath] = os.stat(dirpath).st_mtime
+            for f in filenames:
+                src = os.path.join(dirpath, f)
+                if not os.path.realpath(src).startswith(realsrc):
+                    # a link out of the template directory
+                    continue
+                f = src[len(realsrc):].lstrip(os.sep).replace(os.sep, '/')
+                for rank, extension in enumerate(self.extensions):
+                    if not f.endswith(extension):
+                        continue
+                    name = f[:len(f) - len(extension)]
+                    if name not in names or names[name][0] > rank:
+                        names[name] = (rank, src, f)
+        self.names = dict([(name, (src, f))
+            for name, (rank, src, f) in names.iteritems()])
+        self.dirs = dirs
+        self.checked = time.time()
+        self.registries[realsrc] = (dirs, self.names)
+
+    def refresh(self):
+        """ Rescan the load directory if templates were added or removed,
+            and in "poll" mode drop the compiled templates whose file
+            changed.
+        """
+        if self.cache == 'frozen':
+            return
+        if self.cache == 'poll':
+            if time.time() - self.checked < self.poll_interval:
+                return
+            for src, (mtime, pt) in self.compiled.items():
+                if self.mtime(src) != mtime:
+                    del self.compiled[src]
+        for dirpath, mtime in self.dirs.iteritems():
+            if self.mtime(dirpath) != mtime:
+                self.scan()
+                return
+        self.checked = time.time()
+
+    def mtime(self, path):
+        """ Return the modification time of the file, None if it's gone.
+        """
+        try:
+            return os.stat(path).st_mtime
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
 
     def _find(self, name):
         """ Find template, return full path and filename of the
             template if it is found, None otherwise."""
-        realsrc = os.path.realpath(self.dir)
-        for extension in ['', '.html', '.xml']:
-            f = name + extension
-            src = os.path.join(realsrc, f)
-            realpath = os.path.realpath(src)
-            if string.find(realpath, realsrc) != 0:
-                return # will raise invalid template
-            if os.path.exists(src):
-                return (src, f)
+        self.refresh()
+        return self.names.get(name)
 
     def check(self, name):
         return bool(self._find(name))
 
-    def precompile(self):
-        """ Precompile templates in load directory by loading them """
-        for filename in os.listdir(self.dir):
-            # skip subdirs
-            if os.path.isdir(filename):
-                continue
-
-            # skip files without ".html" or ".xml" extension - .css, .js etc.
-            for extension in '.html', '.xml':
-                if filename.endswith(extension):
-                    break
-            else:
-                continue
+    def load(self, tplname):
+        found = self._find(tplname)
+        if found is None:
+            raise NoTemplate('Template "%s" doesn\'t exist'%tplname)
+        src, filename = found
+        if src in self.compiled:
+            mtime, pt = self.compiled[src]
+            if self.cache != 'check' or self.mtime(src) == mtime:
+                # compiled template is up to date
+                return pt
+        mtime = self.mtime(src)
+        key = self.cache_key(src)
+        cached = self.templates.get(key)
+        if cached is not None and cached[0] == mtime:
+            # compiled by another loader
+            pt = cached[1]
+        else:
+            pt = self.compile(src, filename)
+        # Add it to the cache.  We cannot do this until the template
+        # is fully compiled, as we could otherwise have a race
+        # condition when running with multiple threads.  Since Python
+        # dictionary access is atomic, as long as we insert "pt" only
+        # after it is fully initialized, we avoid this race condition.
+        # It's possible that two separate threads will both do the work
+        # of compiling the template, but the risk of wasted work is
+        # offset by avoiding a lock.
+        self.compiled[src] = (mtime, pt)
+        self.templates[key] = (mtime, pt)
+        return pt
 
-            # remove extension
-            filename = filename[:-len(extension)]
-            self.load(filename)
+    def precompile(self):
+        """ Precompile the .html and .xml templates in the registry """
+        for name, (src, filename) in self.names.items():
+            if name != filename:
+                self.load(name)
 
     def __getitem__(self, name):
         """Special method to access templates by loader['name']"""
@@ -218,6 +341,11 @@ class MultiLoader(LoaderBase):
         for l in self.loaders:
             if l.check(name):
                 return l.load(name)
+        raise NoTemplate('Template "%s" doesn\'t exist'%name)
+
+    def precompile(self):
+        for l in self.loaders:
+            l.precompile()
 
     def __getitem__(self, name):
         """Needed for TAL templates compatibility"""
@@ -232,26 +360,34 @@ class TemplateBase:
     content_type = 'text/html'
 
 
-def get_loader(dir, template_engine):
+def get_loader(dir, template_engine, cache='check', poll_interval=10,
+        compiled=False):
 
     # Support for multiple engines using fallback mechanizm
     # meaning that if first engine can't find template, we
     # use the second
 
+    # "cache" and "poll_interval" control how the loaders notice
+    # changed templates, see TALLoaderBase. "compiled" makes the zopetal
+    # loader compile templates to Python code.
+
     engines = template_engine.split(',')
     engines = [x.strip() for x in engines]
     ml = MultiLoader()
 
     for engine_name in engines:
+        kw = {}
         if engine_name == 'chameleon':
             from engine_chameleon import Loader
         elif engine_name == 'jinja2':
             from engine_jinja2 import Jinja2Loader as Loader
         elif engine_name == 'zopetal':
             from engine_zopetal import Loader
+            kw['compiled'] = compiled
         else:
             raise Exception('Unknown template engine "%s"' % engine_name)
-        ml.add_loader(Loader(dir))
+        ml.add_loader(Loader(dir, cache=cache, poll_interval=poll_interval,
+            **kw))
     
     if len(engines) == 1:
         return ml.loaders[0]
@@ -699,8 +835,8 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
             return []
 
         l = [HTMLItem(self._client, self.classname, id)
-             for id in self._klass.filter(None, filterspec, sort, group)
-             if check('View', userid, self.classname, itemid=id)]
+             for id in self._klass.filter_with_permissions(None, filterspec,
+                 sort, group, userid=userid)]
         return l
 
     def classhelp(self, properties=None, label=''"(list)", width='500',
@@ -974,14 +1110,10 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
                     current[prop_n] = '<a rel="nofollow" href="%s%s">%s</a>'%(
                         classname, id, current[prop_n])
 
-        # get the journal, sort and reverse
-        history = self._klass.history(self._nodeid, skipquiet=(not showall))
-        history.sort()
-        history.reverse()
-
-        # restrict the volume
-        if limit:
-            history = history[:limit]
+        # get the newest entries of the journal
+        history = self._klass.history(self._nodeid, skipquiet=(not showall),
+            limit=limit or None, direction='descending')
+        self._prefetch_history(history, dre)
 
         timezone = self._db.getUserTimezone()
         l = []
@@ -1190,6 +1322,41 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
         l.append('</table>')
         return '\n'.join(l)
 
+    def _prefetch_history(self, history, dre):
+        """ Fetch the users and linked items named in the history entries
+        with one query per class, so that rendering them finds them in
+        the database's cache.
+        """
+        linked = {'user': set()}
+        for id, evt_date, user, action, args in history:
+            linked['user'].add(user)
+            if type(args) != type({}):
+                continue
+            for k, value in args.iteritems():
+                prop = self._props.get(k)
+                if not value or not isinstance(prop, (hyperdb.Link,
+                        hyperdb.Multilink)):
+                    continue
+                ids = linked.setdefault(prop.classname, set())
+                if isinstance(prop, hyperdb.Link):
+                    ids.add(value)
+                    continue
+                for linkid in value:
+                    if isinstance(linkid, type(())):
+                        ids.update(linkid[1])
+                    else:
+                        ids.add(linkid)
+        for classname, ids in linked.iteritems():
+            ids = [i for i in ids if i and dre.match(i)]
+            if not ids:
+                continue
+            try:
+                self._db.getclass(classname).getnodes(ids, props=())
+            except (KeyError, IndexError):
+                # the class or some of its items no longer exist, they
+                # are looked up one at a time
+                pass
+
     def renderQueryForm(self):
         """ Render this item, which is a query, as a search form.
         """
@@ -2941,24 +3108,30 @@ function help_window(helpurl, width, height) {
         sort = self.sort
         group = self.group
 
-        # get the list of ids we're batching over
+        # get the list of ids we're batching over, the best full-text
+        # matches first unless sorted otherwise. All of the matches are
+        # needed: they are narrowed down by the filterspec and the
+        # permissions and counted for the total.
         klass = self.client.db.getclass(self.classname)
         if self.search_text:
-            matches = self.client.db.indexer.search(
-                [w.upper().encode("utf-8", "replace") for w in re.findall(
-                    r'(?u)\b\w{2,25}\b',
-                    unicode(self.search_text, "utf-8", "replace")
-                )], klass)
+            matches = dict(self.client.db.indexer.query(self.search_text,
+                klass))
         else:
             matches = None
 
-        # filter for visibility
-        l = [id for id in klass.filter(matches, filterspec, sort, group)
-            if check(permission, userid, self.classname, itemid=id)]
+        # filter for visibility, lazily if it can't be done by searching
+        # fetching only the displayed page (and one item more, to see
+        # whether there is a next page) if possible
+        pagesize = None
+        if self.pagesize > 0:
+            pagesize = self.pagesize + 1
+        l = klass.filter_with_permissions(matches, filterspec, sort, group,
+            permission=permission, userid=userid, pagesize=pagesize,
+            ranked=True)
 
         # return the batch object, using IDs only
         return Batch(self.client, l, self.pagesize, self.startwith,
-            classname=self.classname)
+            classname=self.classname, props=self.columns or None)
 
 # extend the standard ZTUtils Batch object to remove dependency on
 # Acquisition and add a couple of useful methods
@@ -2977,6 +3150,9 @@ class Batch(ZTUtils.Batch):
         orphan    if the next batch would contain less items than this
                   value, then it is combined with this batch
         overlap   the number of items shared between adjacent batches
+        props     if sequence is a list of ids, the Multilink properties
+                  to fetch along with the items of the batch (None for
+                  all of them)
         ========= ========================================================
 
         Attributes: Note that the "start" attribute, unlike the
@@ -2985,17 +3161,33 @@ class Batch(ZTUtils.Batch):
         the batch.
 
         "sequence_length" is the length of the original, unbatched, sequence.
+        If the sequence checks permissions lazily, this checks every item
+        in it. "known_length" is the length if it is known without that,
+        else None.
     """
     def __init__(self, client, sequence, size, start, end=0, orphan=0,
-            overlap=0, classname=None):
+            overlap=0, classname=None, props=None):
         self.client = client
         self.last_index = self.last_item = None
         self.current_item = None
         self.classname = classname
-        self.sequence_length = len(sequence)
+        self.props = props
+        self.prefetched = False
         ZTUtils.Batch.__init__(self, sequence, size, start, end, orphan,
             overlap)
 
+    # computed on demand: the sequence may check permissions lazily
+    def _get_sequence_length(self):
+        return len(self._sequence)
+    sequence_length = property(_get_sequence_length)
+
+    def _get_known_length(self):
+        known_length = getattr(self._sequence, 'known_length', None)
+        if known_length is None:
+            return len(self._sequence)
+        return known_length()
+    known_length = property(_get_known_length)
+
     # overwrite so we can late-instantiate the HTMLItem instance
     def __getitem__(self, index):
         if index < 0:
@@ -3013,11 +3205,22 @@ class Batch(ZTUtils.Batch):
 
         item = self._sequence[index + self.first]
         if self.classname:
+            if not self.prefetched:
+                self.prefetch()
             # map the item ids to instances
             item = HTMLItem(self.client, self.classname, item)
         self.current_item = item
         return item
 
+    def prefetch(self):
+        """ Fetch the items of this batch from the database in one go
+        """
+        self.prefetched = True
+        ids = [self._sequence[i]
+            for i in range(self.first, self.first + self.length)]
+        klass = self.client.db.getclass(self.classname)
+        klass.getnodes(ids, self.props)
+
     def propchanged(self, *properties):
         """ Detect if one of the properties marked as being a group
             property changed in the last iteration fetch
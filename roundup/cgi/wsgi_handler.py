@@ -6,7 +6,9 @@
 
 import os
 import cgi
+import time
 import weakref
+import threading
 
 import roundup.instance
 from roundup.cgi import TranslationService
@@ -23,16 +25,55 @@ class Writer(object):
         return f(data)
 
 class RequestDispatcher(object):
-    def __init__(self, home, debug=False, timing=False, lang=None):
+    def __init__(self, home, debug=False, timing=False, lang=None,
+            check_interval=5):
+        """Create the WSGI application for the tracker in 'home'
+
+        Unless 'debug' is set, the tracker is opened once per process
+        and reused for all requests.  It is opened again when one of
+        the tracker files changes; this is checked at most once every
+        'check_interval' seconds (0 checks on every request).
+        """
         assert os.path.isdir(home), '%r is not a directory'%(home,)
         self.home = home
         self.debug = debug
         self.timing = timing
+        self.check_interval = check_interval
         if lang:
             self.translator = TranslationService.get_translation(lang,
                 tracker_home=home)
         else:
             self.translator = None
+        self.tracker = None
+        self.tracker_mtime = None
+        self.tracker_checked = 0
+        self.tracker_lock = threading.Lock()
+
+    def get_tracker(self):
+        """Return the tracker instance to serve a request with"""
+        if self.debug:
+            return roundup.instance.open(self.home, optimize=0)
+        # fast path: no lock needed to read the cached tracker
+        now = time.time()
+        tracker = self.tracker
+        if tracker is not None and \
+                now - self.tracker_checked < self.check_interval:
+            return tracker
+        self.tracker_lock.acquire()
+        try:
+            if self.tracker is None:
+                self.tracker = roundup.instance.open(self.home, optimize=1)
+                self.tracker_mtime = self.tracker.get_mtime()
+            elif now - self.tracker_checked >= self.check_interval:
+                mtime = self.tracker.get_mtime()
+                if mtime != self.tracker_mtime:
+                    self.tracker = roundup.instance.open(self.home,
+                        optimize=1)
+                    self.tracker_mtime = mtime
+            self.tracker_checked = now
+            return self.tracker
+        finally:
+            self.tracker_lock.release()
 
     def __call__(self, environ, start_response):
         """Initialize with `apache.Request` object"""
@@ -51,7 +92,7 @@ class RequestDispatcher(object):
             request.wfile.write(DEFAULT_ERROR_MESSAGE % locals())
             return []
 
-        tracker = roundup.instance.open(self.home, not self.debug)
+        tracker = self.get_tracker()
 
         # need to strip the leading '/'
         environ["PATH_INFO"] = environ["PATH_INFO"][1:]
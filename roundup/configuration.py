@@ -369,6 +369,19 @@ class IsolationOption(Option):
             return _val
         raise OptionValueError(self, value, self.class_description)
 
+class TemplateCacheOption(Option):
+
+    """How compiled templates are kept up to date: check, poll, frozen"""
+
+    class_description = "Allowed values: check, poll, frozen"
+
+    def str2value(self, value):
+        _val = value.lower()
+        if _val in ("check", "poll", "frozen"):
+            return _val
+        else:
+            raise OptionValueError(self, value, self.class_description)
+
 class MailAddressOption(Option):
 
     """Email address
@@ -454,6 +467,30 @@ class IntegerNumberOption(Option):
         except ValueError:
             raise OptionValueError(self, value, "Integer number required")
 
+class IntegerMapOption(Option):
+
+    """Mapping of names to integer numbers"""
+
+    class_description = "Allowed values: comma-separated list of\n" \
+        "name:number pairs, e.g. msg:50,user:200"
+
+    def _value2str(self, value):
+        return ','.join(['%s:%d' % item for item in sorted(value.items())])
+
+    def str2value(self, value):
+        _val = {}
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            try:
+                name, number = item.split(':')
+                _val[name.strip()] = int(number)
+            except ValueError:
+                raise OptionValueError(self, value,
+                    "List of name:number pairs required")
+        return _val
+
 class OctalNumberOption(Option):
 
     """Octal Integer numbers"""
@@ -573,6 +610,22 @@ SETTINGS = (
             "ported from Zope, or 'chameleon' for Chameleon."),
         (FilePathOption, "templates", "html",
             "Path to the HTML templates directory."),
+        (TemplateCacheOption, "template_cache", "check",
+            "How compiled templates are kept up to date with the\n"
+            "template files. 'check' looks for added, removed and\n"
+            "changed templates whenever a template is used, 'poll'\n"
+            "at most every template_poll_interval seconds. 'frozen'\n"
+            "compiles all templates when the tracker is loaded and\n"
+            "never looks at the template files again; the tracker\n"
+            "must be restarted to pick up changed templates."),
+        (IntegerNumberOption, "template_poll_interval", "10",
+            "Seconds between checks for changed templates when\n"
+            "template_cache is 'poll'."),
+        (BooleanOption, "template_compile", "no",
+            "Compile 'zopetal' templates to Python code when they\n"
+            "are loaded, instead of interpreting them on every page.\n"
+            "The code is cached in a file next to each template,\n"
+            "named like the template with '.talc' appended."),
         (MultiFilePathOption, "static_files", "",
             "A list of space separated directory paths (or a single\n"
             "directory).  These directories hold additional static\n"
@@ -632,6 +685,13 @@ SETTINGS = (
         (TimezoneOption, "timezone", "UTC", "Default timezone offset,"
             " applied when user's timezone is not set.",
             ["DEFAULT_TIMEZONE"]),
+        (BooleanOption, "share_schema", "no",
+            "Build the classes, security settings and detector\n"
+            "registrations only once per process and share them between\n"
+            "all database connections.  This is only used when templates\n"
+            "are precompiled (e.g. roundup-server, WSGI, mod_python).\n"
+            "schema.py and the detectors must not keep references to\n"
+            "the db they are initialised with."),
         (BooleanOption, "instant_registration", "no",
             "Register new users instantly, or require confirmation via\n"
             "email?"),
@@ -641,7 +701,9 @@ SETTINGS = (
             "Force Roundup to use a particular text indexer.\n"
             "If no indexer is supplied, the first available indexer\n"
             "will be used in the following order:\n"
-            "Possible values: xapian, whoosh, native (internal)."),
+            "Possible values: xapian, whoosh, native (internal),\n"
+            "ranked (internal, SQL backends only, ranks results and\n"
+            "supports OR and \"phrase\" queries)."),
         (WordListOption, "indexer_stopwords", "",
             "Additional stop-words for the full-text indexer specific to\n"
             "your tracker. See the indexer source for the default list of\n"
@@ -832,6 +894,20 @@ always passes, so setting it less than 1 is not recommended."""),
             "Setting this option makes Roundup migrate passwords with\n"
             "an insecure password-scheme to a more secure scheme\n"
             "when the user logs in via the web-interface."),
+        (IntegerNumberOption, "password_verify_threads", "0",
+            "Number of worker threads checking the passwords of logins.\n"
+            "Hashing a password takes a lot of cpu time, so this limits\n"
+            "the server threads busy with logins to this number. Only\n"
+            "useful with a threaded server (e.g. roundup-server in\n"
+            "multiprocess mode 'thread'). Set to 0 to check passwords\n"
+            "in the request thread."),
+        (IntegerNumberOption, "password_cache_time", "0",
+            "Number of seconds a successful password check is remembered\n"
+            "so it needn't be repeated for clients sending the password\n"
+            "with every request (XML-RPC, HTTP Basic Authentication).\n"
+            "Only a keyed hash is kept, in the memory of the server\n"
+            "process. Changing the password ends the caching.\n"
+            "Set to 0 to check the password on every request."),
     )),
     ("rdbms", (
         (Option, 'name', 'roundup',
@@ -863,8 +939,28 @@ always passes, so setting it less than 1 is not recommended."""),
             "Number of seconds to wait when the SQLite database is locked\n"
             "Default: use a 30 second timeout (extraordinarily generous)\n"
             "Only used in SQLite connections."),
+        (BooleanOption, 'anydbm_indexes', 'no',
+            "Keep secondary indexes of the Link, Multilink, Date and\n"
+            "key properties, so that searches only read the items\n"
+            "that can match. The indexes are built on first use.\n"
+            "Only used by the anydbm backend."),
+        (IntegerNumberOption, 'connection_pool_size', '0',
+            "Maximum number of idle database connections kept open per\n"
+            "process for reuse by later requests, including the session\n"
+            "and one-time-key connections. 0 disables connection pooling.\n"
+            "Only used in PostgreSQL and MySQL connections."),
+        (IntegerNumberOption, 'connection_pool_min', '0',
+            "Number of idle pooled connections that are kept open even\n"
+            "when they have been idle longer than connection_pool_timeout."),
+        (IntegerNumberOption, 'connection_pool_timeout', '300',
+            "Idle pooled connections are closed after this many seconds."),
         (IntegerNumberOption, 'cache_size', '100',
             "Size of the node cache (in elements)"),
+        (IntegerMapOption, 'cache_size_per_class', '',
+            "Node cache sizes for individual classes (in elements).\n"
+            "Classes listed here get their own cache of the given size,\n"
+            "so that e.g. many msg rows don't evict user or status rows.\n"
+            "All other classes share the cache set by cache_size."),
         (BooleanOption, "allow_create", "yes",
             "Setting this option to 'no' protects the database against table creations."),
         (BooleanOption, "allow_alter", "yes",
@@ -956,6 +1052,26 @@ always passes, so setting it less than 1 is not recommended."""),
             "If this is false but add_authorinfo is true, only the name\n"
             "of the actor is added which protects the mail address of the\n"
             "actor from being exposed at mail archives, etc."),
+        (IntegerNumberOption, "connection_idle_timeout", "60",
+            "Number of seconds an SMTP connection is kept open after\n"
+            "sending a message, to be reused by the next messages sent\n"
+            "by the same process. Set to 0 to close every connection\n"
+            "after sending."),
+        (IntegerNumberOption, "connection_max_messages", "100",
+            "Maximum number of messages sent over one SMTP connection\n"
+            "before it is closed and a new one is opened."),
+        (BooleanOption, "queue", "no",
+            "Setting this option to \"yes\" makes Roundup put nosy messages\n"
+            "into the directory \"mailqueue\" of the database directory\n"
+            "when the change is committed, instead of sending them while\n"
+            "the change is made. The queue is delivered by the command\n"
+            "\"roundup-admin deliver_mail\", which must be run regularly\n"
+            "(eg. from cron) or kept running with an interval argument."),
+        (IntegerNumberOption, "queue_max_attempts", "10",
+            "Number of attempts to send a queued message before giving up.\n"
+            "The delay between attempts starts at a minute and doubles for\n"
+            "each attempt. Messages given up on are kept in the \"failed\"\n"
+            "subdirectory of the mail queue."),
     ), "Outgoing email options.\nUsed for nosy messages and approval requests"),
     ("mailgw", (
         (EmailBodyOption, "keep_quoted_text", "yes",
@@ -1116,7 +1232,9 @@ always passes, so setting it less than 1 is not recommended."""),
             "Controls the email sending from the nosy reactor. If\n"
             "\"multiple\" then a separate email is sent to each\n"
             "recipient. If \"single\" then a single email is sent with\n"
-            "each recipient as a CC address."),
+            "each recipient as a CC address. If \"envelope\" then a\n"
+            "single email addressed to the tracker is sent to all\n"
+            "recipients, so they don't see each other's addresses."),
         (IntegerNumberOption, "max_attachment_size", sys.maxint,
             "Attachments larger than the given number of bytes\n"
             "won't be attached to nosy mails. They will be replaced by\n"
@@ -21,7 +21,7 @@
 __docformat__ = 'restructuredtext'
 
 # standard python modules
-import os, re, shutil, sys, weakref
+import os, re, shutil, sys, weakref, copy
 import traceback
 import logging
 
@@ -338,6 +338,109 @@ def splitDesignator(designator, dre=re.compile(r'([^\d]+)(\d+)')):
         raise DesignatorError, _('"%s" not a node designator')%designator
     return m.group(1), m.group(2)
 
+class PermissionCheckedList(object):
+    """ Sequence of those ids in a list of item ids that pass a
+    permission check. The check is only run for ids up to the highest
+    index accessed, so paging through a large search result only
+    checks the items up to the page displayed. Taking the len() of the
+    sequence checks all ids, known_length() doesn't.
+    """
+    def __init__(self, ids, check):
+        self.ids = ids
+        self.check = check
+        self.allowed = []
+        self.checked = 0
+
+    def _fill(self, count=None):
+        """ Check ids until count of them are known to be allowed or
+        all ids are checked.
+        """
+        while count is None or len(self.allowed) < count:
+            try:
+                id = self.ids[self.checked]
+            except IndexError:
+                break
+            self.checked += 1
+            if self.check(id):
+                self.allowed.append(id)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if (index.start or 0) < 0 or index.stop is None or index.stop < 0:
+                self._fill()
+            else:
+                self._fill(index.stop)
+        elif index < 0:
+            self._fill()
+        else:
+            self._fill(index + 1)
+        return self.allowed[index]
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __len__(self):
+        self._fill()
+        return len(self.allowed)
+
+    def known_length(self):
+        """ Return the length of the sequence if all ids have been
+        checked, else None.
+        """
+        if self.checked < len(self.ids):
+            return None
+        return len(self.allowed)
+
+    def __iter__(self):
+        n = 0
+        while True:
+            self._fill(n + 1)
+            if n >= len(self.allowed):
+                return
+            yield self.allowed[n]
+            n += 1
+
+class PagedFilterResult(object):
+    """ Sequence of the ids matching a filter. The ids are fetched from
+    the database a page at a time, starting at the first index accessed
+    that isn't known yet, and the length is computed by filter_count.
+    """
+    def __init__(self, cls, search_matches, filterspec, sort=[], group=[],
+            pagesize=50):
+        self.cls = cls
+        self.search_matches = search_matches
+        self.filterspec = filterspec
+        self.sort = sort
+        self.group = group
+        self.pagesize = pagesize
+        self.ids = {}
+        self.length = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError, index
+        if index not in self.ids:
+            page = self.cls.filter(self.search_matches, self.filterspec,
+                self.sort, self.group, limit=self.pagesize, offset=index)
+            for n, id in enumerate(page):
+                self.ids[index + n] = id
+            if index not in self.ids:
+                raise IndexError, index
+        return self.ids[index]
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __len__(self):
+        if self.length is None:
+            self.length = self.cls.filter_count(self.search_matches,
+                self.filterspec)
+        return self.length
+
 class Proptree(object):
     """ Simple tree data structure for property lookup. Each node in
     the tree is a roundup Class Property that has to be navigated to
@@ -374,6 +477,7 @@ class Proptree(object):
         self.propclass = None
         self.orderby = []
         self.sql_idx = None # index of retrieved column in sql result
+        self.limit_done = False # limit/offset applied by the sql backend
         if parent:
             self.root = parent.root
             self.depth = parent.depth + 1
@@ -707,6 +811,19 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         """
         raise NotImplementedError
 
+    def bind_schema(self, classes, security):
+        """Use the classes and Security of a previously opened database.
+
+        'classes' maps class names to Class objects, 'security' is a
+        Security object.  Bound copies are made for this database; the
+        property definitions, auditors, reactors, Roles and Permissions
+        are shared with the originals, so this is much cheaper than
+        executing the schema again.
+        """
+        self.security = security.bind(self)
+        for cl in classes.itervalues():
+            cl.bind(self)
+
     def getclasses(self):
         """Return a list of the names of all existing classes."""
         raise NotImplementedError
@@ -757,11 +874,32 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         """
         raise NotImplementedError
 
+    def getnodes(self, classname, nodeids, props=None):
+        """Get many nodes from the database, returning {nodeid: node}.
+
+        'props' names the Multilink properties that should be fetched
+        along with the nodes, None meaning all of them. Backends that
+        can fetch many nodes at once override this.
+        """
+        return dict([(nodeid, self.getnode(classname, nodeid))
+            for nodeid in nodeids])
+
     def hasnode(self, classname, nodeid):
         """Determine if the database has a given node.
         """
         raise NotImplementedError
 
+    def begin_import(self, classname):
+        """Prepare the class for a bulk import, e.g. by dropping indexes
+        that are rebuilt by end_import().
+        """
+        pass
+
+    def end_import(self, classname):
+        """Finish a bulk import started with begin_import().
+        """
+        pass
+
     def countnodes(self, classname):
         """Count the number of nodes that exist for a particular Class.
         """
@@ -792,11 +930,28 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         """
         raise NotImplementedError
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, decode=True, daterange=None,
+            actions=None, limit=None, offset=None, direction='ascending'):
         """ get the journal for id
+
+        If "decode" is false, a backend may leave the values of the params
+        of "set" entries as stored; decode_journal_params() converts them
+        to hyperdb values.
+
+        The entries are ordered by date, newest first if "direction" is
+        'descending'. "daterange" (see journal_range()) and "actions", a
+        list of action names, select the entries to return; "limit" and
+        "offset" select a page of at most limit entries after skipping
+        offset entries.
         """
         raise NotImplementedError
 
+    def decode_journal_params(self, classname, params):
+        """ Convert the params of a "set" journal entry returned by
+        getjournal() with decode false, returning them.
+        """
+        return params
+
     def pack(self, pack_before):
         """ pack the database
         """
@@ -825,6 +980,35 @@ All methods except __repr__ must be implemented by a concrete backend Database.
 
         """
 
+def journal_range(daterange):
+    """Return the date.Range selected by 'daterange', which is either a
+    Range of Dates or a range spec like "2007-01-01;2007-12-31" (in UTC).
+    """
+    if isinstance(daterange, date.Range):
+        return daterange
+    return date.Range(daterange, date.Date)
+
+def filter_journal(journal, daterange=None, actions=None, limit=None,
+        offset=None, direction='ascending'):
+    """Select and order the entries of a journal as getjournal() is asked
+    to, for backends that can't do it while reading the journal.
+    """
+    if daterange:
+        r = journal_range(daterange)
+        if r.from_value:
+            journal = [j for j in journal if j[1] >= r.from_value]
+        if r.to_value:
+            journal = [j for j in journal if j[1] <= r.to_value]
+    if actions is not None:
+        journal = [j for j in journal if j[3] in actions]
+    journal = sorted(journal, key=lambda j: j[1])
+    if direction == 'descending':
+        journal.reverse()
+    offset = offset or 0
+    if limit is None:
+        return journal[offset:]
+    return journal[offset:offset + limit]
+
 def iter_roles(roles):
     ''' handle the text processing of turning the roles list
         into something python can use more easily
@@ -834,6 +1018,12 @@ def iter_roles(roles):
     for role in [x.lower().strip() for x in roles.split(',')]:
         yield role
 
+def forget_user_roles(db, cl, nodeid, oldvalues):
+    ''' Reactor making Security forget the roles it cached for a user
+        whose roles may have changed.
+    '''
+    db.security.clear_user_roles(nodeid)
+
 
 #
 # The base Class class
@@ -871,12 +1061,28 @@ class Class:
         actions = "create set retire restore".split()
         self.auditors = dict([(a, PrioList()) for a in actions])
         self.reactors = dict([(a, PrioList()) for a in actions])
+        if classname == 'user':
+            # Security.get_user_roles caches the roles until commit
+            self.react('set', forget_user_roles, priority=0)
 
     def __repr__(self):
         """Slightly more useful representation
         """
         return '<hyperdb.Class "%s">'%self.classname
 
+    def bind(self, db):
+        """Return a copy of this class for use with database 'db'.
+
+        The copy shares properties, auditors and reactors with this
+        class and is added to 'db' without creating the default
+        Permissions (they come with the Security object, see
+        Database.bind_schema).
+        """
+        cl = copy.copy(self)
+        cl.db = weakref.proxy(db)
+        db.classes[cl.classname] = cl
+        return cl
+
     # Editing nodes:
 
     def create(self, **propvalues):
@@ -921,6 +1127,20 @@ class Class:
         """
         return Node(self, nodeid)
 
+    def getnodes(self, nodeids, props=None):
+        """ Return convenience wrappers for many nodes.
+
+        The nodes are fetched from the database in one go, so that
+        getting their properties later needs no further database
+        access. 'props' names the Multilink properties to fetch along
+        with the nodes, None meaning all of them.
+
+        Each id in 'nodeids' must be the id of an existing node of this
+        class or an IndexError is raised.
+        """
+        self.db.getnodes(self.classname, nodeids, props)
+        return [Node(self, nodeid) for nodeid in nodeids]
+
     def getnodeids(self, retired=None):
         """Retrieve all the ids of the nodes for a particular Class.
         """
@@ -990,7 +1210,9 @@ class Class:
         if there are any references to the node.
         """
 
-    def history(self, nodeid, enforceperm=True, skipquiet=True):
+    def history(self, nodeid, enforceperm=True, skipquiet=True,
+            daterange=None, actions=None, limit=None, offset=None,
+            direction='ascending'):
         """Retrieve the journal of edits on a particular node.
 
         'nodeid' must be the id of an existing node of this class or an
@@ -1013,10 +1235,42 @@ class Class:
         Note that there is a check for obsolete properties and classes
         resulting from history changes. These are also only checked if
         enforceperm is True.
+
+        The 'daterange', 'actions' and 'direction' arguments are passed
+        to getjournal(). 'limit' and 'offset' select a page of at most
+        limit of the shown entries after skipping offset of them; the
+        journal is read a page at a time until there are enough.
         """
         if not self.do_journal:
             raise ValueError('Journalling is disabled for this class')
 
+        # the params are decoded by _filter_history() once the entries
+        # that aren't shown have been dropped
+        kw = dict(decode=False, daterange=daterange, actions=actions,
+            direction=direction)
+        offset = offset or 0
+        if limit is None:
+            journal = self.db.getjournal(self.classname, nodeid, **kw)
+            return self._filter_history(nodeid, journal, enforceperm,
+                skipquiet)[offset:]
+
+        journal = []
+        size = start = offset + limit
+        entries = self.db.getjournal(self.classname, nodeid, limit=size, **kw)
+        while True:
+            journal.extend(self._filter_history(nodeid, entries,
+                enforceperm, skipquiet))
+            if len(journal) >= offset + limit or len(entries) < size:
+                break
+            entries = self.db.getjournal(self.classname, nodeid, limit=size,
+                offset=start, **kw)
+            start += size
+        return journal[offset:offset + limit]
+
+    def _filter_history(self, nodeid, entries, enforceperm, skipquiet):
+        """Return the journal entries that history() shows, with their
+        params decoded.
+        """
         perm = self.db.security.hasPermission
         journal = []
 
@@ -1027,7 +1281,7 @@ class Class:
         ur = set(self.db.user.get_roles(uid))
         allow_obsolete = bool(hr & ur)
 
-        for j in self.db.getjournal(self.classname, nodeid):
+        for j in entries:
             # hide/remove journal entry if:
             #   property is quiet
             #   property is not (viewable or editable)
@@ -1066,6 +1320,7 @@ class Class:
                                  " all props removed in: %s",
                                  self.classname, nodeid, j_repr)
                     continue
+                self.db.decode_journal_params(self.classname, args)
                 journal.append(j)
             elif action in ['link', 'unlink' ] and type(args) == type(()):
                 # definitions:
@@ -1341,7 +1596,7 @@ class Class:
         return sortattr
 
     def filter(self, search_matches, filterspec, sort=[], group=[],
-               retired=False):
+               retired=False, limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec.
@@ -1355,6 +1610,9 @@ class Class:
 
         "search_matches" is a container type
 
+        "limit" and "offset" select a page of at most limit ids, after
+        skipping offset ids of the sorted result.
+
         The filter must match all properties specificed. If the property
         value to match is a list:
 
@@ -1378,7 +1636,20 @@ class Class:
         sortattr = self._sortattr(sort = sort, group = group)
         proptree = self._proptree(filterspec, sortattr)
         proptree.search(search_matches, retired=retired)
-        return proptree.sort()
+        l = proptree.sort()
+        if limit is not None or offset:
+            offset = offset or 0
+            if limit is None:
+                l = l[offset:]
+            else:
+                l = l[offset:offset + limit]
+        return l
+
+    def filter_count(self, search_matches, filterspec, retired=False):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec, see filter for the arguments.
+        """
+        return len(self.filter(search_matches, filterspec, retired=retired))
 
     # non-optimized filter_iter, a backend may chose to implement a
     # better version that provides a real iterator that pre-fills the
@@ -1387,6 +1658,63 @@ class Class:
     # anyway).
     filter_iter = filter
 
+    def filter_with_permissions(self, search_matches, filterspec, sort=[],
+            group=[], permission='View', userid=None, pagesize=None,
+            ranked=False):
+        """Do the same as filter but return only the ids of the items
+        "userid" (default: the current user) has "permission" for.
+
+        If the permission is only granted by Permissions with a check
+        function and all of them declare a filter, the filters are run
+        as database searches. Otherwise the check functions are called
+        lazily: the result is a PermissionCheckedList that checks the
+        items only as far as they are accessed.
+
+        If "pagesize" is given, the result is fetched from the database
+        in pages of that size (see PagedFilterResult) where possible.
+
+        If "ranked" is set and neither "sort" nor "group" are given,
+        "search_matches" maps the item ids to their scores (as returned
+        by the indexer's query()) and the best matches come first.
+        """
+        if userid is None:
+            userid = self.db.getuid()
+        security = self.db.security
+        granted, checks = security.compile(security.get_user_roles(userid),
+            permission, self.classname, None)
+        if not granted and not checks:
+            return []
+        unfiltered = [perm for perm in checks if perm.filter is None]
+        if ranked and search_matches is not None and not sort and not group:
+            ids = self.filter(search_matches, filterspec)
+            ids.sort(key=lambda id: (-search_matches[id], int(id)))
+        elif pagesize and (granted or unfiltered):
+            ids = PagedFilterResult(self, search_matches, filterspec, sort,
+                group, pagesize)
+        else:
+            ids = self.filter(search_matches, filterspec, sort, group)
+        if granted:
+            return ids
+        if unfiltered:
+            check = security.hasPermission
+            cn = self.classname
+            return PermissionCheckedList(ids, lambda id: check(permission,
+                userid, cn, itemid=id))
+        allowed = {}
+        for perm in checks:
+            for spec in perm.filter(self.db, userid, self):
+                # narrow the search by the user's filterspec unless it
+                # constrains the same properties
+                for propname in spec:
+                    if propname in filterspec:
+                        break
+                else:
+                    spec = spec.copy()
+                    spec.update(filterspec)
+                for id in self.filter(search_matches, spec):
+                    allowed[id] = 1
+        return [id for id in ids if id in allowed]
+
     def count(self):
         """Get the number of nodes in this class.
 
@@ -1429,6 +1757,11 @@ class Class:
         """Add (or refresh) the node to search indexes"""
         raise NotImplementedError
 
+    def index_entries(self, nodeid):
+        """Return the (identifier, text, mime_type) entries to put in the
+        search indexes for the node"""
+        raise NotImplementedError
+
     #
     # Detector interface
     #
@@ -1477,6 +1810,14 @@ class Class:
         propnames.sort()
         return propnames
 
+    def import_lists(self, propnames, proplists):
+        """Import many nodes, see import_list(), returning their nodeids.
+
+        Backends may override this to insert the nodes in bulk.
+        """
+        return [self.import_list(propnames, proplist)
+            for proplist in proplists]
+
     def import_journals(self, entries):
         """Import a class's journal.
 
@@ -64,7 +64,9 @@ class Tracker:
 
         self.load_interfaces()
         self.templates = templating.get_loader(self.config["TEMPLATES"],
-            self.config["TEMPLATE_ENGINE"])
+            self.config["TEMPLATE_ENGINE"], self.config["TEMPLATE_CACHE"],
+            self.config["TEMPLATE_POLL_INTERVAL"],
+            self.config["TEMPLATE_COMPILE"])
 
         rdbms_backend = self.config.RDBMS_BACKEND
 
@@ -102,13 +104,24 @@ update your config.ini
             self.detectors = self.get_extensions('detectors')
             # db_open is set to True after first open()
             self.db_open = 0
+            # with share_schema, classes and security built by the
+            # first open() are bound to later database connections
+            self.schema_classes = None
+            self.schema_security = None
 
     def open(self, name=None):
         # load the database schema
         # we cannot skip this part even if self.optimize is set
         # because the schema has security settings that must be
-        # applied to each database instance
+        # applied to each database instance - unless share_schema
+        # is set, then the classes and security settings of the
+        # first database are bound to the new one
         backend = self.backend
+        if self.optimize and self.schema_classes is not None:
+            db = backend.Database(self.config, name)
+            db.bind_schema(self.schema_classes, self.schema_security)
+            db.tx_Source = None
+            return db
         env = {
             'Class': backend.Class,
             'FileClass': backend.FileClass,
@@ -174,6 +187,9 @@ update your config.ini
 
             db.post_init()
             self.db_open = 1
+            if self.optimize and self.config.SHARE_SCHEMA:
+                self.schema_classes = dict(db.classes)
+                self.schema_security = db.security
         return db
 
     def load_interfaces(self):
@@ -209,6 +225,39 @@ update your config.ini
             sys.path.remove(dirpath)
         return extensions
 
+    def get_mtime(self):
+        """Return the newest modification time of the tracker files
+
+        This covers config.ini, schema.py and interfaces.py, the
+        detectors, extensions and lib directories and the templates.
+        Long-running servers use it to find out whether the tracker
+        has to be opened again.
+
+        """
+        mtime = 0
+        for name in 'config.ini', 'schema.py', 'interfaces.py':
+            try:
+                mtime = max(mtime, os.stat(os.path.join(self.tracker_home,
+                    name)).st_mtime)
+            except OSError:
+                pass
+        dirs = [os.path.join(self.tracker_home, dirname)
+            for dirname in ('detectors', 'extensions', 'lib')]
+        dirs.append(self.config["TEMPLATES"])
+        for dirpath in dirs:
+            if not os.path.isdir(dirpath):
+                continue
+            # the directory itself changes when files are removed
+            mtime = max(mtime, os.stat(dirpath).st_mtime)
+            for name in os.listdir(dirpath):
+                try:
+                    mtime = max(mtime, os.stat(os.path.join(dirpath,
+                        name)).st_mtime)
+                except OSError:
+                    # file removed while we were looking
+                    pass
+        return mtime
+
     def init(self, adminpw, tx_Source=None):
         db = self.open('admin')
         db.tx_Source = tx_Source
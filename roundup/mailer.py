@@ -3,6 +3,7 @@
 __docformat__ = 'restructuredtext'
 
 import time, quopri, os, socket, smtplib, re, sys, traceback, email, logging
+import json, threading
 
 from cStringIO import StringIO
 
@@ -55,10 +56,17 @@ def nice_sender_header(name, address, charset):
 
 class Mailer:
     """Roundup-specific mail sending."""
-    def __init__(self, config):
+    def __init__(self, config, queue=None):
+        """ If "queue" is given, smtp_send passes the messages to it
+            (called with sender, to and message) instead of sending them.
+        """
         self.config = config
+        self.queue = queue
         self.logger = logging.getLogger('roundup.mailer')
 
+        # a connection kept open between open() and close()
+        self.smtp = None
+
         # set to indicate to roundup not to actually _send_ email
         # this var must contain a file to write the mail to
         self.debug = os.environ.get('SENDMAILDEBUG', '') \
@@ -277,7 +285,9 @@ class Mailer:
 
         if not sender:
             sender = self.config.ADMIN_EMAIL
-        if self.debug:
+        if self.queue:
+            self.queue(sender, to, message)
+        elif self.debug:
             # don't send - just write to a file, use unix from line so
             # that resulting file can be openened in a mailer
             fmt = '%a %b %m %H:%M:%S %Y'
@@ -286,18 +296,304 @@ class Mailer:
                                         (unixfrm, sender,
                                          ', '.join(to), message))
         else:
-            # now try to send the message
+            # unless open() was called, the connection goes back to the
+            # pool after this message
+            keep = self.smtp is not None
+            try:
+                self.open()
+                try:
+                    # send the message as admin so bounces are sent there
+                    # instead of to roundup
+                    self._sendmail(sender, to, message)
+                except socket.error as value:
+                    self.discard()
+                    raise MessageSendError("Error: couldn't send email: "
+                                           "mailhost %s"%value)
+                except smtplib.SMTPException, msg:
+                    if isinstance(msg, smtplib.SMTPServerDisconnected):
+                        self.discard()
+                    raise MessageSendError("Error: couldn't send email: %s"
+                                           %msg)
+            finally:
+                if not keep:
+                    self.close()
+
+    def _sendmail(self, sender, to, message):
+        try:
+            self.smtp.sendmail(sender, to, message)
+        except (socket.error, smtplib.SMTPServerDisconnected):
+            if not self.smtp.reused:
+                raise
+            # the mail host has dropped the idle connection, reconnect
+            self.discard()
+            self.smtp = SMTPConnection(self.config)
+            self.smtp.sendmail(sender, to, message)
+
+    def open(self):
+        """Keep an SMTP connection open for the following smtp_send
+        calls, until close() is called. The connection is taken from the
+        process' pool of idle connections if possible.
+        """
+        if self.smtp is None and not self.debug:
             try:
-                # send the message as admin so bounces are sent there
-                # instead of to roundup
-                smtp = SMTPConnection(self.config)
-                smtp.sendmail(sender, to, message)
+                self.smtp = smtp_pool.get(self.config)
             except socket.error as value:
                 raise MessageSendError("Error: couldn't send email: "
                                        "mailhost %s"%value)
             except smtplib.SMTPException, msg:
                 raise MessageSendError("Error: couldn't send email: %s"%msg)
 
+    def close(self):
+        """Give the connection kept open by open() back to the pool."""
+        smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            smtp_pool.put(self.config, smtp)
+
+    def discard(self):
+        """Close the connection kept open by open() for good."""
+        smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            smtp.close()
+
+    def deliver_queue(self, queue, max_attempts=10):
+        """Send the messages waiting in the MailQueue "queue" over one
+        SMTP connection. Messages that can't be sent are retried later,
+        with the delay doubling each time, and moved to the failed
+        messages after max_attempts attempts.
+
+        Returns the numbers of messages sent and of failed attempts.
+        """
+        sent = failed = 0
+        try:
+            for name in queue.waiting():
+                entry = queue.take(name)
+                if entry is None:
+                    # another process got it
+                    continue
+                sender, to, message, attempts = entry
+                try:
+                    self.open()
+                    self.smtp_send(to, message, sender)
+                except MessageSendError, msg:
+                    failed += 1
+                    attempts += 1
+                    if attempts >= max_attempts:
+                        self.logger.error('giving up on queued message %s '
+                            'to %s: %s'%(name, ', '.join(to), msg))
+                        queue.fail(name)
+                    else:
+                        self.logger.warning('queued message %s to %s: %s'%(
+                            name, ', '.join(to), msg))
+                        queue.retry(name, attempts)
+                    if self.smtp is None and not self.debug:
+                        # lost the connection to the mail host, try
+                        # the rest later
+                        break
+                else:
+                    sent += 1
+                    queue.done(name)
+        finally:
+            self.close()
+        return sent, failed
+
+class MailQueue:
+    """A durable queue of outgoing messages in a directory.
+
+    Each message is a file holding a line with the JSON-encoded envelope
+    (sender, recipients and number of failed delivery attempts) followed
+    by the message. Like a maildir, the files are written to "tmp" and
+    then renamed to "new". A delivering process renames a message to
+    "cur" while sending it, so concurrent delivery processes don't send
+    it twice. The modification time of a file in "new" is the time it
+    may be sent (again); messages giving up on are moved to "failed".
+    """
+    # first retry delay, doubled for each further attempt
+    retry_delay = 60
+    # messages in "cur" older than this were left by a crashed process
+    stale_age = 3600
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        for sub in 'tmp', 'new', 'cur', 'failed':
+            path = os.path.join(dirname, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.counter = 0
+
+    def _path(self, sub, name):
+        return os.path.join(self.dirname, sub, name)
+
+    def _write(self, sub, name, sender, to, message, attempts):
+        f = open(self._path(sub, name), 'wb')
+        try:
+            f.write(json.dumps({'sender': sender, 'to': to,
+                'attempts': attempts}) + '\n')
+            f.write(message)
+        finally:
+            f.close()
+
+    def put(self, sender, to, message):
+        """Add a message to the queue, return its name."""
+        self.counter += 1
+        name = '%.6f.%d.%d.%s'%(time.time(), os.getpid(), self.counter,
+            socket.gethostname())
+        self._write('tmp', name, sender, to, message, 0)
+        os.rename(self._path('tmp', name), self._path('new', name))
+        return name
+
+    def waiting(self, now=None):
+        """Return the names of the messages that may be sent now,
+        oldest first.
+        """
+        if now is None:
+            now = time.time()
+        # give back messages a crashed delivery process left behind
+        for name in os.listdir(os.path.join(self.dirname, 'cur')):
+            path = self._path('cur', name)
+            try:
+                if os.path.getmtime(path) < now - self.stale_age:
+                    os.rename(path, self._path('new', name))
+            except OSError:
+                pass
+        names = []
+        for name in os.listdir(os.path.join(self.dirname, 'new')):
+            try:
+                if os.path.getmtime(self._path('new', name)) <= now:
+                    names.append(name)
+            except OSError:
+                pass
+        # names start with the time they were queued
+        names.sort()
+        return names
+
+    def take(self, name):
+        """Claim a waiting message for delivery. Return (sender, to,
+        message, attempts) or None if somebody else has claimed it.
+        """
+        path = self._path('cur', name)
+        try:
+            os.rename(self._path('new', name), path)
+        except OSError:
+            return None
+        # mark the time delivery started
+        os.utime(path, None)
+        f = open(path, 'rb')
+        try:
+            envelope = json.loads(f.readline())
+            message = f.read()
+        finally:
+            f.close()
+        return (envelope['sender'], envelope['to'], message,
+            envelope['attempts'])
+
+    def done(self, name):
+        """Remove a delivered message."""
+        os.remove(self._path('cur', name))
+
+    def retry(self, name, attempts):
+        """Put a message back into the queue for another attempt."""
+        path = self._path('cur', name)
+        f = open(path, 'rb')
+        try:
+            envelope = json.loads(f.readline())
+            message = f.read()
+        finally:
+            f.close()
+        self._write('tmp', name, envelope['sender'], envelope['to'],
+            message, attempts)
+        when = time.time() + self.retry_delay * 2 ** (attempts - 1)
+        os.utime(self._path('tmp', name), (when, when))
+        os.rename(self._path('tmp', name), self._path('new', name))
+        os.remove(path)
+
+    def fail(self, name):
+        """Give up on a message, keeping it in "failed"."""
+        os.rename(self._path('cur', name), self._path('failed', name))
+
+class SMTPConnectionPool:
+    """Idle SMTP connections of this process, kept for reuse by later
+    messages to the same mail host. A connection is closed once it has
+    been idle for the [mail] connection_idle_timeout or has sent
+    connection_max_messages messages.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pid = os.getpid()
+
+    def key(self, config):
+        return (config.MAILHOST, config['MAIL_PORT'],
+            config['MAIL_LOCAL_HOSTNAME'], config['MAIL_TLS'],
+            config['MAIL_USERNAME'])
+
+    def get(self, config):
+        """Return an idle connection to the mail host or a new one."""
+        now = time.time()
+        timeout = config['MAIL_CONNECTION_IDLE_TIMEOUT']
+        conn = None
+        expired = []
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                # forked, the connections belong to the parent
+                self.idle = {}
+                self.pid = os.getpid()
+            idle = self.idle.get(self.key(config), [])
+            while idle:
+                last_used, c = idle.pop()
+                if now - last_used < timeout:
+                    conn = c
+                    break
+                expired.append(c)
+        finally:
+            self.lock.release()
+        for c in expired:
+            quit_smtp(c)
+        if conn is None:
+            return SMTPConnection(config)
+        conn.reused = True
+        return conn
+
+    def put(self, config, conn):
+        """Keep the connection for reuse, or close it if it is used up."""
+        if (config['MAIL_CONNECTION_IDLE_TIMEOUT'] <= 0 or conn.messages_sent
+                >= config['MAIL_CONNECTION_MAX_MESSAGES']):
+            quit_smtp(conn)
+            return
+        self.lock.acquire()
+        try:
+            if self.pid == os.getpid():
+                self.idle.setdefault(self.key(config), []).append(
+                    (time.time(), conn))
+                conn = None
+        finally:
+            self.lock.release()
+        if conn is not None:
+            quit_smtp(conn)
+
+    def clear(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+        for conns in idle.values():
+            for last_used, conn in conns:
+                quit_smtp(conn)
+
+smtp_pool = SMTPConnectionPool()
+
+def quit_smtp(conn):
+    try:
+        conn.quit()
+    except (socket.error, smtplib.SMTPException):
+        conn.close()
+
+def get_mail_queue(config):
+    """Return the MailQueue of the tracker with the given config."""
+    return MailQueue(os.path.join(config.DATABASE, 'mailqueue'))
+
 class SMTPConnection(smtplib.SMTP):
     ''' Open an SMTP connection to the mailhost specified in the config
     '''
@@ -305,6 +601,10 @@ class SMTPConnection(smtplib.SMTP):
         smtplib.SMTP.__init__(self, config.MAILHOST, port=config['MAIL_PORT'],
                               local_hostname=config['MAIL_LOCAL_HOSTNAME'])
 
+        # set by the SMTPConnectionPool when handing out an idle connection
+        self.reused = False
+        self.messages_sent = 0
+
         # start the TLS if requested
         if config["MAIL_TLS"]:
             self.ehlo()
@@ -316,4 +616,9 @@ class SMTPConnection(smtplib.SMTP):
         if mailuser:
             self.login(mailuser, config["MAIL_PASSWORD"])
 
+    def sendmail(self, *args, **kw):
+        result = smtplib.SMTP.sendmail(self, *args, **kw)
+        self.messages_sent += 1
+        return result
+
 # vim: set et sts=4 sw=4 :
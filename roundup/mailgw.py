@@ -95,7 +95,7 @@ explanatory message given in the exception.
 __docformat__ = 'restructuredtext'
 
 import string, re, os, mimetools, cStringIO, smtplib, socket, binascii, quopri
-import time, random, sys, logging
+import time, random, sys, logging, signal
 import traceback
 import email.utils
 
@@ -1312,6 +1312,25 @@ class MailGW:
     # class of MailGW
     parsed_message_class = parsedMessage
 
+    # number of processes handling the messages of a mailbox, POP or
+    # IMAP server (see handle_Messages), set with the -P option
+    processes = 1
+    # number of messages fetched from a server with one command
+    fetch_size = 100
+    # number of messages handed to the processes at a time
+    batch_size = 1000
+    # keep handling the messages delivered to a Maildir or IMAP mailbox
+    # as they arrive, set with the -w option
+    watch = False
+    # seconds between looking for new messages in a Maildir if pyinotify
+    # isn't installed
+    poll_interval = 0.2
+    # seconds an IMAP IDLE command is left running before it's renewed
+    idle_timeout = 600
+    # seconds between looking for new messages on an IMAP server that
+    # doesn't support IDLE
+    imap_poll_interval = 30
+
     def __init__(self, instance, arguments=()):
         self.instance = instance
         self.arguments = arguments
@@ -1319,6 +1338,10 @@ class MailGW:
         for option, value in self.arguments:
             if option == '-c':
                 self.default_class = value.strip()
+            elif option in ('-P', '--processes'):
+                self.processes = int(value)
+            elif option in ('-w', '--watch'):
+                self.watch = True
 
         self.mailer = Mailer(instance.config)
         self.logger = logging.getLogger('roundup.mailgw')
@@ -1358,13 +1381,8 @@ class MailGW:
         # handle and clear the mailbox
         try:
             from mailbox import UnixMailbox
-            mailbox = UnixMailbox(f, factory=Message)
-            # grab one message
-            message = mailbox.next()
-            while message:
-                # handle this message
-                self.handle_Message(message)
-                message = mailbox.next()
+            mailbox = UnixMailbox(f, factory=lambda fp: fp.read())
+            self.handle_Messages(iter(mailbox.next, None))
             # nuke the file contents
             os.ftruncate(f.fileno(), 0)
         except:
@@ -1374,6 +1392,73 @@ class MailGW:
         fcntl.flock(f.fileno(), FCNTL.LOCK_UN)
         return 0
 
+    def do_maildir(self, path):
+        """ Read the messages from the Maildir "path", pass each to the mail
+            handler and remove it once it has been handled. If watch is set, keep waiting for new
+            messages and handle them as they are delivered.
+        """
+        import mailbox
+        maildir = mailbox.Maildir(path, factory=None, create=False)
+        if self.watch:
+            wait = self._maildir_waiter(path)
+            sigterm = self._stop_on_sigterm()
+        try:
+            while True:
+                self.handle_Messages(self._maildir_messages(maildir),
+                    maildir.remove)
+                if not self.watch:
+                    break
+                wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.watch:
+                signal.signal(signal.SIGTERM, sigterm)
+        return 0
+
+    def _stop_on_sigterm(self):
+        ''' Make SIGTERM, which service managers send to stop the mail
+            gateway, stop it like Ctrl-C does: the message being handled
+            is left in the mailbox and those handled before are removed.
+            Return the previous handler.
+        '''
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        return signal.signal(signal.SIGTERM, stop)
+
+    def _maildir_messages(self, maildir):
+        ''' Yield the key and text of the messages of the Maildir in the
+            order of their names, which start with the time they were
+            delivered.
+        '''
+        for key in sorted(maildir.iterkeys()):
+            yield key, maildir.get_string(key)
+
+    def _maildir_waiter(self, path):
+        ''' Return a function waiting until a message is delivered to the
+            Maildir "path". It is notified by inotify if pyinotify is
+            installed, else it looks into the "new" directory every
+            poll_interval seconds.
+        '''
+        new = os.path.join(path, 'new')
+        try:
+            import pyinotify
+        except ImportError:
+            def wait():
+                while not os.listdir(new):
+                    time.sleep(self.poll_interval)
+            return wait
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, lambda event: None)
+        manager.add_watch(new, pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+        def wait():
+            # deliveries since the watch was added are queued already
+            if not os.listdir(new):
+                notifier.check_events()
+            notifier.read_events()
+            notifier.process_events()
+        return wait
+
     def do_imap(self, server, user='', password='', mailbox='', ssl=0,
             cram=0):
         ''' Do an IMAP connection
@@ -1409,6 +1494,8 @@ class MailGW:
             self.logger.exception('IMAP login failure')
             return 1
 
+        if self.watch:
+            sigterm = self._stop_on_sigterm()
         try:
             if not mailbox:
                 (typ, data) = server.select()
@@ -1424,18 +1511,20 @@ class MailGW:
                 self.logger.error('Invalid message count from mailbox %r'%
                     data[0])
                 return 1
-            for i in range(1, numMessages+1):
-                (typ, data) = server.fetch(str(i), '(RFC822)')
-
-                # mark the message as deleted.
-                server.store(str(i), '+FLAGS', r'(\Deleted)')
-
-                # process the message
-                s = cStringIO.StringIO(data[0][1])
-                s.seek(0)
-                self.handle_Message(Message(s))
+            def delete(uid):
+                server.uid('STORE', uid, '+FLAGS', r'(\Deleted)')
+            while True:
+                self.handle_Messages(self._imap_messages(server), delete)
+                if not self.watch:
+                    break
+                server.expunge()
+                numMessages = self._imap_wait(server, mailbox)
             server.close()
+        except KeyboardInterrupt:
+            pass
         finally:
+            if self.watch:
+                signal.signal(signal.SIGTERM, sigterm)
             try:
                 server.expunge()
             except:
@@ -1494,21 +1583,269 @@ class MailGW:
             server.user(user)
             server.pass_(password)
         numMessages = len(server.list()[1])
-        for i in range(1, numMessages+1):
+        self.handle_Messages(self._pop_messages(server, numMessages))
+
+        # quit the server to commit changes.
+        server.quit()
+        return 0
+
+    def _imap_messages(self, server):
+        ''' Fetch the messages of the selected mailbox of the IMAP server
+            that aren't marked as deleted, fetch_size at a time. Yield
+            the UID and text of each message.
+
+            The messages are not marked as deleted here: the caller does
+            it for each message once it has been handled.
+        '''
+        (typ, data) = server.uid('SEARCH', None, 'UNDELETED')
+        if typ != 'OK':
+            raise MailGWError('Failed to search messages: %s'%data)
+        uids = sorted(map(int, data[0].split()))
+        for start in range(0, len(uids), self.fetch_size):
+            messageset = ','.join(map(str, uids[start:start+self.fetch_size]))
+            (typ, data) = server.uid('FETCH', messageset, '(RFC822)')
+            if typ != 'OK':
+                raise MailGWError('Failed to fetch messages %s: %s'%(
+                    messageset, data))
+
+            # the response has a (envelope, text) tuple per message and
+            # a ')' after each; the UID is in the envelope or, for some
+            # servers, after the text
+            messages = []
+            text = None
+            for d in data:
+                if isinstance(d, tuple):
+                    envelope, text = d
+                else:
+                    envelope = d or ''
+                m = re.search(r'\bUID (\d+)', envelope)
+                if m and text is not None:
+                    messages.append((int(m.group(1)), text))
+                    text = None
+            messages.sort()
+            for uid, text in messages:
+                yield str(uid), text
+
+    def _imap_wait(self, server, mailbox):
+        ''' Wait until there are messages in the mailbox of the IMAP server
+            and return their number. The server is asked with IDLE to
+            report new messages if it supports it, else the mailbox is
+            looked into every imap_poll_interval seconds.
+        '''
+        while True:
+            (typ, data) = server.select(mailbox=mailbox or 'INBOX')
+            if typ != 'OK':
+                raise MailGWError('Failed to get mailbox %r: %s'%(mailbox,
+                    data))
+            numMessages = int(data[0])
+            if numMessages:
+                return numMessages
+            if 'IDLE' in server.capabilities:
+                self._imap_idle(server)
+            else:
+                time.sleep(self.imap_poll_interval)
+
+    def _imap_idle(self, server):
+        ''' Run the IDLE command (RFC 2177) until the IMAP server reports
+            that messages exist in the selected mailbox or idle_timeout
+            seconds pass. imaplib doesn't know the command, so it is sent
+            and its responses are read here.
+        '''
+        tag = server._new_tag()
+        server.send('%s IDLE\r\n'%tag)
+        response = server._get_line()
+        if not response.startswith('+'):
+            raise MailGWError('IMAP IDLE failed: %s'%response)
+        # IMAP4_SSL reads from its ssl socket
+        sock = getattr(server, 'sslobj', None) or server.socket()
+        timeout = sock.gettimeout()
+        end = time.time() + self.idle_timeout
+        try:
+            while time.time() < end:
+                sock.settimeout(max(end - time.time(), 0.1))
+                if server._get_line().endswith('EXISTS'):
+                    break
+        except socket.timeout:
+            pass
+        sock.settimeout(timeout)
+        server.send('DONE\r\n')
+        while not server._get_line().startswith(tag):
+            pass
+
+    def _pop_messages(self, server, numMessages):
+        ''' Retrieve the messages from the POP server, sending fetch_size
+            RETR commands at a time if the server supports pipelining,
+            and delete them. Yield the text of each message.
+
+            The deletions only take effect once the caller quits the
+            server, after handling all messages.
+        '''
+        import poplib
+        try:
+            capabilities = server._longcmd('CAPA')[1]
+        except poplib.error_proto:
+            capabilities = []
+        pipelining = 'PIPELINING' in [c.strip().upper()
+            for c in capabilities]
+        for start in range(1, numMessages+1, self.fetch_size):
+            ids = range(start, min(start + self.fetch_size, numMessages+1))
             # retr: returns
             # [ pop response e.g. '+OK 459 octets',
             #   [ array of message lines ],
             #   number of octets ]
-            lines = server.retr(i)[1]
-            s = cStringIO.StringIO('\n'.join(lines))
-            s.seek(0)
-            self.handle_Message(Message(s))
-            # delete the message
-            server.dele(i)
+            if pipelining:
+                for i in ids:
+                    server._putcmd('RETR %d'%i)
+                responses = [server._getlongresp() for i in ids]
+            else:
+                responses = [server.retr(i) for i in ids]
+            for i, (response, lines, octets) in zip(ids, responses):
+                yield '\n'.join(lines)
+                # delete the message
+                server.dele(i)
+
+    def message_keys(self, message):
+        ''' Return the keys of the Message: messages sharing a key must
+            be handled in the order they were received.
+
+            These are the designator or the title in the subject, which
+            find the item the message is about, and the sender, who may
+            be created as a user.
+        '''
+        keys = []
+        for name, address in message.getaddrlist('from'):
+            keys.append('from:' + address.lower())
+        config = self.instance.config
+        subject = message.getheader('subject', '').strip()
+        m = re.match(r'(%s)\s*'%config['MAILGW_REFWD_RE'].pattern, subject,
+            re.IGNORECASE|re.VERBOSE|re.UNICODE)
+        if m:
+            subject = subject[m.end():]
+        sd_open, sd_close = map(re.escape,
+            config['MAILGW_SUBJECT_SUFFIX_DELIMITERS'])
+        m = re.search(r'%s([a-z_]\w*?)(\d+)%s'%(sd_open, sd_close), subject,
+            re.IGNORECASE)
+        if m:
+            keys.append('designator:%s%s'%(m.group(1).lower(), m.group(2)))
+        else:
+            # the title without class name and arguments
+            title = re.sub(r'%s[^%s]*%s'%(sd_open, sd_close, sd_close), '',
+                subject)
+            keys.append('title:' + ' '.join(title.strip(' "').lower().split()))
+        return keys
+
+    def group_messages(self, messages, count):
+        ''' Distribute the Messages among "count" groups, so that messages
+            sharing a key (see message_keys) are in the same group.
+            Return the lists of indexes into "messages" of each group, in
+            the order of the messages.
+        '''
+        # join the messages sharing a key
+        parent = range(len(messages))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        first = {}
+        for i, message in enumerate(messages):
+            for key in self.message_keys(message):
+                if key in first:
+                    parent[find(i)] = find(first[key])
+                else:
+                    first[key] = i
+        joined = {}
+        for i in range(len(messages)):
+            joined.setdefault(find(i), []).append(i)
+
+        # hand the biggest sets of messages to the smallest groups first
+        groups = [[] for i in range(count)]
+        for indexes in sorted(joined.values(), key=len, reverse=True):
+            min(groups, key=len).extend(indexes)
+        for group in groups:
+            group.sort()
+        return groups
+
+    def handle_Messages(self, messages, handled=None):
+        ''' Handle the texts of RFC822 messages from the iterable
+            "messages" with handle_Message.
+
+            If "handled" is given, "messages" yields (key, text) pairs
+            and handled(key) is called once the message has been handled.
+            Messages that weren't handled because of an error are left
+            alone.
+
+            With more than one process, the messages are handled
+            batch_size at a time by that many processes, each opening
+            the tracker database for itself. Messages about the same item
+            or from the same sender are handled by the same process, in
+            the order they were received; see message_keys. They report
+            the keys of the messages they handled to this process, which
+            calls handled for them.
+        '''
+        if handled is None:
+            messages = ((None, text) for text in messages)
+            handled = lambda key: None
+        if self.processes <= 1:
+            for key, text in messages:
+                self.handle_Message(Message(cStringIO.StringIO(text)))
+                handled(key)
+            return
 
-        # quit the server to commit changes.
-        server.quit()
-        return 0
+        batch = []
+        for item in messages:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                self._handle_batch(batch, handled)
+                batch = []
+        if batch:
+            self._handle_batch(batch, handled)
+
+    def _handle_batch(self, items, handled):
+        import multiprocessing, Queue
+        keys = [key for key, text in items]
+        messages = [Message(cStringIO.StringIO(text)) for key, text in items]
+        # the workers share the connection to a POP or IMAP server with
+        # this process, so they send the keys of the handled messages
+        # here instead of calling handled themselves
+        done = multiprocessing.Queue()
+        workers = []
+        for group in self.group_messages(messages, self.processes):
+            if not group:
+                continue
+            # the forked process gets the messages without pickling
+            worker = multiprocessing.Process(target=self._handle_group,
+                args=([(keys[i], messages[i]) for i in group], done.put))
+            worker.start()
+            workers.append(worker)
+        # when interrupted, keep collecting the keys until the workers,
+        # which are usually interrupted too, have exited
+        interrupted = False
+        while True:
+            alive = [w for w in workers if w.is_alive()]
+            try:
+                try:
+                    key = done.get(timeout=0.1)
+                except Queue.Empty:
+                    if not alive:
+                        break
+                    continue
+                handled(key)
+            except KeyboardInterrupt:
+                interrupted = True
+        for worker in workers:
+            worker.join()
+        if interrupted:
+            raise KeyboardInterrupt
+        failed = len([w for w in workers if w.exitcode])
+        if failed:
+            raise MailGWError('%d of %d processes failed handling messages'%(
+                failed, len(workers)))
+
+    def _handle_group(self, messages, handled):
+        for key, message in messages:
+            self.handle_Message(message)
+            handled(key)
 
     def main(self, fp):
         ''' fp - the file from which to read the Message.
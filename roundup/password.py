@@ -20,8 +20,11 @@
 __docformat__ = 'restructuredtext'
 
 import re, string, random
-import os
+import os, time, threading, Queue
+import hashlib, hmac
 from base64 import b64encode, b64decode
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
 from hashlib import md5, sha1
 
 try:
@@ -53,34 +56,45 @@ def h64decode(data):
     else:
         return b64decode(data + "=", "./")
 
+# hashlib has a C implementation of pbkdf2 since python 2.7.8
 try:
-    from M2Crypto.EVP import pbkdf2 as _pbkdf2
+    from hashlib import pbkdf2_hmac as _pbkdf2_hmac
 except ImportError:
-    #no m2crypto - make our own pbkdf2 function
+    _pbkdf2_hmac = None
+
+try:
+    from M2Crypto.EVP import pbkdf2 as _m2_pbkdf2
+except ImportError:
+    _m2_pbkdf2 = None
+
+def _pbkdf2_python(password, salt, rounds, keylen, digest):
+    """pbkdf2 in python, for when neither hashlib nor M2Crypto has it"""
     from struct import pack
-    from hmac import HMAC
-
-    def xor_bytes(left, right):
-        "perform bitwise-xor of two byte-strings"
-        return _bjoin(chr(ord(l) ^ ord(r)) for l, r in zip(left, right))
-
-    def _pbkdf2(password, salt, rounds, keylen):
-        digest_size = 20 # sha1 generates 20-byte blocks
-        total_blocks = int((keylen+digest_size-1)/digest_size)
-        hmac_template = HMAC(password, None, sha1)
-        out = _bempty
-        for i in xrange(1, total_blocks+1):
-            hmac = hmac_template.copy()
-            hmac.update(salt + pack(">L",i))
-            block = tmp = hmac.digest()
-            for j in xrange(rounds-1):
-                hmac = hmac_template.copy()
-                hmac.update(tmp)
-                tmp = hmac.digest()
-                #TODO: need to speed up this call
-                block = xor_bytes(block, tmp)
-            out += block
-        return out[:keylen]
+    digestmod = getattr(hashlib, digest)
+    digest_size = digestmod().digest_size
+    total_blocks = int((keylen+digest_size-1)/digest_size)
+    hmac_template = hmac.HMAC(password, None, digestmod)
+    out = _bempty
+    for i in xrange(1, total_blocks+1):
+        mac = hmac_template.copy()
+        mac.update(salt + pack(">L",i))
+        tmp = mac.digest()
+        # xor the blocks as long integers, much faster than byte-wise
+        block = long(hexlify(tmp), 16)
+        for j in xrange(rounds-1):
+            mac = hmac_template.copy()
+            mac.update(tmp)
+            tmp = mac.digest()
+            block ^= long(hexlify(tmp), 16)
+        out += unhexlify('%0*x' % (digest_size*2, block))
+    return out[:keylen]
+
+def _pbkdf2(password, salt, rounds, keylen, digest='sha1'):
+    if _pbkdf2_hmac is not None:
+        return _pbkdf2_hmac(digest, password, salt, rounds, keylen)
+    if _m2_pbkdf2 is not None and digest == 'sha1' and keylen <= 40:
+        return _m2_pbkdf2(password, salt, rounds, keylen)
+    return _pbkdf2_python(password, salt, rounds, keylen, digest)
 
 def ssha(password, salt):
     ''' Make ssha digest from password and salt.
@@ -92,15 +106,17 @@ def ssha(password, salt):
     ssha_digest = b64encode( '{0}{1}'.format(shaval.digest(), salt) ).strip()
     return ssha_digest
 
-def pbkdf2(password, salt, rounds, keylen):
+def pbkdf2(password, salt, rounds, keylen, digest='sha1'):
     """pkcs#5 password-based key derivation v2.0
 
     :arg password: passphrase to use to generate key (if unicode, converted to utf-8)
     :arg salt: salt string to use when generating key (if unicode, converted to utf-8)
     :param rounds: number of rounds to use to generate key
     :arg keylen: number of bytes to generate
+    :arg digest: name of the hashlib digest used by the HMAC
 
-    If M2Crypto is present, uses it's implementation as backend.
+    Uses the C implementation of hashlib or, failing that, of M2Crypto
+    (sha1 only) if present.
 
     :returns:
         raw bytes of generated key
@@ -109,14 +125,15 @@ def pbkdf2(password, salt, rounds, keylen):
         password = password.encode("utf-8")
     if isinstance(salt, unicode):
         salt = salt.encode("utf-8")
-    if keylen > 40:
+    if keylen > 64:
         #NOTE: pbkdf2 allows up to (2**31-1)*20 bytes,
         # but m2crypto has issues on some platforms above 40,
-        # and such sizes aren't needed for a password hash anyways...
+        # and sizes above the 64 bytes of sha512 aren't needed for a
+        # password hash anyways...
         raise ValueError, "key length too large"
     if rounds < 1:
         raise ValueError, "rounds must be positive number"
-    return _pbkdf2(password, salt, rounds, keylen)
+    return _pbkdf2(password, salt, rounds, keylen, digest)
 
 class PasswordValueError(ValueError):
     """ The password value is not valid """
@@ -141,12 +158,19 @@ def pbkdf2_unpack(pbkdf2):
     raw_salt = h64decode(salt)
     return rounds, salt, raw_salt, digest
 
+# digest and key length of the PBKDF2 schemes
+pbkdf2_schemes = {
+    "PBKDF2": ("sha1", 20),
+    "PBKDF2S5": ("sha512", 64),
+}
+
 def encodePassword(plaintext, scheme, other=None, config=None):
     """Encrypt the plaintext password.
     """
     if plaintext is None:
         plaintext = ""
-    if scheme == "PBKDF2":
+    if scheme in pbkdf2_schemes:
+        hash_name, keylen = pbkdf2_schemes[scheme]
         if other:
             rounds, salt, raw_salt, digest = pbkdf2_unpack(other)
         else:
@@ -158,7 +182,7 @@ def encodePassword(plaintext, scheme, other=None, config=None):
                 rounds = 10000
         if rounds < 1000:
             raise PasswordValueError, "invalid PBKDF2 hash (rounds too low)"
-        raw_digest = pbkdf2(plaintext, raw_salt, rounds, 20)
+        raw_digest = pbkdf2(plaintext, raw_salt, rounds, keylen, hash_name)
         return "%d$%s$%s" % (rounds, salt, h64encode(raw_digest))
     elif scheme == 'SSHA':
         if other:
@@ -262,7 +286,7 @@ class Password(JournalPassword):
     #TODO: code to migrate from old password schemes.
 
     deprecated_schemes = ["SHA", "MD5", "crypt", "plaintext"]
-    known_schemes = ["PBKDF2", "SSHA"] + deprecated_schemes
+    known_schemes = ["PBKDF2", "PBKDF2S5", "SSHA"] + deprecated_schemes
 
     def __init__(self, plaintext=None, scheme=None, encrypted=None, strict=False, config=None):
         """Call setPassword if plaintext is not None."""
@@ -317,6 +341,89 @@ class Password(JournalPassword):
             raise ValueError, 'Password not set'
         return '{%s}%s'%(self.scheme, self.password)
 
+class Verifier:
+    """ Checks plaintext passwords against stored Passwords.
+
+        With "threads" set, the hashing is done by a pool of that many
+        worker threads, so that a burst of logins to a threaded server
+        can't keep all its threads busy hashing.
+
+        With "cache_time" set, successful checks are remembered for that
+        many seconds, for clients that send their password with every
+        request (XML-RPC, HTTP Basic Auth). The cache only holds HMACs of
+        the stored and the given password keyed with a random secret,
+        and only in memory. Changing the password invalidates it.
+    """
+    cache_size = 1000
+
+    def __init__(self, threads=0, cache_time=0):
+        self.cache_time = cache_time
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.secret = os.urandom(32)
+        self.queue = None
+        if threads:
+            self.queue = Queue.Queue()
+            for i in range(threads):
+                worker = threading.Thread(target=self.work)
+                worker.setDaemon(True)
+                worker.start()
+
+    def work(self):
+        while True:
+            stored, plaintext, done, result = self.queue.get()
+            try:
+                result.append(stored == plaintext)
+            except Exception as e:
+                result.append(e)
+            done.set()
+
+    def check(self, stored, plaintext):
+        if self.queue is None:
+            return stored == plaintext
+        done = threading.Event()
+        result = []
+        self.queue.put((stored, plaintext, done, result))
+        done.wait()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def verify(self, stored, plaintext):
+        """ Return whether "plaintext" matches the Password "stored". """
+        if not self.cache_time:
+            return self.check(stored, plaintext)
+        if isinstance(plaintext, unicode):
+            plaintext = plaintext.encode("utf-8")
+        key = hmac.new(self.secret, "%s\0%s" % (stored, plaintext),
+            hashlib.sha256).digest()
+        now = time.time()
+        with self.lock:
+            expires = self.cache.get(key)
+            if expires is not None:
+                if expires > now:
+                    return True
+                del self.cache[key]
+        if not self.check(stored, plaintext):
+            return False
+        with self.lock:
+            self.cache[key] = now + self.cache_time
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return True
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+def get_verifier(threads=0, cache_time=0):
+    """ Return the Verifier of this process with the given settings. """
+    threads, cache_time = int(threads), int(cache_time)
+    with _verifiers_lock:
+        key = (threads, cache_time)
+        if key not in _verifiers:
+            _verifiers[key] = Verifier(threads, cache_time)
+        return _verifiers[key]
+
 def test():
     # SHA
     p = Password('sekrit')
@@ -352,6 +459,14 @@ def test():
     k = pbkdf2("password", "ATHENA.MIT.EDUraeburn", 1200, 32)
     assert k == unhexlify("5c08eb61fdf71e4e4ec3cf6ba1f5512ba7e52ddbc5e5142f708a31e2e62b1e13")
 
+    k = pbkdf2("password", "salt", 1, 64, "sha512")
+    assert k == unhexlify("867f70cf1ade02cff3752599a3a53dc4af34c7a669815ae5"
+        "d513554e1c8cf252c02d470a285a0501bad999bfe943c08f050235d7d68b1da55e"
+        "63f73b60a57fce")
+    for digest in "sha1", "sha512":
+        assert _pbkdf2_python("password", "salt", 1200, 40, digest) == \
+            pbkdf2("password", "salt", 1200, 40, digest)
+
     # PBKDF2 - hash function
     h = "5000$7BvbBq.EZzz/O0HuwX3iP.nAG3s$g3oPnFFaga2BJaX5PoPRljl4XIE"
     assert encodePassword("sekrit", "PBKDF2", h) == h
@@ -363,6 +478,12 @@ def test():
     assert 'sekrit' == p
     assert 'not sekrit' != p
 
+    # PBKDF2S5
+    p = Password('sekrit', 'PBKDF2S5')
+    assert p == 'sekrit'
+    assert p != 'not sekrit'
+    assert not p.needs_migration()
+
 if __name__ == '__main__':
     test()
 
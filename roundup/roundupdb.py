@@ -37,7 +37,7 @@ from roundup.i18n import _
 from roundup.hyperdb import iter_roles
 
 from roundup.mailer import Mailer, MessageSendError, encode_quopri, \
-    nice_sender_header
+    nice_sender_header, get_mail_queue
 
 try:
     import pyme, pyme.core
@@ -134,6 +134,15 @@ class Database:
         return userid
 
 
+    def queue_mail(self, sender, to, message):
+        """Add an outgoing message to the mail queue once the current
+        transaction is committed.
+        """
+        self.transactions.append((self.doQueueMail, (sender, to, message)))
+
+    def doQueueMail(self, sender, to, message):
+        get_mail_queue(self.config).put(sender, to, message)
+
     def log_debug(self, msg, *args, **kwargs):
         """Log a message with level DEBUG."""
 
@@ -513,8 +522,16 @@ class IssueClass:
 
         author = (authname + from_tag, from_address)
 
-        # send an individual message per recipient?
-        if self.db.config.NOSY_EMAIL_SENDING != 'single':
+        # send an individual message per recipient? With "envelope" a
+        # single message goes to everybody but only shows the tracker
+        # address as recipient.
+        sending = self.db.config.NOSY_EMAIL_SENDING
+        if sending == 'envelope' and crypt:
+            # the keys of a message encrypted to everybody would show
+            # the recipients
+            sending = 'multiple'
+        envelope = sending == 'envelope'
+        if sending not in ('single', 'envelope'):
             sendto = [[address] for address in sendto]
         else:
             sendto = [sendto]
@@ -530,8 +547,11 @@ class IssueClass:
         # and/or fixing some day
         first = True
         for sendto in sendto:
-            # create the message
-            mailer = Mailer(self.db.config)
+            # create the message, to be sent on commit if mail is queued
+            if self.db.config.MAIL_QUEUE:
+                mailer = Mailer(self.db.config, queue=self.db.queue_mail)
+            else:
+                mailer = Mailer(self.db.config)
 
             message = mailer.get_standard_message(multipart=message_files)
 
@@ -654,7 +674,12 @@ class IssueClass:
                 send_msg = self.encrypt_to (message, sendto)
             else:
                 send_msg = message
-            mailer.set_message_attributes(send_msg, sendto, subject, author)
+            if envelope:
+                mailer.set_message_attributes(send_msg, [from_address],
+                    subject, author)
+            else:
+                mailer.set_message_attributes(send_msg, sendto, subject,
+                    author)
             if crypt:
                 send_msg ['Message-Id'] = message ['Message-Id']
                 send_msg ['Reply-To'] = message ['Reply-To']
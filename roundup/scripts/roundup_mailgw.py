@@ -45,11 +45,16 @@ def usage(args, message=None):
     if message is not None:
         print message
     print _(
-"""Usage: %(program)s [-v] [-c class] [[-C class] -S field=value]* [instance home] [mail source [specification]]
+"""Usage: %(program)s [-v] [-w] [-c class] [-P processes] [[-C class] -S field=value]* [instance home] [mail source [specification]]
 
 Options:
  -v: print version and exit
  -c: default class of item to create (else the tracker's MAIL_DEFAULT_CLASS)
+ -P: number of processes handling the messages of a mailbox, POP or IMAP
+     server (default 1). Messages about the same item or from the same
+     sender are still handled in the order they were received.
+ -w: keep running and handle the messages delivered to a Maildir or IMAP
+     mailbox as they arrive
  -C / -S: see below
 
 The roundup mail gateway may be called in one of the following ways:
@@ -80,6 +85,14 @@ Mail source "mailbox":
  specified as:
    mailbox /path/to/mailbox
 
+Mail source "maildir":
+ The gateway reads all messages from the Maildir directory, submits
+ each in turn to the roundup.mailgw module and removes it. With -w it
+ keeps watching the Maildir: new messages are handled at once if
+ pyinotify is installed, else within a fraction of a second. The
+ directory is specified as:
+   maildir /path/to/Maildir
+
 In all of the following mail source type the username and password
 can be stored in a ~/.netrc file. If done so case only the server name
 need to be specified on the command-line.
@@ -112,6 +125,9 @@ IMAP:
  It also allows you to specify a specific mailbox other than INBOX using
  this format:
     imap username:password@server mailbox
+ With -w the gateway stays connected and handles new messages as they
+ arrive if the server supports the IDLE command, else it looks for them
+ every 30 seconds.
 
 IMAPS:
  Connect to an IMAP server over ssl.
@@ -132,8 +148,8 @@ def main(argv):
     # take the argv array and parse it leaving the non-option
     # arguments in the args array.
     try:
-        optionsList, args = getopt.getopt(argv[1:], 'vc:C:S:', ['set=',
-            'class='])
+        optionsList, args = getopt.getopt(argv[1:], 'vc:C:S:P:w', ['set=',
+            'class=', 'processes=', 'watch'])
     except getopt.GetoptError:
         # print help information and exit:
         usage(argv)
@@ -143,6 +159,13 @@ def main(argv):
         if opt == '-v':
             print '%s (python %s)'%(roundup_version, sys.version.split()[0])
             return
+        if opt in ('-P', '--processes'):
+            try:
+                if int(arg) < 1:
+                    raise ValueError
+            except ValueError:
+                return usage(argv, _('Error: -P needs a positive number'))
+    watch = [opt for opt, arg in optionsList if opt in ('-w', '--watch')]
 
     # figure the instance home
     if len(args) > 0:
@@ -152,9 +175,14 @@ def main(argv):
     if not (instance_home and os.path.isdir(instance_home)):
         return usage(argv)
 
-    # get the instance
+    if watch and not (len(args) > 1 and (args[1] == 'maildir' or
+            args[1].startswith('imap'))):
+        return usage(argv, _('Error: -w needs a "maildir" or IMAP source'))
+
+    # get the instance, when watching load its schema and detectors
+    # only once
     import roundup.instance
-    instance = roundup.instance.open(instance_home)
+    instance = roundup.instance.open(instance_home, optimize=bool(watch))
 
     if hasattr(instance, 'MailGW'):
         handler = instance.MailGW(instance, optionsList)
@@ -171,12 +199,14 @@ def main(argv):
     source, specification = args[1:3]
 
     # time out net connections after a minute if we can
-    if source not in ('mailbox', 'imaps', 'imaps_cram'):
+    if source not in ('mailbox', 'maildir', 'imaps', 'imaps_cram'):
         if hasattr(socket, 'setdefaulttimeout'):
             socket.setdefaulttimeout(60)
 
     if source == 'mailbox':
         return handler.do_mailbox(specification)
+    if source == 'maildir':
+        return handler.do_maildir(specification)
 
     # the source will be a network server, so obtain the credentials to
     # use in connecting to the server
@@ -219,7 +249,7 @@ def main(argv):
             cram)
 
     return usage(argv, _('Error: The source must be either "mailbox",'
-        ' "pop", "pops", "apop", "imap", "imaps" or "imaps_cram'))
+        ' "maildir", "pop", "pops", "apop", "imap", "imaps" or "imaps_cram'))
 
 def run():
     sys.exit(main(sys.argv))
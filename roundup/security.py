@@ -2,6 +2,7 @@
 """
 __docformat__ = 'restructuredtext'
 
+import copy
 import weakref
 
 from roundup import hyperdb, support
@@ -17,6 +18,7 @@ class Permission:
         - properties (optional)
         - check function (optional)
         - props_only (optional, internal field is limit_perm_to_props_only)
+        - filter function (optional)
 
         The klass may be unset, indicating that this permission is not
         locked to a particular class. That means there may be multiple
@@ -41,12 +43,19 @@ class Permission:
            db.security.set_props_only_default()
 
         with a True or False value.
+
+        If filter function is set, it describes the items the check
+        function grants access to as filter expressions, so that
+        searches can be restricted in the database instead of calling
+        the check function for every item found. The function is called
+        with arguments db, userid, klass and returns a list of
+        filterspecs: an item passes if it matches any of them.
     '''
 
     limit_perm_to_props_only=False
 
     def __init__(self, name='', description='', klass=None,
-            properties=None, check=None, props_only=None):
+            properties=None, check=None, props_only=None, filter=None):
         from roundup.anypy import findargspec
         self.name = name
         self.description = description
@@ -54,6 +63,7 @@ class Permission:
         self.properties = properties
         self._properties_dict = support.TruthDict(properties)
         self.check = check
+        self.filter = filter
         if properties is not None:
             # Set to None unless properties are defined.
             # This means that:
@@ -201,6 +211,16 @@ class Security:
         # roles are mapped by name to the Role
         self.role = {}
 
+        # compiled permission lookups: maps (rolenames, permission,
+        # classname, property) to (granted, checks) where granted is
+        # true if a Permission without check function matches and
+        # checks lists the matching Permissions with a check function
+        self.compiled = {}
+
+        # the valid roles of users, cleared with the db cache
+        self.user_roles = {}
+        db.registerClearCacheCallback(self.clear_user_roles)
+
         # the default Roles
         self.addRole(name="User", description="A regular user, no privs")
         self.addRole(name="Admin", description="An admin user, full privs")
@@ -218,6 +238,78 @@ class Security:
         from roundup import mailgw
         mailgw.initialiseSecurity(self)
 
+    def bind(self, db):
+        ''' Return a copy of this Security object for use with database
+            'db'.  The Roles and Permissions are shared with the copy.
+        '''
+        security = copy.copy(self)
+        security.db = weakref.proxy(db)
+        security.user_roles = {}
+        db.registerClearCacheCallback(security.clear_user_roles)
+        return security
+
+    def clear_user_roles(self, userid=None):
+        ''' Forget the cached roles of user "userid", or of all users.
+            Called when the database cache is cleared (i.e. on commit
+            and rollback) and when a user is changed.
+        '''
+        if userid is None:
+            self.user_roles = {}
+        else:
+            self.user_roles.pop(userid, None)
+
+    def clear_compiled(self):
+        ''' Forget compiled permission lookups after Roles or their
+            Permissions changed.
+        '''
+        self.compiled.clear()
+        self.user_roles = {}
+
+    def get_user_roles(self, userid):
+        ''' Return the names of the known roles of the user as a tuple.
+        '''
+        roles = self.user_roles.get(userid)
+        if roles is None:
+            roles = tuple([r for r in self.db.user.get_roles(userid)
+                if r and r in self.role])
+            self.user_roles[userid] = roles
+        return roles
+
+    def compile(self, rolenames, permission, classname, property):
+        ''' Return (granted, checks) for the given roles: granted is
+            true if any of their Permissions matches without a check
+            function, checks lists the matching Permissions that have a
+            check function (in role order).
+        '''
+        key = (rolenames, permission, classname, property)
+        # the permission lists of roles may be replaced or appended to
+        # directly, the result is only valid for the same lists
+        state = [(id(self.role[rolename].permissions),
+            len(self.role[rolename].permissions)) for rolename in rolenames]
+        try:
+            result, known = self.compiled[key]
+            if known == state:
+                return result
+        except KeyError:
+            pass
+        granted = 0
+        checks = []
+        for rolename in rolenames:
+            for perm in self.role[rolename].permissions:
+                # with no itemid, test() doesn't call the check function
+                if not perm.test(self.db, permission, classname, property,
+                        None, None):
+                    continue
+                if perm.check is None:
+                    granted = 1
+                    break
+                checks.append(perm)
+            if granted:
+                break
+        result = (granted, checks)
+        self.compiled[key] = (result, state)
+        return result
+
     def getPermission(self, permission, classname=None, properties=None,
             check=None, props_only=None):
         ''' Find the Permission matching the name and for the class, if the
@@ -276,15 +368,17 @@ class Security:
         '''
         if itemid and classname is None:
             raise ValueError, 'classname must accompany itemid'
-        for rolename in self.db.user.get_roles(userid):
-            if not rolename or (rolename not in self.role):
-                continue
-            # for each of the user's Roles, check the permissions
-            for perm in self.role[rolename].permissions:
-                # permission match?
-                if perm.test(self.db, permission, classname, property,
-                        userid, itemid):
-                    return 1
+        granted, checks = self.compile(self.get_user_roles(userid),
+            permission, classname, property)
+        if granted:
+            return 1
+        if itemid is None:
+            # check functions only apply to items
+            return checks and 1 or 0
+        for perm in checks:
+            if perm.test(self.db, permission, classname, property,
+                    userid, itemid):
+                return 1
         return 0
 
     def roleHasSearchPermission(self, classname, property, *rolenames):
@@ -358,8 +452,7 @@ class Security:
            either no properties listed or the property must appear in
            the list.
         '''
-        roles = [r for r in self.db.user.get_roles(userid)
-                 if r and (r in self.role)]
+        roles = self.get_user_roles(userid)
         return self.roleHasSearchPermission (classname, property, *roles)
 
     def addPermission(self, **propspec):
@@ -369,6 +462,7 @@ class Security:
         '''
         perm = Permission(**propspec)
         self.permission.setdefault(perm.name, []).append(perm)
+        self.clear_compiled()
         return perm
 
     def addRole(self, **propspec):
@@ -376,6 +470,7 @@ class Security:
         '''
         role = Role(**propspec)
         self.role[role.name] = role
+        self.clear_compiled()
         return role
 
     def set_props_only_default(self, props_only=None):
@@ -406,6 +501,7 @@ class Security:
                 properties, check, props_only)
         role = self.role[rolename.lower()]
         role.permissions.append(permission)
+        self.clear_compiled()
 
     # Convenience methods for removing non-allowed properties from a
     # filterspec or sort/group list
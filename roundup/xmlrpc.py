@@ -99,10 +99,9 @@ class RoundupInstance:
         filterspec = security.filterFilterspec (uid, classname, filterspec)
         sort = security.filterSortspec (uid, classname, sort)
         group = security.filterSortspec (uid, classname, group)
-        result = cl.filter(search_matches, filterspec, sort=sort, group=group)
-        check = security.hasPermission
-        x = [id for id in result if check('View', uid, classname, itemid=id)]
-        return x
+        result = cl.filter_with_permissions(search_matches, filterspec,
+            sort=sort, group=group, userid=uid)
+        return list(result)
 
     def lookup(self, classname, key):
         cl = self.db.getclass(classname)
@@ -0,0 +1,92 @@
+""" Measure searches of the anydbm backend scanning all items and using
+the secondary indexes.
+
+Run from the top of the source tree:
+
+    python test/benchmark_anydbm_index.py [issues [rounds]]
+"""
+import sys, os, shutil, time, random
+
+from roundup import configuration, init, instance, password, date
+
+def setupTracker(dirname, issues):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        'classic'))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = 'anydbm'
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+    db = tracker.open('admin')
+    users = [db.user.create(username='user%d'%i) for i in range(20)]
+    db.commit()
+    for i in range(issues):
+        db.issue.create(title='index benchmark %d'%i,
+            status=random.choice(db.status.list()),
+            priority=random.choice(db.priority.list()),
+            assignedto=random.choice(users + [None]),
+            nosy=random.sample(users, 3))
+        if not i % 500:
+            db.commit()
+    db.commit()
+    db.close()
+    return tracker
+
+QUERIES = (
+    ('filter Link', lambda db: db.issue.filter(None, {'status': '2'})),
+    ('filter unset Link', lambda db: db.issue.filter(None,
+        {'assignedto': '-1', 'status': '1'})),
+    ('filter Multilink', lambda db: db.issue.filter(None, {'nosy': '5'})),
+    ('filter Date', lambda db: db.issue.filter(None,
+        {'activity': '-1m;', 'priority': '1'})),
+    ('find', lambda db: db.issue.find(assignedto='7')),
+    ('lookup', lambda db: db.user.lookup('user13')),
+)
+
+def measure(tracker, rounds):
+    timings = []
+    for name, query in QUERIES:
+        # each round opens the database, like a web request does, so
+        # that no items are cached
+        elapsed = 0
+        for i in range(rounds):
+            db = tracker.open('admin')
+            start = time.time()
+            query(db)
+            elapsed += time.time() - start
+            db.close()
+        timings.append(elapsed / rounds * 1000)
+    return timings
+
+def main(issues=5000, rounds=5):
+    dirname = '_benchmark_anydbm_index'
+    random.seed(42)
+    tracker = setupTracker(dirname, issues)
+    print '%d issues'%issues
+    try:
+        tracker.config.RDBMS_ANYDBM_INDEXES = False
+        scan = measure(tracker, rounds)
+        tracker.config.RDBMS_ANYDBM_INDEXES = True
+        # build the indexes
+        db = tracker.open('admin')
+        start = time.time()
+        for classname in 'issue', 'user':
+            cldb = db.getclassdb(classname)
+            db.getnodeindex(classname, cldb)
+            cldb.close()
+        print 'indexes built in %.1f ms'%((time.time() - start) * 1000)
+        db.close()
+        indexed = measure(tracker, rounds)
+        print 'Query                scan ms  index ms'
+        for (name, query), s, i in zip(QUERIES, scan, indexed):
+            print '%-18s %9.1f %9.1f'%(name, s, i)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
+
+# vim: set et sts=4 sw=4 :
@@ -0,0 +1,85 @@
+""" Measure reading a long journal stored in the legacy repr() format and
+in the current marshalled format.
+
+Run from the top of the source tree:
+
+    python test/benchmark_journal.py [backend [entries [rounds]]]
+"""
+import sys, os, shutil, time
+
+from roundup import configuration, init, instance, password
+from roundup.backends.rdbms_common import journal_loads
+
+def setupTracker(dirname, backend, entries):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        'classic'))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = backend
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+    db = tracker.open('admin')
+    issue = db.issue.create(title='journal benchmark')
+    for i in range(entries - 1):
+        db.issue.set(issue, title='journal benchmark %d'%i,
+            priority=str(i % 4 + 1), status=str(i % 8 + 1))
+    db.commit()
+    db.close()
+    return tracker, issue
+
+def to_legacy(db):
+    """ Rewrite the issue journal the way older versions stored it. """
+    db.sql('select nodeid, date, tag, action, params from issue__journal')
+    rows = db.cursor.fetchall()
+    db.sql('delete from issue__journal')
+    for nodeid, jdate, tag, action, params in rows:
+        params = journal_loads(params)
+        if isinstance(params, dict):
+            # _journal_marshal() converts the values in place
+            db.decode_journal_params('issue', params)
+            db._journal_marshal(params, 'issue')
+        db.sql('insert into issue__journal values (%s,%s,%s,%s,%s)'%(
+            (db.arg,)*5), (nodeid, jdate, tag, action, repr(params)))
+    db.commit()
+
+def measure(tracker, issue, rounds):
+    db = tracker.open('admin')
+    timings = []
+    for reader in (lambda: db.getjournal('issue', issue),
+            lambda: db.issue.history(issue)):
+        start = time.time()
+        for i in range(rounds):
+            reader()
+        timings.append((time.time() - start) / rounds * 1000)
+    db.close()
+    return timings
+
+def main(backend='sqlite', entries=500, rounds=20):
+    dirname = '_benchmark_journal'
+    tracker, issue = setupTracker(dirname, backend, entries)
+    print 'backend %s, %d journal entries'%(backend, entries)
+    print 'Format  getjournal ms  history ms'
+    try:
+        db = tracker.open('admin')
+        to_legacy(db)
+        db.close()
+        print 'repr   %13.1f %11.1f'%tuple(measure(tracker, issue, rounds))
+        db = tracker.open('admin')
+        db.convert_journal('issue')
+        db.commit()
+        db.close()
+        print 'm2     %13.1f %11.1f'%tuple(measure(tracker, issue, rounds))
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    for i in 1, 2:
+        if len(args) > i:
+            args[i] = int(args[i])
+    main(*args)
+
+# vim: set et sts=4 sw=4 :
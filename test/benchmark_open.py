@@ -0,0 +1,48 @@
+""" Measure the cost of Tracker.open() with and without share_schema.
+
+Run from the top of the source tree:
+
+    python test/benchmark_open.py [backend [template [count]]]
+"""
+import sys, os, shutil, time
+
+from roundup import configuration, init, instance, password
+
+def setupTracker(dirname, backend, template):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        template))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = backend
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+
+def main(backend='sqlite', template='classic', count=100):
+    dirname = '_benchmark_open'
+    setupTracker(dirname, backend, template)
+    print 'backend %s, template %s, %d opens' % (backend, template, count)
+    print 'Mode            per open (ms)'
+    try:
+        for share in 'no', 'yes':
+            tracker = instance.open(dirname, optimize=1)
+            tracker.config.SHARE_SCHEMA = share
+            # the first open builds the schema in both modes
+            tracker.open('admin').close()
+            start = time.time()
+            for i in range(count):
+                tracker.open('admin').close()
+            print 'share_schema=%-3s %8.2f' % (share,
+                (time.time() - start) * 1000 / count)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 2:
+        args[2] = int(args[2])
+    main(*args)
+
+# vim: set et sts=4 sw=4 :
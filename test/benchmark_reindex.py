@@ -0,0 +1,66 @@
+""" Measure the throughput of a full reindex with various batch sizes and
+numbers of processes.
+
+Run from the top of the source tree:
+
+    python test/benchmark_reindex.py [backend [messages [processes]]]
+"""
+import sys, os, shutil, time, random
+
+from roundup import configuration, init, instance, password
+
+WORDS = '''alpha bravo charlie delta echo foxtrot golf hotel india juliet
+kilo lima mike november oscar papa quebec romeo sierra tango uniform
+victor whiskey xray yankee zulu roundup tracker issue message nosy
+priority status keyword superseder assigned resolved'''.split()
+
+def setupTracker(dirname, backend, messages):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        'classic'))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = backend
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+    db = tracker.open('admin')
+    for i in range(messages):
+        content = ' '.join([random.choice(WORDS) for n in range(200)])
+        m = db.msg.create(content=content, author='1')
+        if not i % 10:
+            db.issue.create(title=' '.join(random.sample(WORDS, 5)),
+                messages=[m])
+    db.commit()
+    db.close()
+    return tracker
+
+def main(backend='sqlite', messages=1000, processes=4):
+    dirname = '_benchmark_reindex'
+    random.seed(42)
+    tracker = setupTracker(dirname, backend, messages)
+    print 'backend %s, %d messages'%(backend, messages)
+    print 'Batch Processes  items/s'
+    try:
+        for batch_size, nproc in (1, None), (100, None), (100, processes):
+            db = tracker.open('admin')
+            items = len(db.msg.list()) + len(db.issue.list())
+            start = time.time()
+            db.reindex('msg', batch_size=batch_size, processes=nproc)
+            db.reindex('issue', batch_size=batch_size, processes=nproc)
+            db.commit()
+            print '%5d %9s %8.1f'%(batch_size, nproc or 1,
+                items / (time.time() - start))
+            db.close()
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    for i in 1, 2:
+        if len(args) > i:
+            args[i] = int(args[i])
+    main(*args)
+
+# vim: set et sts=4 sw=4 :
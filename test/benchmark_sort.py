@@ -0,0 +1,74 @@
+""" Measure sorting issues of the sqlite backend by Multilink properties
+in the database and in Python.
+
+Run from the top of the source tree:
+
+    python test/benchmark_sort.py [issues [rounds]]
+"""
+import sys, os, shutil, time, random
+
+from roundup import configuration, init, instance, password
+
+def setupTracker(dirname, issues):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        'classic'))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = 'sqlite'
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+    db = tracker.open('admin')
+    users = [db.user.create(username='user%d'%i) for i in range(50)]
+    keywords = [db.keyword.create(name='keyword%d'%i) for i in range(20)]
+    for i in range(issues):
+        m = db.msg.create(content='message %d'%i, author=random.choice(users))
+        db.issue.create(title='sort benchmark %d'%i, messages=[m],
+            nosy=random.sample(users, random.randint(0, 4)),
+            keyword=random.sample(keywords, random.randint(0, 2)))
+    db.commit()
+    db.close()
+    return tracker
+
+SORTS = (
+    ('nosy', [('+', 'nosy')]),
+    ('keyword', [('-', 'keyword')]),
+    ('messages.author', [('+', 'messages.author')]),
+    ('messages.date', [('-', 'messages.date')]),
+)
+
+def measure(tracker, sort, rounds, limit, python):
+    elapsed = 0
+    for i in range(rounds):
+        db = tracker.open('admin')
+        if python:
+            # don't let the database sort by the Multilink
+            db.issue._multilink_sort = lambda proptree: {}
+        start = time.time()
+        db.issue.filter(None, {}, sort, limit=limit)
+        elapsed += time.time() - start
+        db.close()
+    return elapsed / rounds * 1000
+
+def main(issues=5000, rounds=5):
+    dirname = '_benchmark_sort'
+    random.seed(42)
+    tracker = setupTracker(dirname, issues)
+    print '%d issues'%issues
+    print 'Sort              Limit  python ms  database ms'
+    try:
+        for name, sort in SORTS:
+            for limit in None, 50:
+                python = measure(tracker, sort, rounds, limit, True)
+                database = measure(tracker, sort, rounds, limit, False)
+                print '%-16s %6s %10.1f %12.1f'%(name, limit or '-', python,
+                    database)
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
+
+# vim: set et sts=4 sw=4 :
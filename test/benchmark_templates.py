@@ -0,0 +1,93 @@
+""" Measure rendering pages of the classic and devel templates with the
+interpreted and the compiled zopetal engine.
+
+Run from the top of the source tree:
+
+    python test/benchmark_templates.py [issues [rounds]]
+"""
+import sys, os, shutil, time
+
+from roundup import configuration, init, instance, password
+from roundup.cgi import client, templating
+
+from mocknull import MockNull
+
+# the templates and the class of their issues
+TEMPLATES = (('classic', 'issue'), ('devel', 'bug'))
+
+def setupTracker(dirname, template, classname, issues):
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    init.install(dirname, os.path.join('share', 'roundup', 'templates',
+        template))
+    config = configuration.CoreConfig(dirname)
+    config.RDBMS_BACKEND = 'sqlite'
+    config.MAIL_DOMAIN = 'your.tracker.email.domain.example'
+    config.TRACKER_WEB = 'http://tracker.example/cgi-bin/roundup.cgi/bugs/'
+    config.save(os.path.join(dirname, 'config.ini'))
+    tracker = instance.open(dirname)
+    tracker.init(password.Password('sekrit'))
+    db = tracker.open('admin')
+    for i in range(issues):
+        m = db.msg.create(content='message %d'%i, author='1')
+        db.getclass(classname).create(title='template benchmark %d'%i,
+            messages=[m], nosy=['1'])
+    db.commit()
+    db.close()
+    return tracker
+
+def measure(tracker, classname, loaders, rounds):
+    """ Return the milliseconds per page for each loader, rendering the
+        pages in turn with each loader so they see the same database.
+    """
+    db = tracker.open('admin')
+    cl = client.Client(tracker, None, {'PATH_INFO': '/',
+        'REQUEST_METHOD': 'GET'}, form={})
+    cl.db = db
+    cl.userid = '1'
+    cl.language = ('en',)
+    cl.session_api = MockNull(_sid='1234567890')
+    cl._error_message = []
+    cl._ok_message = []
+    timings = [[] for loader in loaders]
+    for path, template in (classname, 'index'), (classname + '1', 'item'):
+        cl.form = client.cgi.FieldStorage(environ={'QUERY_STRING':
+            '@template=%s'%template, 'REQUEST_METHOD': 'GET'})
+        cl.path = path
+        cl.determine_context()
+        elapsed = [0] * len(loaders)
+        for i in range(rounds + 1):
+            for n, loader in enumerate(loaders):
+                tracker.templates = loader
+                start = time.time()
+                cl.renderContext()
+                # the first round loads the templates
+                if i:
+                    elapsed[n] += time.time() - start
+            # every page adds a csrf key, don't let them pile up
+            db.getOTKManager().clear()
+        for n in range(len(loaders)):
+            timings[n].append(elapsed[n] / rounds * 1000)
+    db.close()
+    return timings
+
+def main(issues=50, rounds=20):
+    dirname = '_benchmark_templates'
+    print '%d issues'%issues
+    print 'Template Engine       index ms  item ms'
+    try:
+        for template, classname in TEMPLATES:
+            tracker = setupTracker(dirname, template, classname, issues)
+            html = tracker.config['TEMPLATES']
+            loaders = [templating.get_loader(html, 'zopetal',
+                compiled=compiled) for compiled in False, True]
+            timings = measure(tracker, classname, loaders, rounds)
+            for engine, t in zip(('interpreted', 'compiled'), timings):
+                print '%-8s %-11s %9.1f %8.1f'%(template, engine, t[0], t[1])
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
+
+# vim: set et sts=4 sw=4 :
@@ -23,7 +23,7 @@ from email.parser import FeedParser
 import pytest
 from roundup.hyperdb import String, Password, Link, Multilink, Date, \
     Interval, DatabaseError, Boolean, Number, Node, Integer
-from roundup.mailer import Mailer
+from roundup.mailer import Mailer, get_mail_queue
 from roundup import date, password, init, instance, configuration, \
     roundupdb, i18n, hyperdb
 from roundup.cgi.templating import HTMLItem
@@ -692,6 +692,69 @@ class DBTest(commonDBTest):
         b = self.db.issue.get('1', 'title')
         self.assertEqual(b, 'ham')
 
+    def testGetNodes(self):
+        ae = self.assertEqual
+        u1 = self.db.user.create(username='u1')
+        u2 = self.db.user.create(username='u2')
+        i1 = self.db.issue.create(title='spam', status='1', nosy=[u2, u1])
+        i2 = self.db.issue.create(title='ham', status='2')
+        i3 = self.db.issue.create(title='eggs', nosy=[u1])
+        self.db.commit()
+        self.db.clearCache()
+        queries = []
+        if hasattr(self.db, 'sql'):
+            sql = self.db.sql
+            def counting_sql(*args, **kw):
+                queries.append(args[0])
+                return sql(*args, **kw)
+            self.db.sql = counting_sql
+        nodes = self.db.issue.getnodes([i3, i1, i2], props=['nosy'])
+        if hasattr(self.db, 'sql'):
+            # one query for the items and one for the nosy lists
+            ae(len(queries), 2)
+        ae([n.title for n in nodes], ['eggs', 'spam', 'ham'])
+        ae([sorted(n.nosy) for n in nodes], [[u1], sorted([u1, u2]), []])
+        ae(nodes[1].status, '1')
+        del queries[:]
+        ae(sorted(self.db.issue.get(i1, 'nosy')), sorted([u1, u2]))
+        ae(self.db.issue.get(i2, 'title'), 'ham')
+        ae(queries, [])
+        self.assertRaises(IndexError, self.db.issue.getnodes, [i1, '99'])
+
+    def testJournalStorage(self):
+        # the SQL backends store the journal params without repr()
+        if not hasattr(self.db, 'sql'):
+            return
+        from roundup.backends import rdbms_common
+        ae = self.assertEqual
+        id = self.db.issue.create(title='spam', status='1')
+        self.db.issue.set(id, title='ham', deadline=date.Date('2007-01-01'))
+        self.db.commit()
+        a = self.db.arg
+        sql = 'select params from issue__journal where nodeid=%s'%a
+        self.db.sql(sql, (id,))
+        for row in self.db.cursor.fetchall():
+            self.assert_(row[0].startswith('m2:'))
+
+        # entries written by older versions hold the repr() of the params
+        old = date.Date('2006-01-01')
+        self.db.sql('update issue__journal set params=%s where action=%s'%(
+            a, a), (repr({'title': 'spam', 'deadline':
+            self.db.to_sql_value(Date)(old)}), 'set'))
+        def check():
+            journal = self.db.getjournal('issue', id)
+            ae([j[3] for j in journal], ['create', 'set'])
+            ae(journal[1][4]['title'], 'spam')
+            ae(str(journal[1][4]['deadline']), str(old))
+        check()
+        self.db.convert_journal('issue')
+        self.db.sql(sql, (id,))
+        for row in self.db.cursor.fetchall():
+            self.assert_(row[0].startswith('m2:'))
+        check()
+        self.assertRaises(ValueError, rdbms_common.journal_loads,
+            "{'title': __import__('os').getcwd()}")
+
     def testSerialisation(self):
         nid = self.db.issue.create(title="spam", status='1',
             deadline=date.Date(), foo=date.Interval('-1d'))
@@ -1332,6 +1395,38 @@ class DBTest(commonDBTest):
             self.assertEqual(len(result), 2)
             self.assertEqual(result [1][4], jp0)
 
+    def testJournalSelection(self):
+        ae = self.assertEqual
+        id = self.db.issue.create(title='spam', status='1')
+        for day in range(1, 7):
+            if day % 3:
+                params = {'title': 'spam%d'%day}
+            else:
+                # assignedto is quiet, history() doesn't show these
+                params = {'assignedto': '1'}
+            self.db.addjournal('issue', id, 'set', params,
+                creation=date.Date('2010-01-0%d.12:00'%day))
+        self.db.commit()
+        days = lambda journal: [j[1].day for j in journal]
+        r = '2010-01-01;2010-12-31'
+        ae(days(self.db.getjournal('issue', id, daterange=r)),
+            [1, 2, 3, 4, 5, 6])
+        ae(days(self.db.getjournal('issue', id,
+            daterange='2010-01-02;2010-01-04')), [2, 3])
+        ae(days(self.db.getjournal('issue', id, daterange=r,
+            direction='descending', limit=2, offset=1)), [5, 4])
+        ae([j[3] for j in self.db.getjournal('issue', id,
+            actions=['create'])], ['create'])
+        ae(self.db.getjournal('issue', id, actions=[]), [])
+
+        # history() reads more of the journal when entries are hidden
+        ae(days(self.db.issue.history(id, daterange=r)), [1, 2, 4, 5])
+        ae(days(self.db.issue.history(id, daterange=r,
+            direction='descending', limit=3)), [5, 4, 2])
+        ae(days(self.db.issue.history(id, daterange=r, limit=2,
+            offset=2)), [4, 5])
+        ae(days(self.db.issue.history(id, daterange=r, offset=3)), [5])
+
     def testJournalPreCommit(self):
         id = self.db.user.create(username="mary")
         self.assertEqual(len(self.db.getjournal('user', id)), 1)
@@ -1480,6 +1575,49 @@ class DBTest(commonDBTest):
         self.assertEquals(self.db.indexer.search(['flebble'], self.db.issue),
             {'1': {}})
 
+    def testReindexBatches(self):
+        search = self.db.indexer.search
+        m1 = self.db.msg.create(content="one two")
+        m2 = self.db.msg.create(content="two three")
+        i1 = self.db.issue.create(title="flebble plop", messages=[m1])
+        i2 = self.db.issue.create(title="flebble frooz", messages=[m2])
+        i3 = self.db.issue.create(title="frooz")
+        self.db.commit()
+        self.db.reindex(batch_size=2, processes=2)
+        self.db.commit()
+        self.assertEquals(search(['flebble'], self.db.issue),
+            {i1: {}, i2: {}})
+        self.assertEquals(search(['frooz'], self.db.issue), {i2: {}, i3: {}})
+        self.assertEquals(search(['two'], self.db.issue),
+            {i1: {'messages': [m1]}, i2: {'messages': [m2]}})
+
+    def testReindexResume(self):
+        for title in 'one', 'two', 'three', 'four', 'five':
+            self.db.issue.create(title=title)
+        self.db.commit()
+        state_file = os.path.join(config.DATABASE, 'reindex-state')
+        open(state_file, 'w').write('{"issue": "2"}')
+        indexed = []
+        def add_texts(entries, pool=None):
+            indexed.extend([identifier[1] for identifier, text, mime_type
+                in entries if identifier[2] == 'title'])
+        self.db.indexer.add_texts = add_texts
+        self.db.reindex('issue', batch_size=2, state_file=state_file)
+        self.assertEquals(indexed, ['3', '4', '5'])
+        self.failIf(os.path.exists(state_file))
+
+    def testReindexSmall(self):
+        # fewer items than one batch never write the state file
+        state_file = os.path.join(config.DATABASE, 'reindex-state')
+        self.db.reindex('status', state_file=state_file)
+        i1 = self.db.issue.create(title="flebble")
+        self.db.commit()
+        self.db.reindex(batch_size=100, state_file=state_file)
+        self.db.commit()
+        self.assertEquals(self.db.indexer.search(['flebble'], self.db.issue),
+            {i1: {}})
+        self.failIf(os.path.exists(state_file))
+
     def testIndexingPropertiesOnImport(self):
         # import an issue
         title = 'Bzzt'
@@ -1886,28 +2024,46 @@ class DBTest(commonDBTest):
         # Note the sort order for the multilink doen't change when
         # reversing the sort direction due to the re-sorting of the
         # multilink!
-        # Note that we don't test filter_iter here, Multilink sort-order
-        # isn't defined for that.
-        ae, filt, dummy = self.filteringSetup()
-        ae(filt(None, {}, ('+','nosy'), (None,None)), ['1', '2', '4', '3'])
-        ae(filt(None, {}, ('-','nosy'), (None,None)), ['4', '3', '1', '2'])
+        ae, filter, filter_iter = self.filteringSetup()
+        for filt in filter, filter_iter:
+            ae(filt(None, {}, ('+','nosy'), (None,None)), ['1', '2', '4', '3'])
+            ae(filt(None, {}, ('-','nosy'), (None,None)), ['4', '3', '1', '2'])
+
+    def testFilteringMultilinkSortPrefix(self):
+        # ['a', 'c'] sorts before ['ab'] like in Python, whatever the
+        # collation of the database
+        ae, filter, filter_iter = self.iterSetup()
+        a, c, ab = [self.db.user.create(username=n) for n in ('a', 'c', 'ab')]
+        i1 = self.db.issue.create(title='one', nosy=[ab])
+        i2 = self.db.issue.create(title='two', nosy=[a, c])
+        self.db.commit()
+        for filt in filter, filter_iter:
+            ae(filt(None, {}, ('+','nosy.username')), [i2, i1])
+            ae(filt(None, {}, ('-','nosy.username')), [i2, i1])
 
     def testFilteringMultilinkSortGroup(self):
         # 1: status: 2 "in-progress" nosy: []
         # 2: status: 1 "unread"      nosy: []
         # 3: status: 1 "unread"      nosy: ['admin','fred']
         # 4: status: 3 "testing"     nosy: ['admin','bleep','fred']
-        # Note that we don't test filter_iter here, Multilink sort-order
-        # isn't defined for that.
-        ae, filt, dummy = self.filteringSetup()
-        ae(filt(None, {}, ('+','nosy'), ('+','status')), ['1', '4', '2', '3'])
-        ae(filt(None, {}, ('-','nosy'), ('+','status')), ['1', '4', '3', '2'])
-        ae(filt(None, {}, ('+','nosy'), ('-','status')), ['2', '3', '4', '1'])
-        ae(filt(None, {}, ('-','nosy'), ('-','status')), ['3', '2', '4', '1'])
-        ae(filt(None, {}, ('+','status'), ('+','nosy')), ['1', '2', '4', '3'])
-        ae(filt(None, {}, ('-','status'), ('+','nosy')), ['2', '1', '4', '3'])
-        ae(filt(None, {}, ('+','status'), ('-','nosy')), ['4', '3', '1', '2'])
-        ae(filt(None, {}, ('-','status'), ('-','nosy')), ['4', '3', '2', '1'])
+        ae, filter, filter_iter = self.filteringSetup()
+        for filt in filter, filter_iter:
+            ae(filt(None, {}, ('+','nosy'), ('+','status')),
+                ['1', '4', '2', '3'])
+            ae(filt(None, {}, ('-','nosy'), ('+','status')),
+                ['1', '4', '3', '2'])
+            ae(filt(None, {}, ('+','nosy'), ('-','status')),
+                ['2', '3', '4', '1'])
+            ae(filt(None, {}, ('-','nosy'), ('-','status')),
+                ['3', '2', '4', '1'])
+            ae(filt(None, {}, ('+','status'), ('+','nosy')),
+                ['1', '2', '4', '3'])
+            ae(filt(None, {}, ('-','status'), ('+','nosy')),
+                ['2', '1', '4', '3'])
+            ae(filt(None, {}, ('+','status'), ('-','nosy')),
+                ['4', '3', '1', '2'])
+            ae(filt(None, {}, ('-','status'), ('-','nosy')),
+                ['4', '3', '2', '1'])
 
     def testFilteringLinkSortGroup(self):
         # 1: status: 2 -> 'i', priority: 3 -> 1
@@ -1927,6 +2083,41 @@ class DBTest(commonDBTest):
             ae(filt(None, {}, ('+','priority'), ('+','status')),
                 ['1', '4', '2', '3'])
 
+    def testFilteringLimitOffset(self):
+        ae, filter, filter_iter = self.filteringSetup()
+        for filt in filter, filter_iter:
+            sort = ('+','status'), ('+','priority')
+            ae(filt(None, {}, *sort, limit=2), ['1', '2'])
+            ae(filt(None, {}, *sort, limit=2, offset=1), ['2', '4'])
+            ae(filt(None, {}, *sort, offset=2), ['4', '3'])
+            ae(filt(None, {}, *sort, limit=3, offset=3), ['3'])
+            ae(filt(None, {}, *sort, limit=2, offset=4), [])
+            ae(filt(None, {'status': '1'}, ('-','id'), limit=1, offset=1),
+                ['2'])
+            ae(filt(None, {}, ('+','nosy'), limit=2, offset=1), ['2', '4'])
+        # sorting by two attributes of a Multilink is finished in python
+        # before paging
+        ae(filter(None, {}, [('+','nosy.age'), ('+','nosy.username')],
+            limit=2, offset=1), ['2', '3'])
+        cls = self.db.issue
+        ae(cls.filter_count(None, {}), 4)
+        ae(cls.filter_count(None, {'status': '1'}), 2)
+        ae(cls.filter_count(None, {'nosy': ['1', '2']}), 2)
+        ae(cls.filter_count([], {}), 0)
+        ae(cls.filter_count(['1', '3'], {'status': '1'}), 1)
+
+    def testPagedFilterResult(self):
+        self.filteringSetup()
+        l = hyperdb.PagedFilterResult(self.db.issue, None, {}, [('-','id')],
+            [], pagesize=2)
+        self.assertEqual(l[1], '3')
+        self.assertEqual(l.ids, {1: '3', 2: '2'})
+        self.assertEqual(list(l), ['4', '3', '2', '1'])
+        self.assertEqual(l[-1], '1')
+        self.assertEqual(l[1:3], ['3', '2'])
+        self.assertEqual(len(l), 4)
+        self.assertRaises(IndexError, l.__getitem__, 4)
+
     def testFilteringDateSort(self):
         # '1': '2003-02-16.22:50'
         # '2': '2003-01-01.00:00'
@@ -2108,8 +2299,20 @@ class DBTest(commonDBTest):
 
     def testFilteringTransitiveMultilinkSort(self):
         # Note that we don't test filter_iter here, Multilink sort-order
-        # isn't defined for that.
-        ae, filt, dummy = self.filteringSetupTransitiveSearch()
+        # isn't defined for that when sorting by several attributes of a
+        # Multilink.
+        ae, filter, filter_iter = self.filteringSetupTransitiveSearch()
+        # a single attribute of a Multilink is sorted by the database
+        for filt in filter, filter_iter:
+            ae(filt(None, {}, [('+','messages.author')]),
+                ['1', '2', '3', '4', '5', '8', '6', '7'])
+            ae(filt(None, {}, [('-','messages.date')]),
+                ['1', '2', '3', '4', '8', '5', '6', '7'])
+            ae(filt(None, {}, [('+','messages.author.supervisor')]),
+                ['1', '2', '3', '4', '5', '6', '7', '8'])
+            ae(filt(None, {}, [('-','messages.author.username')],
+                limit=3, offset=1), ['6', '7', '5'])
+        filt = filter
         ae(filt(None, {}, [('+','messages.author')]),
             ['1', '2', '3', '4', '5', '8', '6', '7'])
         ae(filt(None, {}, [('-','messages.author')]),
@@ -2213,6 +2416,22 @@ class DBTest(commonDBTest):
         self.db = self.module.Database(config, 'admin')
         setupSchema(self.db, 0, self.module)
 
+    def testImportIndexes(self):
+        if not hasattr(self.db, 'sql'):
+            return
+        # end_import() restores exactly the indexes begin_import() dropped
+        indexes = [index for index in ['_status_retired_idx',
+            '_status_name_idx', '_status_key_retired_idx']
+            if self.db.sql_index_exists('_status', index)]
+        self.assert_('_status_name_idx' in indexes)
+        self.db.begin_import('status')
+        for index in indexes:
+            self.assertEqual(self.db.sql_index_exists('_status', index), 0)
+        self.db.end_import('status')
+        for index in indexes:
+            self.assertEqual(self.db.sql_index_exists('_status', index), 1)
+        self.db.commit()
+
     def testImportExport(self):
         # use the filtering setup to create a bunch of items
         ae, dummy1, dummy2 = self.filteringSetup()
@@ -2597,6 +2816,48 @@ class DBTest(commonDBTest):
             roundupdb._ = old_translate_
             Mailer.smtp_send = backup
 
+    def testNosyMailEnvelope(self):
+        db = self.db
+        db.config.NOSY_EMAIL_SENDING = 'envelope'
+        res = []
+        def dummy_snd(s, to, msg, res=res) :
+            res.append((to, msg))
+        backup, Mailer.smtp_send = Mailer.smtp_send, dummy_snd
+        try:
+            u = db.user.create(username="bleep", roles='User',
+                address='bleep@example.com')
+            m = db.msg.create(content="one two", author="admin")
+            i = db.issue.create(title='spam', messages=[m],
+                nosy=[db.user.lookup("fred"), u])
+            db.issue.nosymessage(i, m, {})
+            [(to, msg)] = res
+            self.assertEqual(to, ["bleep@example.com", "fred@example.com"])
+            self.assert_("To: %s\n" % db.config.TRACKER_EMAIL in msg)
+        finally:
+            Mailer.smtp_send = backup
+
+    def testNosyMailQueue(self):
+        db = self.db
+        db.config.MAIL_QUEUE = True
+        queue = get_mail_queue(db.config)
+        m = db.msg.create(content="one two", author="admin")
+        i = db.issue.create(title='spam', messages=[m],
+            nosy=[db.user.lookup("fred")])
+        db.commit()
+        # nothing is queued before the commit
+        db.issue.nosymessage(i, m, {})
+        self.assertEqual(queue.waiting(), [])
+        db.rollback()
+        self.assertEqual(queue.waiting(), [])
+        db.issue.nosymessage(i, m, {})
+        db.commit()
+        [name] = queue.waiting()
+        sender, to, msg, attempts = queue.take(name)
+        self.assertEqual(to, ["fred@example.com"])
+        self.assert_("Subject: [issue1] spam" in msg)
+        self.assertEqual(attempts, 0)
+        queue.done(name)
+
     @pytest.mark.skipif(gpgmelib.pyme is None, reason='Skipping PGPNosy test')
     def testPGPNosyMail(self) :
         """Creates one issue with two attachments, one smaller and one larger
@@ -3039,6 +3300,35 @@ class FilterCacheTest(commonDBTest):
             self.db.clearCache()
         ae (result, ['4', '5', '6', '7', '8', '1', '2', '3'])
 
+    def testNodeCacheLRU(self):
+        ae = self.assertEqual
+        self.filteringSetupTransitiveSearch()
+        self.db.commit()
+        self.db.cache_size = 3
+        self.db.cache_class_size = {'msg': 2}
+        self.db.stats['cache_classes'] = {}
+        self.db.clearCache()
+        for id in '1', '2', '3', '4':
+            self.db.getnode('user', id)
+        for id in '1', '2', '3':
+            self.db.getnode('msg', id)
+        # the shared cache only keeps the 3 most recent users, the msg
+        # class has its own cache and doesn't evict any users
+        ae(sorted(self.db.cache), [('msg', '2'), ('msg', '3'),
+            ('user', '2'), ('user', '3'), ('user', '4')])
+        # a hit moves the node to the top of the LRU
+        self.db.getnode('user', '2')
+        self.db.getnode('user', '5')
+        ae(sorted(k for k in self.db.cache if k[0] == 'user'),
+            [('user', '2'), ('user', '4'), ('user', '5')])
+        if __debug__:
+            stats = self.db.stats['cache_classes']
+            ae(stats['user'], {'hits': 1, 'misses': 5, 'evictions': 2})
+            ae(stats['msg'], {'hits': 0, 'misses': 3, 'evictions': 1})
+            ae(self.db.cache_hit_rate('user'), 1/6.)
+        self.db.msg.destroy('3')
+        ae(sorted(k for k in self.db.cache if k[0] == 'msg'), [('msg', '2')])
+
 
 class ClassicInitBase(object):
     count = 0
@@ -3088,6 +3378,31 @@ class ClassicInitTest(ClassicInitBase):
         l = db.issue.list()
         ae(l, [])
 
+    def testSharedSchema(self):
+        ae = self.assertEqual
+        setupTracker(self.dirname, self.backend)
+        tracker = instance.open(self.dirname, optimize=1)
+        tracker.config.SHARE_SCHEMA = 'yes'
+        db = tracker.open('admin')
+        issue = db.issue
+        db.close()
+
+        db = self.db = tracker.open('admin')
+        # the classes are bound to the new database ...
+        self.assertTrue(db.issue is not issue)
+        ae(db.issue.db.getclasses(), db.getclasses())
+        ae(db.security.db.user.lookup('admin'), '1')
+        # ... but property definitions and detectors are shared
+        self.assertTrue(db.issue.properties is issue.properties)
+        self.assertTrue(db.issue.auditors is issue.auditors)
+        self.assertTrue(db.security.role is tracker.schema_security.role)
+        # and things still work, including the detectors
+        id = db.issue.create(title='spam')
+        ae(db.issue.get(id, 'status'), db.status.lookup('unread'))
+        self.assertTrue(db.security.hasPermission('Edit', '1', 'issue'))
+        self.assertFalse(db.security.hasPermission('Edit', '2', 'user',
+            itemid='1'))
+
 
 class ConcurrentDBTest(ClassicInitBase):
     def testConcurrency(self):
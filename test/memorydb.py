@@ -164,6 +164,9 @@ class Indexer(indexer_dbm.Indexer):
         self.words = {}
         self.files = {'_TOP':(0,None)}
         self.fileids = {}
+        self.offsets = {}
+        self.pending_files = {}
+        self.pending_words = {}
         self.changed = 0
 
     def save_index(self):
@@ -206,6 +209,8 @@ class Database(back_anydbm.Database):
         self.newnodes = {}      # keep track of the new nodes by class
         self.destroyednodes = {}# keep track of the destroyed nodes by class
         self.transactions = []
+        self.nodeindexes = {}   # secondary indexes opened for reading
+        self.indexdbs = {}
         self.tx_Source = None
 
     def filename(self, classname, nodeid, property=None, create=0):
@@ -227,7 +232,8 @@ class Database(back_anydbm.Database):
     def getOTKManager(self):
         return self.otks
 
-    def reindex(self, classname=None, show_progress=False):
+    def reindex(self, classname=None, show_progress=False, batch_size=100,
+            processes=None, state_file=None):
         pass
 
     def __repr__(self):
@@ -307,6 +313,8 @@ class Database(back_anydbm.Database):
     #
     def clear(self):
         self.items = {}
+        self.closenodeindexes()
+        self.indexdbs = {}
 
     def getclassdb(self, classname, mode='r'):
         """ grab a connection to the class db that will be used for
@@ -314,6 +322,12 @@ class Database(back_anydbm.Database):
         """
         return self.items[classname]
 
+    def getindexdb(self, classname, mode='r'):
+        return self.indexdbs.setdefault(classname, cldb())
+
+    def removeindexdb(self, classname):
+        self.indexdbs.pop(classname, None)
+
     def getCachedJournalDB(self, classname):
         return self.journals.setdefault(classname, {})
 
@@ -341,7 +355,8 @@ class Database(back_anydbm.Database):
     def doSetJournal(self, classname, nodeid, journal):
         self.journals.setdefault(classname, {})[nodeid] = journal
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, decode=True, daterange=None,
+            actions=None, limit=None, offset=None, direction='ascending'):
         # our journal result
         res = []
 
@@ -362,9 +377,10 @@ class Database(back_anydbm.Database):
         try:
             res += self.journals.get(classname, {})[nodeid]
         except KeyError:
-            if res: return res
-            raise IndexError, nodeid
-        return res
+            if not res:
+                raise IndexError, nodeid
+        return hyperdb.filter_journal(res, daterange=daterange,
+            actions=actions, limit=limit, offset=offset, direction=direction)
 
     def pack(self, pack_before):
         """ Delete all journal entries except "create" before 'pack_before'.
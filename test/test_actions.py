@@ -233,6 +233,8 @@ class LoginTestCase(ActionTestCase):
 
         # set the db password to 'right'
         self.client.db.user.get = lambda a,b: 'right'
+        self.client.db.config.WEB_PASSWORD_VERIFY_THREADS = 0
+        self.client.db.config.WEB_PASSWORD_CACHE_TIME = 0
 
         # unless explicitly overridden, we should never get here
         self.client.opendb = lambda a: self.fail(
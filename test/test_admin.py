@@ -6,6 +6,7 @@
 
 from __future__ import print_function
 import unittest, os, shutil, errno, sys, difflib, cgi, re
+from StringIO import StringIO
 
 from roundup.admin import AdminTool
 
@@ -70,6 +71,74 @@ class AdminTest(object):
         self.assertEqual(config['MAIL_DEBUG'], self.dirname + "/SendMail.LOG")
         
 
+    def install(self, dirname):
+        import sys
+        sys.argv=['main', '-i', dirname, 'install', 'classic', self.backend,
+            'mail_domain=example.com']
+        self.assertEqual(AdminTool().main(), 0)
+        sys.argv=['main', '-i', dirname, 'initialise', 'sekrit']
+        self.assertEqual(AdminTool().main(), 0)
+
+    def testExportImportParallel(self):
+        import sys, roundup.instance
+        self.install(self.dirname)
+        target = self.dirname + '_import'
+        export = self.dirname + '_export'
+        try:
+            db = roundup.instance.open(self.dirname).open('admin')
+            for i in range(5):
+                db.issue.create(title='issue %d'%i, nosy=['1'])
+            db.issue.retire('3')
+            db.commit()
+            db.close()
+
+            sys.argv=['main', '-i', self.dirname, 'export', 'processes=2',
+                'batch=2', export]
+            self.assertEqual(AdminTool().main(), 0)
+
+            self.install(target)
+            sys.argv=['main', '-i', target, 'import', 'processes=2',
+                'batch=2', export]
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertEqual(AdminTool().main(), 0)
+                output = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            # backends locking the whole database use a single process
+            if self.backend in ('anydbm', 'sqlite'):
+                self.assert_('Ignoring processes=2' in output, output)
+            else:
+                self.assertEqual(output, '')
+
+            db = roundup.instance.open(target).open('admin')
+            try:
+                self.assertEqual(sorted(db.issue.list(), key=int),
+                    ['1', '2', '4', '5'])
+                self.assertEqual(db.issue.get('3', 'title'), 'issue 2')
+                self.assertEqual(db.issue.get('5', 'nosy'), ['1'])
+                self.assertEqual(sorted(db.issue.find(nosy='1'), key=int),
+                    ['1', '2', '4', '5'])
+                # the id counter is set past the imported items
+                self.assert_(int(db.issue.create(title='new')) > 5)
+            finally:
+                db.close()
+        finally:
+            for dirname in target, export:
+                if os.path.exists(dirname):
+                    shutil.rmtree(dirname)
+
+    def testIntOptions(self):
+        from roundup.exceptions import UsageError
+        admin = AdminTool()
+        self.assertEqual(admin.int_options_from_args(['batch=0', 'dir'],
+            batch=100, processes=1), ({'batch': 1, 'processes': 1}, ['dir']))
+        self.assertRaises(UsageError, admin.int_options_from_args,
+            ['batch=x'], batch=100)
+        self.assertRaises(UsageError, admin.int_options_from_args,
+            ['spam=1'], batch=100)
+
 
 class anydbmAdminTest(AdminTest, unittest.TestCase):
     backend = 'anydbm'
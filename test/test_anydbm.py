@@ -16,6 +16,7 @@
 # SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
 
 import unittest, os, shutil, time
+from roundup import date
 from roundup.backends import get_backend
 
 from db_test_base import DBTest, ROTest, SchemaTest, ClassicInitTest, config
@@ -32,6 +33,63 @@ class anydbmDBTest(anydbmOpener, DBTest, unittest.TestCase):
     pass
 
 
+class anydbmIndexedOpener(anydbmOpener, object):
+    """ Run the tests with the secondary indexes kept. """
+    def setUp(self):
+        config.RDBMS_ANYDBM_INDEXES = True
+        super(anydbmIndexedOpener, self).setUp()
+
+    def tearDown(self):
+        super(anydbmIndexedOpener, self).tearDown()
+        config.RDBMS_ANYDBM_INDEXES = False
+
+
+class anydbmIndexedDBTest(anydbmIndexedOpener, DBTest, unittest.TestCase):
+    def testNodeIndexes(self):
+        def indexed():
+            return [f for f in os.listdir(config.DATABASE)
+                if f.startswith('indexes.issue')]
+        db = self.db
+        for i in range(4):
+            db.issue.create(title='i%d'%i, status=str(i % 2 + 1),
+                nosy=i and ['1'] or [],
+                deadline=date.Date('2017-0%d-01'%(i + 1)))
+        db.commit()
+        # the first search builds the indexes, later commits update them
+        self.assertEqual(db.issue.filter(None, {'status': '1'}), ['1', '3'])
+        self.assert_(indexed())
+        db.issue.set('3', status='2', nosy=[])
+        db.issue.retire('2')
+        db.commit()
+        self.assertEqual(db.issue.filter(None, {'status': '1'}), ['1'])
+        self.assertEqual(db.issue.filter(None, {'nosy': '-1'}), ['1', '3'])
+        self.assertEqual(db.issue.find(nosy='1'), ['4'])
+        self.assertEqual(db.issue.filter(None,
+            {'deadline': '2017-02-01;2017-03-01'}), ['3'])
+        self.assertEqual(db.issue.filter(None,
+            {'deadline': '2017-03-01;', 'status': '2'}), ['3', '4'])
+        self.assertEqual(db.status.lookup('unread'), '1')
+
+        # uncommitted changes are seen
+        db.issue.set('4', status='1')
+        db.status.set('1', name='new')
+        self.assertEqual(db.issue.filter(None, {'status': '1'}), ['1', '4'])
+        self.assertEqual(db.status.lookup('new'), '1')
+        self.assertRaises(KeyError, db.status.lookup, 'unread')
+        db.rollback()
+        self.assertEqual(db.issue.filter(None, {'status': '1'}), ['1'])
+        self.assertEqual(db.status.lookup('unread'), '1')
+
+        # a commit without indexes drops them, the next search with
+        # indexes builds them again
+        config.RDBMS_ANYDBM_INDEXES = False
+        db.issue.set('4', status='1')
+        db.commit()
+        self.assert_(not indexed())
+        config.RDBMS_ANYDBM_INDEXES = True
+        self.assertEqual(db.issue.filter(None, {'status': '1'}), ['1', '4'])
+
+
 class anydbmROTest(anydbmOpener, ROTest, unittest.TestCase):
     pass
 
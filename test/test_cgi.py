@@ -8,7 +8,7 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 
-import unittest, os, shutil, errno, sys, difflib, cgi, re, StringIO
+import unittest, os, shutil, errno, sys, difflib, cgi, re, StringIO, time
 
 from roundup.cgi import client, actions, exceptions
 from roundup.cgi.exceptions import FormError, NotFound
@@ -1463,6 +1463,37 @@ class FormTestCase(FormTestParent, unittest.TestCase):
             '8,resolved\r\n',
             output.getvalue())
 
+    def testCSVExportLinks(self):
+        bob = self.db.user.create(username='bob')
+        self.db.issue.create(title='spam', status='2', nosy=['1', bob])
+        self.db.issue.create(title='ham')
+        cl = self._make_client({'@columns': 'title,status,nosy',
+            '@sort': 'id'}, nodeid=None, userid='1')
+        cl.classname = 'issue'
+        output = StringIO.StringIO()
+        cl.request = MockNull()
+        cl.request.wfile = output
+        action = actions.ExportCSVAction(cl)
+        action.batch_size = 1
+        action.handle()
+        self.assertEquals('title,status,nosy\r\nspam,deferred,admin;bob\r\n'
+            'ham,unread,\r\n', output.getvalue())
+
+    def testCSVExportDanglingLink(self):
+        bob = self.db.user.create(username='bob')
+        self.db.issue.create(title='spam', nosy=['1', bob])
+        self.db.user.destroy(bob)
+        cl = self._make_client({'@columns': 'title,nosy'}, nodeid=None,
+            userid='1')
+        cl.classname = 'issue'
+        output = StringIO.StringIO()
+        cl.request = MockNull()
+        cl.request.wfile = output
+        actions.ExportCSVAction(cl).handle()
+        # the destroyed user is exported as its id
+        self.assertEquals('title,nosy\r\nspam,admin;%s\r\n'%bob,
+            output.getvalue())
+
     def testCSVExportBadColumnName(self):
         cl = self._make_client({'@columns': 'falseid,name'}, nodeid=None,
             userid='1')
@@ -1560,6 +1591,58 @@ class TemplateHtmlRendering(unittest.TestCase):
         self.assertNotEqual(-1,
            self.output[0].index('<!-- SHA: c87a4e18d59a527331f1d367c0c6cc67ee123e63 -->'))
 
+    def testCompiledTemplates(self):
+        # pages rendered from templates compiled to Python are the same
+        # as the interpreted ones
+        from roundup.cgi.templating import get_loader
+        html = self.dirname + '/html'
+        f = open(os.path.join(html, 'issue.tal.html'), 'w')
+        f.write("""<html><body tal:define="items python:[1, 2, 3]">
+<p i18n:translate="">Hello <b i18n:name="who" tal:content="request/classname"
+ >x</b>!</p>
+<ul><li tal:repeat="i items" tal:attributes="class python:i % 2 and 'odd'"
+ tal:omit-tag="python:i == 2"><span tal:replace="i"/></li></ul>
+<tal:block tal:condition="python:0">hidden</tal:block>
+<div tal:on-error="string:failed"><span tal:content="nosuchname"/></div>
+<input type="checkbox" tal:attributes="checked python:1" />
+<p tal:replace="structure string:&lt;em&gt;em&lt;/em&gt;"/>
+<metal:block metal:use-macro="templates/page/macros/icing">
+<tal:block metal:fill-slot="content">filled</tal:block>
+</metal:block></body></html>""")
+        f.close()
+
+        def render():
+            output = []
+            for path, template in (('', ''), ('issue', 'index'),
+                    ('issue1', 'item'), ('user1', 'item'),
+                    ('issue', 'tal')):
+                self.client.form = db_test_base.makeForm(
+                    {'@template': template})
+                self.client.path = path
+                self.client.determine_context()
+                # the csrf token is new for every page and the history
+                # of the uncommitted issue is dated when it's rendered
+                page = re.sub(r'value="[0-9a-f]{64}"', 'value=""',
+                    self.client.renderContext())
+                output.append(re.sub(r'\d{4}-\d\d-\d\d&nbsp;[\d:]{8}', '',
+                    page))
+            return output
+
+        interpreted = render()
+        self.instance.templates = get_loader(html, 'zopetal',
+            compiled=True)
+        self.assertEqual(render(), interpreted)
+        self.assert_('<li class="odd">1</li>' in interpreted[-1])
+        self.assert_('<input type="checkbox" checked="checked" />' in
+            interpreted[-1])
+        self.assert_(os.path.exists(os.path.join(html,
+            'issue.item.html.talc')))
+
+        # the cached code is used by a new loader
+        self.instance.templates = get_loader(html, 'zopetal',
+            compiled=True)
+        self.assertEqual(render(), interpreted)
+
     def testrenderContext(self):
         # set up the client;
         # run determine_context to set the required client attributes
@@ -1812,4 +1895,131 @@ class TemplateTestCase(unittest.TestCase):
         r = t.selectTemplate("user", "subdir/item")
         self.assertEquals("subdir/user.item", r)
 
+    def testTemplateCache(self):
+        from roundup.cgi.templating import get_loader
+        html = self.dirname + '/html'
+        def write(name, text):
+            f = open(os.path.join(html, name), 'w')
+            f.write('<p>%s</p>'%text)
+            f.close()
+        def render(loader, name):
+            return loader.load(name).render(MockNull(), None, MockNull())
+
+        write('test.view.html', 'one')
+        check = get_loader(html, 'zopetal')
+        frozen = get_loader(html, 'zopetal', 'frozen')
+        poll = get_loader(html, 'zopetal', 'poll', 3600)
+        self.assert_(frozen.compiled)
+        for loader in check, frozen, poll:
+            self.assertEqual(render(loader, 'test.view'), '<p>one</p>\n')
+        self.assertRaises(NoTemplate, check.load, '../config.ini')
+
+        # make sure the template's modification time changes
+        write('test.view.html', 'two')
+        mtime = time.time() + 10
+        os.utime(os.path.join(html, 'test.view.html'), (mtime, mtime))
+        write('test.new.html', 'new')
+        self.assertEqual(render(check, 'test.view'), '<p>two</p>\n')
+        self.assert_(check.check('test.new'))
+        for loader in frozen, poll:
+            self.assertEqual(render(loader, 'test.view'), '<p>one</p>\n')
+            self.failIf(loader.check('test.new'))
+
+        # the poll loader looks again once the interval has passed
+        poll.checked -= 3600
+        self.assertEqual(render(poll, 'test.view'), '<p>two</p>\n')
+        self.assert_(poll.check('test.new'))
+
+    def testTemplateCacheShared(self):
+        from roundup.cgi.templating import get_loader
+        html = self.dirname + '/html'
+        def write(name, text):
+            f = open(os.path.join(html, name), 'w')
+            f.write('<p>%s</p>'%text)
+            f.close()
+
+        # a loader created when the tracker is opened again reuses the
+        # templates compiled before
+        write('test.view.html', 'one')
+        pt = get_loader(html, 'zopetal').load('test.view')
+        loader = get_loader(html, 'zopetal')
+        self.assert_(loader.load('test.view') is pt)
+        self.assert_(get_loader(html, 'zopetal', compiled=True).load(
+            'test.view') is not pt)
+
+        # unless they changed
+        write('test.view.html', 'two')
+        mtime = time.time() + 10
+        os.utime(os.path.join(html, 'test.view.html'), (mtime, mtime))
+        write('test.new.html', 'new')
+        os.utime(html, (mtime, mtime))
+        loader = get_loader(html, 'zopetal')
+        self.assertEqual(loader.load('test.view').render(MockNull(), None,
+            MockNull()), '<p>two</p>\n')
+        self.assert_(loader.check('test.new'))
+
+    def testCompiledTemplateRecompile(self):
+        from roundup.cgi.templating import get_loader
+        from roundup.cgi.engine_zopetal import Loader
+        html = self.dirname + '/html'
+        src = os.path.join(html, 'test.view.html')
+        def write(text, mtime):
+            f = open(src, 'w')
+            f.write('<p tal:condition="python:1">%s</p>'%text)
+            f.close()
+            os.utime(src, (mtime, mtime))
+
+        # the functions compiled for an edited template replace those
+        # compiled for it before
+        write('one', time.time())
+        loader = get_loader(html, 'zopetal', compiled=True)
+        pt = loader.load('test.view')
+        key = loader.names['test.view'][0]
+        old = set(Loader.programs_compiled[key])
+        self.assert_(id(pt._v_program) in old)
+        self.assert_(old <= set(Loader.functions_compiled))
+        write('two', time.time() + 10)
+        pt = loader.load('test.view')
+        self.assertEqual(pt.render(MockNull(), None, MockNull()),
+            '<p>two</p>\n')
+        new = set(Loader.programs_compiled[key])
+        self.assert_(id(pt._v_program) in new)
+        self.failIf(old & set(Loader.functions_compiled))
+
+class WsgiTrackerCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = '_test_wsgi'
+        self.instance = setupTracker(self.dirname)
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError as error:
+            if error.errno not in (errno.ENOENT, errno.ESRCH): raise
+
+    def testTrackerReuse(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        app = RequestDispatcher(self.dirname, check_interval=0)
+        tracker = app.get_tracker()
+        self.assertTrue(tracker.optimize)
+        self.assertTrue(app.get_tracker() is tracker)
+        # changing a tracker file opens the tracker again
+        schema = os.path.join(self.dirname, 'schema.py')
+        mtime = time.time() + 10
+        os.utime(schema, (mtime, mtime))
+        new_tracker = app.get_tracker()
+        self.assertFalse(new_tracker is tracker)
+        self.assertTrue(app.get_tracker() is new_tracker)
+        # the check is skipped within check_interval
+        app.check_interval = 3600
+        os.utime(schema, (mtime + 10, mtime + 10))
+        self.assertTrue(app.get_tracker() is new_tracker)
+
+    def testDebugOpensEveryRequest(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        app = RequestDispatcher(self.dirname, debug=True)
+        tracker = app.get_tracker()
+        self.assertFalse(tracker.optimize)
+        self.assertFalse(app.get_tracker() is tracker)
+
 # vim: set filetype=python sts=4 sw=4 et si :
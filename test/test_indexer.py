@@ -23,6 +23,7 @@ import os, unittest, shutil
 import pytest
 from roundup.backends import get_backend, have_backend
 from roundup.backends.indexer_rdbms import Indexer
+from roundup.backends.indexer_ranked import Indexer as RankedIndexer
 
 # borrow from other tests
 from db_test_base import setupSchema, config
@@ -158,6 +159,108 @@ class IndexerTest(unittest.TestCase):
             self.dex.add_text(('test', str(i), 'many'), 'many')
         self.assertEqual(len(self.dex.find(['many'])), 123)
 
+    def test_add_texts(self):
+        """Test adding a batch of texts."""
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.add_texts([(('test', '1', 'a'), 'blah world', 'text/plain'),
+            (('test', '2', 'a'), 'hello blah', 'text/plain'),
+            (('test', '3', 'a'), 'hello', 'text/html')])
+        self.assertSeqEqual(self.dex.find(['blah']), [('test', '1', 'a'),
+                                                   ('test', '2', 'a')])
+        self.assertSeqEqual(self.dex.find(['hello']), [('test', '2', 'a')])
+
+    def tearDown(self):
+        shutil.rmtree('test-index')
+
+class DbmIndexerTest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists('test-index'):
+            shutil.rmtree('test-index')
+        os.mkdir('test-index')
+        from roundup.backends.indexer_dbm import Indexer
+        self.Indexer = Indexer
+        self.dex = Indexer(db)
+        self.dex.load_index()
+
+    def reopen(self):
+        self.dex.save_index()
+        self.dex = self.Indexer(db)
+        self.dex.load_index()
+
+    def find(self, word):
+        return sorted(self.dex.find([word]))
+
+    def test_save_reload(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.add_text(('test', '2', 'a'), 'hello blah')
+        self.reopen()
+        self.assertEqual(self.find('hello'), [('test', '1', 'a'),
+                                              ('test', '2', 'a')])
+        self.dex.add_text(('test', '1', 'a'), 'blah')
+        self.reopen()
+        self.assertEqual(self.find('hello'), [('test', '2', 'a')])
+        self.assertEqual(self.find('blah'), [('test', '1', 'a'),
+                                             ('test', '2', 'a')])
+
+    def test_purge_reload(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.reopen()
+        self.dex.purge_entry(('test', '1', 'a'))
+        self.reopen()
+        self.assertEqual(self.find('hello'), [])
+
+    def test_incremental_save(self):
+        for i in range(500):
+            self.dex.add_text(('test', str(i), 'a'),
+                'hello world word%d other%d'%(i, i))
+        self.dex.save_index()
+        log = self.dex.path(self.dex.generation, 'log')
+        size = os.path.getsize(log)
+        self.dex.add_text(('test', '500', 'a'), 'hello')
+        self.dex.save_index()
+        # only the new text is written
+        self.assert_(os.path.getsize(log) - size < size / 10)
+
+    def test_merge(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.add_text(('test', '2', 'a'), 'hello blah')
+        self.dex.add_text(('test', '2', 'a'), 'blah')
+        self.dex.merge_index()
+        self.assertEqual(self.dex.generation, 1)
+        self.assertEqual(os.path.getsize(self.dex.path(1, 'log')), 0)
+        self.dex.add_text(('test', '3', 'a'), 'hello')
+        self.reopen()
+        self.assertEqual(self.find('hello'), [('test', '1', 'a'),
+                                              ('test', '3', 'a')])
+        self.assertEqual(self.find('blah'), [('test', '2', 'a')])
+        # a second merge drops the generation before the previous one
+        self.dex.merge_index()
+        self.dex.merge_index()
+        self.failIf(os.path.exists(self.dex.path(1, 'post')))
+        self.assertEqual(self.find('hello'), [('test', '1', 'a'),
+                                              ('test', '3', 'a')])
+
+    def test_save_after_merge(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.save_index()
+        other = self.Indexer(db)
+        other.load_index()
+        other.merge_index()
+        # the change is logged to the generation written by the merge
+        self.dex.add_text(('test', '2', 'a'), 'hello')
+        self.reopen()
+        self.assertEqual(self.find('hello'), [('test', '1', 'a'),
+                                              ('test', '2', 'a')])
+
+    def test_truncated_log(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.save_index()
+        log = open(self.dex.path(0, 'log'), 'ab')
+        log.write('\0\0\1\0partial')
+        log.close()
+        self.reopen()
+        self.assertEqual(self.find('hello'), [('test', '1', 'a')])
+
     def tearDown(self):
         shutil.rmtree('test-index')
 
@@ -198,6 +301,62 @@ class RDBMSIndexerTest(object):
             shutil.rmtree(config.DATABASE)
 
 
+class RankedIndexerTest(RDBMSIndexerTest):
+    def setUp(self):
+        RDBMSIndexerTest.setUp(self)
+        self.dex = RankedIndexer(self.db)
+
+    def test_or(self):
+        self.dex.add_text(('test', '1', 'a'), 'hello world')
+        self.dex.add_text(('test', '2', 'a'), 'blah blah')
+        self.dex.add_text(('test', '3', 'a'), 'something else')
+        self.assertSeqEqual(self.dex.match('world OR blah'),
+            [('test', '1', 'a'), ('test', '2', 'a')])
+        self.assertSeqEqual(self.dex.match('hello world OR else'),
+            [('test', '1', 'a'), ('test', '3', 'a')])
+
+    def test_phrase(self):
+        self.dex.add_text(('test', '1', 'a'), 'a memory leak in the parser')
+        self.dex.add_text(('test', '2', 'a'), 'leak of memory')
+        self.dex.add_text(('test', '3', 'a'), 'memory of the leak')
+        self.assertSeqEqual(self.dex.match('"memory leak"'),
+            [('test', '1', 'a')])
+        # stopwords still count as words between the words of a phrase
+        self.assertSeqEqual(self.dex.match('"leak in the parser"'),
+            [('test', '1', 'a')])
+        self.assertSeqEqual(self.dex.match('"leak parser"'), [])
+        self.assertSeqEqual(self.dex.match('memory leak'),
+            [('test', '1', 'a'), ('test', '2', 'a'), ('test', '3', 'a')])
+
+    def test_query(self):
+        setupSchema(self.db, 1, self.module)
+        self.db.indexer = self.dex
+        m1 = self.db.msg.create(content="crash crash crash on startup")
+        m2 = self.db.msg.create(content="crash when saving")
+        m3 = self.db.msg.create(content="nothing to see")
+        i1 = self.db.issue.create(title="startup problem", messages=[m1])
+        i2 = self.db.issue.create(title="saving", messages=[m2, m3])
+        i3 = self.db.issue.create(title="unrelated crash")
+        i4 = self.db.issue.create(title="unrelated")
+        self.db.commit()
+        issue = self.db.issue
+        self.assertEqual([i for i, score in self.dex.query('crash', issue)],
+            [i1, i2, i3])
+        self.assertEqual([i for i, score in self.dex.query('crash', issue,
+            limit=1)], [i1])
+        self.assertEqual([i for i, score in self.dex.query('startup',
+            issue)], [i1])
+        self.assertEqual(self.dex.search(['crash'], issue),
+            {i1: {'messages': [m1]}, i2: {'messages': [m2]}, i3: {}})
+        self.assertEqual(self.dex.search(['crash'], issue,
+            ignore={('msg', 'content'): 1}), {i3: {}})
+        self.assertEqual(self.dex.search(['startup'], issue),
+            {i1: {'messages': [m1]}})
+        # retired items aren't found through their links
+        issue.retire(i1)
+        self.assertEqual(self.dex.search(['startup'], issue), {i1: {}})
+
+
 @skip_postgresql
 class postgresqlIndexerTest(postgresqlOpener, RDBMSIndexerTest, IndexerTest):
     def setUp(self):
@@ -221,4 +380,7 @@ class mysqlIndexerTest(mysqlOpener, RDBMSIndexerTest, IndexerTest):
 class sqliteIndexerTest(sqliteOpener, RDBMSIndexerTest, IndexerTest):
     pass
 
+class sqliteRankedIndexerTest(sqliteOpener, RankedIndexerTest, IndexerTest):
+    pass
+
 # vim: set filetype=python ts=4 sw=4 et si
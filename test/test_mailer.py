@@ -1,5 +1,5 @@
 #-*- encoding: utf-8 -*-
-import unittest
+import os, shutil, smtplib, socket, time, unittest
 
 from roundup import mailer
 
@@ -12,4 +12,144 @@ class EncodingTestCase(unittest.TestCase):
             '=?iso8859-1?q?caf=E9?= <ascii@test.com>')
         a('as"ii', 'ascii@test.com', 'iso8859-1', '"as\\"ii" <ascii@test.com>')
 
+class FakeConfig(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+class FakeSMTP:
+    connections = []
+    refuse = ()
+    drop = False
+    def __init__(self, config):
+        if config['MAIL_HOST'] is None:
+            raise socket.error('connection refused')
+        self.sent = []
+        self.quitted = self.closed = False
+        self.reused = False
+        self.messages_sent = 0
+        FakeSMTP.connections.append(self)
+    def sendmail(self, sender, to, message):
+        if self.drop:
+            FakeSMTP.drop = False
+            raise smtplib.SMTPServerDisconnected('gone')
+        if to[0] in self.refuse:
+            raise smtplib.SMTPRecipientsRefused(to)
+        self.sent.append((sender, to, message))
+        self.messages_sent += 1
+    def quit(self):
+        self.quitted = True
+    def close(self):
+        self.closed = True
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = '_test_mailqueue'
+        if os.path.exists(self.dirname):
+            shutil.rmtree(self.dirname)
+        self.queue = mailer.MailQueue(self.dirname)
+        self.config = FakeConfig(MAIL_DEBUG='', TIMEZONE='UTC',
+            ADMIN_EMAIL='admin@test.test', MAIL_HOST='localhost',
+            MAILHOST='localhost', MAIL_PORT=25, MAIL_LOCAL_HOSTNAME='',
+            MAIL_TLS=False, MAIL_USERNAME='', MAIL_CONNECTION_IDLE_TIMEOUT=60,
+            MAIL_CONNECTION_MAX_MESSAGES=3)
+        self.mailer = mailer.Mailer(self.config)
+        self.mailer.debug = ''
+        self.backup, mailer.SMTPConnection = mailer.SMTPConnection, FakeSMTP
+        FakeSMTP.connections = []
+
+    def tearDown(self):
+        mailer.smtp_pool.clear()
+        mailer.SMTPConnection = self.backup
+        shutil.rmtree(self.dirname)
+
+    def testQueuedSend(self):
+        m = mailer.Mailer(self.config, queue=self.queue.put)
+        m.smtp_send(['a@test.test'], 'message 1')
+        m.smtp_send(['b@test.test', 'c@test.test'], 'message 2', 'x@test.test')
+        self.assertEqual(FakeSMTP.connections, [])
+        self.assertEqual(len(self.queue.waiting()), 2)
+        self.assertEqual(self.mailer.deliver_queue(self.queue), (2, 0))
+        # one connection for all messages, kept for reuse when done
+        [smtp] = FakeSMTP.connections
+        self.assertEqual(smtp.sent, [
+            ('admin@test.test', ['a@test.test'], 'message 1'),
+            ('x@test.test', ['b@test.test', 'c@test.test'], 'message 2')])
+        self.assert_(not smtp.quitted)
+        self.assertEqual(self.queue.waiting(), [])
+        mailer.smtp_pool.clear()
+        self.assert_(smtp.quitted)
+
+    def testConnectionReuse(self):
+        send = self.mailer.smtp_send
+        send(['a@test.test'], 'message 1')
+        send(['a@test.test'], 'message 2')
+        [smtp] = FakeSMTP.connections
+        self.assert_(smtp.reused)
+        # used up after three messages
+        send(['a@test.test'], 'message 3')
+        self.assert_(smtp.quitted)
+        send(['a@test.test'], 'message 4')
+        self.assertEqual(len(FakeSMTP.connections), 2)
+        # idle connections expire
+        self.config['MAIL_CONNECTION_IDLE_TIMEOUT'] = 0.01
+        time.sleep(0.02)
+        send(['a@test.test'], 'message 5')
+        self.assert_(FakeSMTP.connections[1].quitted)
+        self.assertEqual(len(FakeSMTP.connections), 3)
+        # with a zero timeout connections are closed right away
+        self.config['MAIL_CONNECTION_IDLE_TIMEOUT'] = 0
+        send(['a@test.test'], 'message 6')
+        self.assert_(FakeSMTP.connections[2].quitted)
+
+    def testReconnect(self):
+        send = self.mailer.smtp_send
+        send(['a@test.test'], 'message 1')
+        # the mail host has closed the idle connection
+        FakeSMTP.drop = True
+        send(['a@test.test'], 'message 2')
+        first, second = FakeSMTP.connections
+        self.assert_(first.closed)
+        self.assertEqual(second.sent, [('admin@test.test', ['a@test.test'],
+            'message 2')])
+        # a new connection isn't retried
+        FakeSMTP.drop = True
+        mailer.smtp_pool.clear()
+        self.assertRaises(mailer.MessageSendError, send, ['a@test.test'],
+            'message 3')
+        self.assertEqual(len(FakeSMTP.connections), 3)
+
+    def testRetry(self):
+        FakeSMTP.refuse = ('a@test.test',)
+        try:
+            self.queue.put('admin@test.test', ['a@test.test'], 'message 1')
+            self.queue.put('admin@test.test', ['b@test.test'], 'message 2')
+            self.assertEqual(self.mailer.deliver_queue(self.queue,
+                max_attempts=3), (1, 1))
+            # the failed message waits for a minute
+            self.assertEqual(self.queue.waiting(), [])
+            [name] = self.queue.waiting(time.time() + 61)
+            self.assertEqual(self.queue.take(name)[3], 1)
+            self.queue.retry(name, 2)
+            # and then for two
+            self.assertEqual(self.queue.waiting(time.time() + 61), [])
+            self.assertEqual(self.queue.waiting(time.time() + 121), [name])
+            os.utime(os.path.join(self.dirname, 'new', name), (0, 0))
+            self.assertEqual(self.mailer.deliver_queue(self.queue,
+                max_attempts=3), (0, 1))
+            self.assertEqual(os.listdir(os.path.join(self.dirname, 'new')),
+                [])
+            self.assertEqual(os.listdir(os.path.join(self.dirname, 'failed')),
+                [name])
+        finally:
+            FakeSMTP.refuse = ()
+
+    def testConnectionError(self):
+        self.config['MAIL_HOST'] = None
+        self.queue.put('admin@test.test', ['a@test.test'], 'message 1')
+        self.queue.put('admin@test.test', ['b@test.test'], 'message 2')
+        # the first failure stops the delivery
+        self.assertEqual(self.mailer.deliver_queue(self.queue), (0, 1))
+        self.assertEqual(len(self.queue.waiting()), 1)
+        self.assertEqual(len(self.queue.waiting(time.time() + 61)), 2)
+
 # vim: set et sts=4 sw=4 :
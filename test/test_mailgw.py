@@ -14,6 +14,7 @@
 import email
 import gpgmelib
 import unittest, tempfile, os, shutil, errno, imp, sys, difflib, time
+import mailbox, socket, threading, signal
 
 import pytest
 
@@ -4238,6 +4239,306 @@ Stack trace:
         fileid = self.db.msg.get(msgid, 'files')[0]
         self.assertEqual(self.db.file.get(fileid, 'type'), 'message/rfc822')
 
+    #
+    # Handling many messages
+    #
+    def _message(self, msgid, sender, subject):
+        return '''From: %s
+To: issue_tracker@your.tracker.email.domain.example
+Message-Id: <%s>
+Subject: %s
+
+This is message %s.
+'''%(sender, msgid, subject, msgid)
+
+    def testMailbox(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirname, 'mailbox')
+            f = open(path, 'w')
+            for message in (
+                    self._message('1', 'Chef <chef@bork.bork.bork>',
+                        '[issue] Testing...'),
+                    self._message('2', 'mary@test.test',
+                        'Re: [issue1] Testing... [status=chatting]')):
+                f.write('From chef@bork.bork.bork Mon Jan  1 00:00:00 2018\n')
+                f.write(message + '\n')
+            f.close()
+            handler = self._create_mailgw('')
+            self.assertEqual(handler.do_mailbox(path), 0)
+            self.assertEqual(os.path.getsize(path), 0)
+        finally:
+            shutil.rmtree(dirname)
+        self.assertEqual(self.db.issue.list(), ['1'])
+        self.assertEqual(self.db.issue.get('1', 'status'), '3')
+        self.assertEqual([self.db.msg.get(m, 'content')
+            for m in self.db.issue.get('1', 'messages')],
+            ['This is message 1.', 'This is message 2.'])
+
+    def testMaildir(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirname, 'Maildir')
+            maildir = mailbox.Maildir(path, factory=None)
+            for message in (
+                    self._message('1', 'Chef <chef@bork.bork.bork>',
+                        '[issue] Testing...'),
+                    self._message('2', 'mary@test.test',
+                        'Re: [issue1] Testing... [status=chatting]')):
+                maildir.add(message)
+                # the names start with the delivery time
+                time.sleep(1)
+            handler = self._create_mailgw('')
+            self.assertEqual(handler.do_maildir(path), 0)
+            self.assertEqual(os.listdir(os.path.join(path, 'new')), [])
+            self.assertEqual(os.listdir(os.path.join(path, 'cur')), [])
+        finally:
+            shutil.rmtree(dirname)
+        self.assertEqual(self.db.issue.list(), ['1'])
+        self.assertEqual(self.db.issue.get('1', 'status'), '3')
+        self.assertEqual([self.db.msg.get(m, 'content')
+            for m in self.db.issue.get('1', 'messages')],
+            ['This is message 1.', 'This is message 2.'])
+
+    def testMaildirProcesses(self):
+        dirname = tempfile.mkdtemp()
+        path = os.path.join(dirname, 'Maildir')
+        maildir = mailbox.Maildir(path, factory=None)
+        for i in range(4):
+            maildir.add(self._message(str(i), 'user%d@test.test'%i,
+                'Test %d'%i))
+        class MailGW(self.instance.MailGW):
+            fail = True
+            def handle_Message(self, message):
+                if self.fail:
+                    raise ValueError('failed')
+        handler = MailGW(self.instance, [('-P', '2')])
+        try:
+            # messages are only removed once they have been handled
+            self.assertRaises(mailgw.MailGWError, handler.do_maildir, path)
+            self.assertEqual(len(maildir.keys()), 4)
+            handler.fail = False
+            self.assertEqual(handler.do_maildir(path), 0)
+            self.assertEqual(maildir.keys(), [])
+        finally:
+            shutil.rmtree(dirname)
+
+    def testMaildirWatch(self):
+        dirname = tempfile.mkdtemp()
+        path = os.path.join(dirname, 'Maildir')
+        maildir = mailbox.Maildir(path, factory=None)
+        handled = []
+        class MailGW(self.instance.MailGW):
+            def handle_Message(self, message):
+                handled.append(message.getheader('message-id'))
+                if len(handled) == 2:
+                    raise KeyboardInterrupt
+        handler = MailGW(self.instance, [('-w', '')])
+        self.assertEqual(handler.watch, True)
+        maildir.add(self._message('1', 'chef@bork.bork.bork', 'One'))
+        def deliver():
+            time.sleep(0.5)
+            maildir.add(self._message('2', 'chef@bork.bork.bork', 'Two'))
+        thread = threading.Thread(target=deliver)
+        thread.start()
+        try:
+            # returns once the second message has been handled
+            self.assertEqual(handler.do_maildir(path), 0)
+        finally:
+            thread.join()
+            shutil.rmtree(dirname)
+        self.assertEqual(handled, ['<1>', '<2>'])
+
+    def testMaildirWatchSigterm(self):
+        dirname = tempfile.mkdtemp()
+        path = os.path.join(dirname, 'Maildir')
+        maildir = mailbox.Maildir(path, factory=None)
+        for i in range(2):
+            maildir.add(self._message(str(i), 'chef@bork.bork.bork', 'Test'))
+            # the names start with the delivery time
+            time.sleep(1)
+        second = sorted(maildir.keys())[1]
+        class MailGW(self.instance.MailGW):
+            def handle_Message(self, message):
+                if message.getheader('message-id') == '<1>':
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    time.sleep(1)
+        handler = MailGW(self.instance, [('-w', '')])
+        try:
+            # SIGTERM stops the gateway like Ctrl-C, leaving the message
+            # being handled in the Maildir
+            self.assertEqual(handler.do_maildir(path), 0)
+            self.assertEqual(maildir.keys(), [second])
+            self.assertEqual(signal.getsignal(signal.SIGTERM),
+                signal.SIG_DFL)
+        finally:
+            shutil.rmtree(dirname)
+
+    def testImapIdle(self):
+        class Socket:
+            timeout = 60
+            def gettimeout(self):
+                return self.timeout
+            def settimeout(self, timeout):
+                self.timeout = timeout
+        class Server:
+            def __init__(self, lines):
+                self.lines = lines
+                self.sent = []
+                self.sock = Socket()
+            def _new_tag(self):
+                return 'A1'
+            def send(self, data):
+                self.sent.append(data)
+            def socket(self):
+                return self.sock
+            def _get_line(self):
+                line = self.lines.pop(0)
+                if line is None:
+                    raise socket.timeout
+                return line
+        handler = self._create_mailgw('')
+        server = Server(['+ idling', '* OK Still here', '* 1 EXISTS',
+            'A1 OK IDLE terminated'])
+        handler._imap_idle(server)
+        self.assertEqual(server.sent, ['A1 IDLE\r\n', 'DONE\r\n'])
+        self.assertEqual(server.lines, [])
+        self.assertEqual(server.sock.timeout, 60)
+        # the command is ended when it times out
+        server = Server(['+ idling', None, '* 2 EXISTS',
+            'A1 OK IDLE terminated'])
+        handler._imap_idle(server)
+        self.assertEqual(server.sent, ['A1 IDLE\r\n', 'DONE\r\n'])
+        self.assertEqual(server.lines, [])
+        server = Server(['A1 BAD unknown command'])
+        self.assertRaises(mailgw.MailGWError, handler._imap_idle, server)
+
+    def testGroupMessages(self):
+        messages = [mailgw.Message(StringIO(self._message(*m))) for m in (
+            ('1', 'chef@bork.bork.bork', '[issue] Testing...'),
+            ('2', 'mary@test.test', 'Other [status=chatting]'),
+            ('3', 'Mary <MARY@test.test>', 'Re: Third'),
+            ('4', 'rgg@test.test', 'Re: "Testing..." [status=resolved]'),
+            ('5', 'john@test.test', '[issue4] Fourth'),
+            ('6', 'richard@test.test', 'Fwd: [issue4] Fourth'))]
+        handler = self._create_mailgw('')
+        self.assertEqual(handler.message_keys(messages[3]),
+            ['from:rgg@test.test', 'title:testing...'])
+        self.assertEqual(handler.message_keys(messages[5]),
+            ['from:richard@test.test', 'designator:issue4'])
+        # messages with the same title, sender or designator stay together
+        self.assertEqual(handler.group_messages(messages, 3),
+            [[0, 3], [1, 2], [4, 5]])
+        self.assertEqual(handler.group_messages(messages, 1),
+            [range(6)])
+        self.assertEqual(handler.group_messages(messages, 5),
+            [[0, 3], [1, 2], [4, 5], [], []])
+
+    def testHandleMessagesProcesses(self):
+        dirname = tempfile.mkdtemp()
+        class MailGW(self.instance.MailGW):
+            batch_size = 4
+            def handle_Message(self, message):
+                f = open(os.path.join(dirname, str(os.getpid())), 'a')
+                f.write(message.getheader('message-id') + '\n')
+                f.close()
+        handler = MailGW(self.instance, [('-P', '3')])
+        self.assertEqual(handler.processes, 3)
+        try:
+            handler.handle_Messages([self._message(str(i),
+                'user%d@test.test'%(i % 4), '[issue%d] Test'%(i % 3))
+                for i in range(10)])
+            handled = []
+            for name in os.listdir(dirname):
+                handled.append(open(os.path.join(dirname, name)).read().split())
+        finally:
+            shutil.rmtree(dirname)
+        # the batches of four messages are handled by up to three
+        # processes, each in the order the messages were received
+        self.assert_(len(handled) > 3)
+        for ids in handled:
+            self.assertEqual(ids, sorted(ids, key=lambda i: int(i[1:-1])))
+        self.assertEqual(sorted([int(i[1:-1]) for ids in handled
+            for i in ids]), range(10))
+
+    def testFetchImap(self):
+        class Server:
+            def __init__(self, uids):
+                self.uids = uids
+                self.calls = []
+                self.deleted = []
+            def uid(self, command, *args):
+                self.calls.append((command,) + args[:1])
+                if command == 'SEARCH':
+                    return 'OK', [' '.join([str(uid) for uid in self.uids
+                        if uid not in self.deleted])]
+                if command == 'STORE':
+                    self.deleted.append(int(args[0]))
+                    return 'OK', []
+                data = []
+                for uid in reversed(args[0].split(',')):
+                    # the UID may come before or after the text
+                    if int(uid) % 2:
+                        data.append(('%s (UID %s RFC822 {9}'%(uid, uid),
+                            'message %s'%uid))
+                        data.append(')')
+                    else:
+                        data.append(('%s (RFC822 {9}'%uid,
+                            'message %s'%uid))
+                        data.append(' UID %s)'%uid)
+                return 'OK', data
+        handler = self._create_mailgw('')
+        handler.fetch_size = 2
+        server = Server([3, 7, 12])
+        self.assertEqual(list(handler._imap_messages(server)),
+            [('3', 'message 3'), ('7', 'message 7'), ('12', 'message 12')])
+        self.assertEqual(server.calls, [('SEARCH', None), ('FETCH', '3,7'),
+            ('FETCH', '12')])
+
+        # messages are only marked as deleted once they have been handled
+        # and those marked already are skipped
+        server.deleted = [3]
+        class MailGW(self.instance.MailGW):
+            def handle_Message(self, message):
+                if message.fp.read() == 'message 12':
+                    raise ValueError('failed')
+        handler = MailGW(self.instance, [])
+        self.assertRaises(ValueError, handler.handle_Messages,
+            handler._imap_messages(server), lambda uid: server.uid('STORE',
+                uid, '+FLAGS', r'(\Deleted)'))
+        self.assertEqual(server.deleted, [3, 7])
+
+    def testFetchPop(self):
+        class Server:
+            def __init__(self, capabilities):
+                self.capabilities = capabilities
+                self.calls = []
+                self.sent = []
+            def _longcmd(self, command):
+                return '+OK', self.capabilities, 0
+            def _putcmd(self, command):
+                self.calls.append(command)
+                self.sent.append(int(command.split()[1]))
+            def _getlongresp(self):
+                i = self.sent.pop(0)
+                return '+OK', ['message %d'%i, 'line 2'], 20
+            def retr(self, i):
+                self.calls.append('retr %d'%i)
+                return '+OK', ['message %d'%i, 'line 2'], 20
+            def dele(self, i):
+                self.calls.append('dele %d'%i)
+        handler = self._create_mailgw('')
+        handler.fetch_size = 2
+        server = Server(['TOP', 'PIPELINING'])
+        self.assertEqual(list(handler._pop_messages(server, 3)),
+            ['message 1\nline 2', 'message 2\nline 2', 'message 3\nline 2'])
+        self.assertEqual(server.calls, ['RETR 1', 'RETR 2', 'dele 1',
+            'dele 2', 'RETR 3', 'dele 3'])
+        server = Server(['TOP'])
+        self.assertEqual(len(list(handler._pop_messages(server, 2))), 2)
+        self.assertEqual(server.calls, ['retr 1', 'retr 2', 'dele 1',
+            'dele 2'])
+
 
 @skip_pgp
 class MailgwPGPTestCase(MailgwTestAbstractBase, unittest.TestCase):
@@ -15,3 +15,50 @@ class AcceptLanguageTest(unittest.TestCase):
         self.assertEqual(parse(None),[])
         self.assertEqual(parse("   "), [])
         self.assertEqual(parse("en,"), ['en'])
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+    def cursor(self):
+        if self.closed:
+            raise ValueError('connection closed')
+        return self
+    def execute(self, sql):
+        pass
+    def fetchone(self):
+        return (1,)
+    def rollback(self):
+        self.cursor()
+    def close(self):
+        self.closed = True
+
+class FakeDatabase:
+    def sql_open_connection(self):
+        conn = FakeConnection()
+        return conn, conn.cursor()
+
+class ConnectionPoolTest(unittest.TestCase):
+    def testPool(self):
+        from roundup.backends.rdbms_common import ConnectionPool
+        pool = ConnectionPool(min_size=1, max_size=2, idle_timeout=60)
+        db = FakeDatabase()
+        conns = [pool.get(db)[0] for i in range(3)]
+        for conn in conns:
+            pool.put(conn)
+        # only max_size connections are kept
+        self.assertEqual([c for c, t in pool.idle], conns[:2])
+        self.assertTrue(conns[2].closed)
+        # the most recently used connection is handed out first
+        self.assertTrue(pool.get(db)[0] is conns[1])
+        # broken connections are replaced
+        conns[0].close()
+        conn = pool.get(db)[0]
+        self.assertFalse(conn in conns)
+        self.assertEqual(pool.idle, [])
+        # idle connections expire, but min_size are kept
+        pool.put(conns[1])
+        pool.put(conn)
+        pool.idle = [(c, t - 120) for c, t in pool.idle]
+        pool.expire()
+        self.assertEqual([c for c, t in pool.idle], [conn])
+        self.assertTrue(conns[1].closed)
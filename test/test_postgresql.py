@@ -203,6 +203,57 @@ class postgresqlClassicInitTest(postgresqlOpener, ClassicInitTest,
         postgresqlOpener.tearDown(self)
 
 
+@skip_postgresql
+class postgresqlConnectionPoolTest(postgresqlOpener, ClassicInitBase,
+                                   unittest.TestCase):
+    backend = 'postgresql'
+    def setUp(self):
+        postgresqlOpener.setUp(self)
+        ClassicInitBase.setUp(self)
+        self.tracker = setupTracker(self.dirname, self.backend)
+        self.tracker.config.RDBMS_CONNECTION_POOL_SIZE = 2
+
+    def tearDown(self):
+        ClassicInitBase.tearDown(self)
+        postgresqlOpener.tearDown(self)
+        self.tracker.config.RDBMS_CONNECTION_POOL_SIZE = 0
+
+    def testConnectionReuse(self):
+        db = self.tracker.open('admin')
+        db.getSessionManager().set('k', v=1)
+        db.commit()
+        conns = set((id(db.conn), id(db.Session.conn)))
+        db.close()
+        db = self.db = self.tracker.open('admin')
+        self.assertTrue(id(db.conn) in conns)
+        self.assertTrue(id(db.getSessionManager().conn) in conns)
+        self.assertEqual(db.Session.get('k', 'v'), 1)
+        # a broken connection is replaced on checkout
+        db.close()
+        self.db = None
+        pool = self.module.rdbms_common.get_connection_pool(db)
+        for conn, t in pool.idle:
+            conn.close()
+        db = self.db = self.tracker.open('admin')
+        self.assertEqual(db.user.lookup('admin'), '1')
+
+    def testDoubleClose(self):
+        db = self.tracker.open('admin')
+        session = db.getSessionManager()
+        db.close()
+        db.close()
+        session.close()
+        pool = self.module.rdbms_common.get_connection_pool(db)
+        conns = [id(conn) for conn, t in pool.idle]
+        self.assertEqual(len(conns), len(set(conns)))
+        db = self.db = self.tracker.open('admin')
+        other = self.tracker.open('admin')
+        try:
+            self.assertTrue(db.conn is not other.conn)
+        finally:
+            other.close()
+
+
 from session_common import SessionTest
 @skip_postgresql
 class postgresqlSessionTest(postgresqlOpener, SessionTest, unittest.TestCase):
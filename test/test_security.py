@@ -410,8 +410,119 @@ class PermissionTest(MyTestCase, unittest.TestCase):
         self.assertEquals(has(uimu, 'issue', 'messages.recipients'), 1)
         self.assertEquals(has(uimu, 'issue', 'messages.recipients.username'), 1)
 
+    def testCompiledPermissions(self):
+        add = self.db.security.addPermission
+        has = self.db.security.hasPermission
+        addToRole = self.db.security.addPermissionToRole
+        calls = []
+        def own_issue(db, userid, itemid):
+            calls.append(itemid)
+            return itemid == '1'
+        u = self.db.user.create(username='one', roles='User')
+        addToRole('User', add(name='Edit', klass='issue', check=own_issue))
+        self.assertEquals(has('Edit', u, 'issue'), 1)
+        self.assertEquals(has('Edit', u, 'issue', itemid='1'), 1)
+        self.assertEquals(has('Edit', u, 'issue', itemid='2'), 0)
+        self.assertEquals(calls, ['1', '2'])
+        self.assertEquals(self.db.security.compiled[(('user',), 'Edit',
+            'issue', None)][0][0], 0)
+        # adding a permission without check invalidates the lookups
+        addToRole('User', add(name='Edit', klass='issue', properties=['title']))
+        self.assertEquals(has('Edit', u, 'issue', 'title', itemid='2'), 1)
+        self.assertEquals(calls, ['1', '2'])
+        # so does changing the permissions of a role directly
+        role = self.db.security.role['user']
+        permissions = role.permissions
+        role.permissions = []
+        self.assertEquals(has('Edit', u, 'issue', 'title', itemid='2'), 0)
+        role.permissions = permissions
+        self.assertEquals(has('Edit', u, 'issue', 'title', itemid='2'), 1)
+        # changed roles apply before the transaction is committed
+        self.db.user.set(u, roles='Anonymous')
+        self.assertEquals(has('Edit', u, 'issue'), 0)
+        self.db.user.set(u, roles='User')
+        self.assertEquals(has('Edit', u, 'issue'), 1)
+
+    def testFilterWithPermissions(self):
+        add = self.db.security.addPermission
+        addToRole = self.db.security.addPermissionToRole
+        calls = []
+        def assigned(db, userid, itemid):
+            calls.append(itemid)
+            return db.issue.get(itemid, 'assignedto') == userid
+        def assigned_filter(db, userid, klass):
+            return [{'assignedto': userid}]
+        u = self.db.user.create(username='one', roles='User')
+        addToRole('Admin', add(name='View', klass='issue'))
+        ids = [self.db.issue.create(title='i%d' % i, assignedto=[None, u][i%2])
+            for i in range(10)]
+        filt = self.db.issue.filter_with_permissions
+        # unconditional permission
+        self.assertEquals(filt(None, {}, userid='1'), ids)
+        # full-text matches ranked by score unless sorted otherwise
+        scores = {ids[2]: 1, ids[5]: 3, ids[7]: 3}
+        self.assertEquals(filt(scores, {}, userid='1', ranked=True),
+            [ids[5], ids[7], ids[2]])
+        self.assertEquals(filt(scores, {}, [('-','id')], userid='1',
+            ranked=True), [ids[7], ids[5], ids[2]])
+        # no permission
+        self.assertEquals(filt(None, {}, userid=u), [])
+        # check function only: checked as far as accessed
+        p = add(name='View', klass='issue', check=assigned)
+        addToRole('User', p)
+        l = filt(None, {}, [('+','id')], userid=u)
+        self.assertEquals(l[1], ids[3])
+        self.assertEquals(calls, ids[:4])
+        self.assertEquals(l.known_length(), None)
+        self.assertEquals(list(l), ids[1::2])
+        self.assertEquals(len(l), 5)
+        self.assertEquals(l.known_length(), 5)
+        # a batch of the first page doesn't check all items for its total
+        from roundup.cgi.templating import Batch
+        del calls[:]
+        batch = Batch(None, filt(None, {}, [('+','id')], userid=u), 2, 0)
+        self.assertEquals(batch.known_length, None)
+        self.assertEquals(calls, ids[:4])
+        self.assertEquals(batch.sequence_length, 5)
+        self.assertEquals(batch.known_length, 5)
+        # with a filter the check function isn't called at all
+        del calls[:]
+        p.filter = assigned_filter
+        self.assertEquals(filt(None, {}, [('-','id')], userid=u),
+            ids[::-2])
+        self.assertEquals(filt(None, {'title': 'i3'}, userid=u), [ids[3]])
+        self.assertEquals(filt(['3', '4'], {}, userid=u), ['4'])
+        self.assertEquals(calls, [])
+
     # roundup.password has its own built-in test, call it.
     def test_password(self):
         roundup.password.test()
 
+    def test_password_verifier(self):
+        Password = roundup.password.Password
+        stored = Password('sekrit', 'PBKDF2')
+        for threads in 0, 2:
+            verifier = roundup.password.Verifier(threads, cache_time=60)
+            self.assert_(verifier.verify(stored, 'sekrit'))
+            self.assert_(not verifier.verify(stored, 'not sekrit'))
+            # only the successful check is cached, without the password
+            self.assertEqual(len(verifier.cache), 1)
+            self.assert_('sekrit' not in verifier.cache.keys()[0])
+            # a cached check doesn't hash the password again
+            verifier.check = lambda stored, plaintext: 1/0
+            self.assert_(verifier.verify(stored, 'sekrit'))
+            self.assertRaises(ZeroDivisionError, verifier.verify, stored,
+                'not sekrit')
+            self.assertRaises(ZeroDivisionError, verifier.verify,
+                Password('sekrit', 'PBKDF2'), 'sekrit')
+            # expired checks are done again
+            verifier.cache[verifier.cache.keys()[0]] = 0
+            self.assertRaises(ZeroDivisionError, verifier.verify, stored,
+                'sekrit')
+        # errors of the worker threads are raised by verify
+        verifier = roundup.password.Verifier(1)
+        self.assertRaises(ValueError, verifier.verify, Password(), 'sekrit')
+        self.assert_(roundup.password.get_verifier(1, 60) is
+            roundup.password.get_verifier(1, 60))
+
 # vim: set filetype=python sts=4 sw=4 et si :
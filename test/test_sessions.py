@@ -0,0 +1,79 @@
+import os, shutil, unittest
+
+from roundup.backends import sessions_dbm, sessions_rdbms
+
+class FakeConfig:
+    DATABASE = '_test_sessions'
+    UMASK = 002
+
+class FakeDB:
+    config = FakeConfig()
+
+class CountingSessions(sessions_dbm.Sessions):
+    opened = 0
+    def opendb(self, mode):
+        self.opened += 1
+        return sessions_dbm.Sessions.opendb(self, mode)
+
+class CodecTestCase(unittest.TestCase):
+    def testRoundTrip(self):
+        values = {'user': 'admin', '__timestamp': 1234567890.5,
+            'uid': '1', 'count': 3, 'flags': ['a', 'b']}
+        data = sessions_rdbms.dumps(values)
+        self.assert_(isinstance(data, str))
+        self.assertEqual(sessions_rdbms.loads(data), values)
+
+    def testLegacyRepr(self):
+        values = {'user': 'admin', '__timestamp': 1234567890.5}
+        self.assertEqual(sessions_rdbms.loads(repr(values)), values)
+
+    def testNoEval(self):
+        self.assertRaises(ValueError, sessions_rdbms.loads,
+            "{'user': __import__('os').getcwd()}")
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(FakeConfig.DATABASE):
+            shutil.rmtree(FakeConfig.DATABASE)
+        os.makedirs(FakeConfig.DATABASE)
+        self.sessions = CountingSessions(FakeDB())
+
+    def tearDown(self):
+        shutil.rmtree(FakeConfig.DATABASE)
+
+    def testSingleRead(self):
+        self.sessions.set('key', user='admin')
+        self.sessions.commit()
+        self.sessions.opened = 0
+        # what a page view for a logged-in user does
+        self.assert_(self.sessions.exists('key'))
+        self.assertEqual(self.sessions.getall('key'), {'user': 'admin'})
+        self.sessions.updateTimestamp('key')
+        self.assertEqual(self.sessions.get('key', 'user'), 'admin')
+        self.assertEqual(self.sessions.opened, 1)
+
+    def testUnchangedSet(self):
+        self.sessions.set('key', user='admin')
+        self.sessions.opened = 0
+        self.sessions.set('key', user='admin')
+        self.assertEqual(self.sessions.opened, 0)
+        self.sessions.set('key', user='demo')
+        self.assertEqual(self.sessions.opened, 1)
+        self.assertEqual(self.sessions.get('key', 'user'), 'demo')
+
+    def testCommitDropsCache(self):
+        self.sessions.set('key', user='admin')
+        other = CountingSessions(FakeDB())
+        other.set('key', user='demo')
+        self.assertEqual(self.sessions.get('key', 'user'), 'admin')
+        self.sessions.commit()
+        self.assertEqual(self.sessions.get('key', 'user'), 'demo')
+
+    def testDestroy(self):
+        self.sessions.set('key', user='admin')
+        self.sessions.destroy('key')
+        self.failIf(self.sessions.exists('key'))
+        self.sessions.commit()
+        self.failIf(self.sessions.exists('key'))
+
+# vim: set et sts=4 sw=4 :